@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# Synthetic Cassandra data directories for the benchmark suite.
+#
+# Generated trees follow the Cassandra layout:
+#   <data_dir>/<keyspace>/<table>-<uuid>/<version>-<generation>-big-<Component>
+# with snapshots created as hardlinks under <table>-<uuid>/snapshots/<tag>,
+# like nodetool snapshot does.
+
+import argparse
+import os
+import random
+import time
+import uuid
+
+COMPONENTS = ['CompressionInfo.db', 'Data.db', 'Digest.crc32', 'Filter.db', 'Index.db', 'Statistics.db',
+              'Summary.db', 'TOC.txt']
+SYSTEM_KEYSPACES = {'system': ['local', 'peers', 'size_estimates', 'sstable_activity'],
+                    'system_schema': ['keyspaces', 'tables', 'columns']}
+
+
+def component_size(component, data_size, rnd):
+   """
+   Get a realistic size for a SSTable component from its Data.db size
+
+   :type component: str
+   :type data_size: int
+   :type rnd: random.Random
+   :rtype: int
+   """
+   if component == 'Data.db':
+      return data_size
+   if component == 'Index.db':
+      return max(16, int(data_size * rnd.uniform(0.01, 0.05)))
+   if component == 'Filter.db':
+      return max(16, int(data_size * rnd.uniform(0.0005, 0.002)))
+   if component == 'CompressionInfo.db':
+      return 43 + (data_size // 65536 + 1) * 8
+   if component == 'Summary.db':
+      return max(64, int(data_size * rnd.uniform(0.0001, 0.0005)))
+   if component == 'Statistics.db':
+      return rnd.randint(4000, 12000)
+   if component == 'Digest.crc32':
+      return 10
+   return 92
+
+
+def write_file(path, size):
+   """
+   Write a file of random content without keeping it in memory
+
+   :type path: str
+   :type size: int
+   """
+   block = os.urandom(min(size, 65536))
+   with open(path, 'wb') as f:
+      remaining = size
+      while remaining > 0:
+         f.write(block[:remaining])
+         remaining -= len(block)
+
+
+class DataGenerator:
+   def __init__(self, data_dirs, keyspaces=4, tables=5, sstables=8, data_size=16 * 1024 * 1024, system=True,
+                seed=42):
+      """
+      Generate Cassandra data directories. Data.db sizes follow a log-normal
+      distribution around data_size, like tables with a few large compacted
+      SSTables and many small flushed ones.
+
+      :param data_dirs: data directories, tables are spread over them
+      :type data_dirs: list
+      :param keyspaces: number of user keyspaces
+      :param tables: number of tables per keyspace
+      :param sstables: number of SSTables per table
+      :param data_size: median Data.db size in bytes
+      :param system: also generate small system keyspaces
+      :param seed: random seed, the same seed generates the same tree
+      """
+      self.data_dirs = data_dirs
+      self.keyspaces = keyspaces
+      self.tables = tables
+      self.sstables = sstables
+      self.data_size = data_size
+      self.system = system
+      self.rnd = random.Random(seed)
+      self.generation = 0
+      self.table_dirs = []
+
+   def generate(self):
+      """
+      Generate the whole tree
+
+      :return: number of files and bytes written
+      :rtype: tuple
+      """
+      layout = {}
+      if self.system:
+         layout.update(SYSTEM_KEYSPACES)
+      for k in range(self.keyspaces):
+         layout['ks%d' % k] = ['table%d' % t for t in range(self.tables)]
+
+      files, size = 0, 0
+      for keyspace in sorted(layout):
+         for table in layout[keyspace]:
+            table_uuid = uuid.UUID(int=self.rnd.getrandbits(128)).hex
+            for data_dir in self.data_dirs:
+               table_dir = os.path.join(data_dir, keyspace, '-'.join([table, table_uuid]))
+               if not os.path.isdir(table_dir):
+                  os.makedirs(table_dir)
+               self.table_dirs.append(table_dir)
+               count = self.sstables if keyspace not in SYSTEM_KEYSPACES else 2
+               scale = self.data_size if keyspace not in SYSTEM_KEYSPACES else 64 * 1024
+               for _ in range(max(1, count // len(self.data_dirs))):
+                  f, s = self.add_sstable(table_dir, scale)
+                  files += f
+                  size += s
+      return files, size
+
+   def add_sstable(self, table_dir, scale=None):
+      """
+      Write a new SSTable in a table directory, like a memtable flush
+
+      :type table_dir: str
+      :param scale: median Data.db size in bytes
+      :return: number of files and bytes written
+      :rtype: tuple
+      """
+      self.generation += 1
+      data_size = max(1024, int(self.rnd.lognormvariate(0, 1) * (scale or self.data_size)))
+      size = 0
+      for component in COMPONENTS:
+         path = os.path.join(table_dir, 'mc-%d-big-%s' % (self.generation, component))
+         if component == 'TOC.txt':
+            # Cassandra lists the SSTable components in its TOC
+            with open(path, 'w') as f:
+               f.write('\n'.join(COMPONENTS) + '\n')
+            size += os.path.getsize(path)
+            continue
+         component_bytes = component_size(component, data_size, self.rnd)
+         write_file(path, component_bytes)
+         size += component_bytes
+      return len(COMPONENTS), size
+
+   def flush(self, ratio=0.1):
+      """
+      Add new SSTables to a part of the tables
+
+      :param ratio: ratio of tables getting a new SSTable
+      :return: number of files and bytes written
+      :rtype: tuple
+      """
+      files, size = 0, 0
+      for table_dir in self.table_dirs:
+         if self.rnd.random() < ratio:
+            f, s = self.add_sstable(table_dir)
+            files += f
+            size += s
+      return files, size
+
+
+def snapshot(data_dirs, tag=None):
+   """
+   Hardlink all live SSTables in snapshots/<tag>, like nodetool snapshot
+
+   :type data_dirs: list
+   :param tag: snapshot name, a timestamp in milliseconds by default
+   :rtype: str
+   """
+   tag = tag or str(int(time.time() * 1000))
+   for data_dir in data_dirs:
+      for keyspace in os.listdir(data_dir):
+         for table in os.listdir(os.path.join(data_dir, keyspace)):
+            table_dir = os.path.join(data_dir, keyspace, table)
+            snap_dir = os.path.join(table_dir, 'snapshots', tag)
+            files = [f for f in os.listdir(table_dir) if os.path.isfile(os.path.join(table_dir, f))]
+            if not os.path.isdir(snap_dir):
+               os.makedirs(snap_dir)
+            for f in files:
+               os.link(os.path.join(table_dir, f), os.path.join(snap_dir, f))
+   return tag
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Generate synthetic Cassandra data directories',
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+   parser.add_argument('data_dirs', nargs='+', help='Data directories to fill')
+   parser.add_argument('--keyspaces', type=int, default=4, help='Number of user keyspaces')
+   parser.add_argument('--tables', type=int, default=5, help='Number of tables per keyspace')
+   parser.add_argument('--sstables', type=int, default=8, help='Number of SSTables per table')
+   parser.add_argument('--data_size', type=float, default=16, help='Median Data.db size in MB')
+   parser.add_argument('--seed', type=int, default=42, help='Random seed')
+   arg = parser.parse_args()
+
+   generator = DataGenerator(arg.data_dirs, arg.keyspaces, arg.tables, arg.sstables,
+                             int(arg.data_size * 1024 * 1024), seed=arg.seed)
+   files, size = generator.generate()
+   print('Generated %d files, %.1f MB' % (files, size / 1024.0 / 1024))
+
+
+if __name__ == '__main__':
+   main()
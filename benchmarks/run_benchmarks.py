@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# Benchmark suite for cassnap_manage against a local WebHDFS stand-in.
+#
+# Each run generates a synthetic Cassandra node, starts a mock WebHDFS
+# cluster and measures the main actions: full and incremental snapshots,
+# listing, flush, retention, deletion and restore. Results are reported in
+# files/s and MB/s, with the time of each phase, and can be saved to compare
+# two runs:
+#
+#   python benchmarks/run_benchmarks.py --output before.json
+#   python benchmarks/run_benchmarks.py --compare before.json
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cassnap_manage
+import datagen
+from webhdfs_mock import MockCluster
+
+MB = 1024.0 * 1024
+SCENARIOS = ['snapshot_full', 'snapshot_incremental', 'list_snapshots', 'flush_snapshot', 'retention', 'delete',
+             'restore']
+
+
+class BenchSnapshot(cassnap_manage.ManageSnapshot):
+   def _take_local_snapshot(self):
+      """
+      Snapshot the synthetic data directories with hardlinks instead of nodetool
+      """
+      return datagen.snapshot(self.data_dirs)
+
+
+class Bench:
+   def __init__(self, arg):
+      """
+      Benchmark workspace: synthetic node, mock cluster and scenarios
+
+      :param arg: parsed command line arguments
+      """
+      self.arg = arg
+      self.workdir = tempfile.mkdtemp(prefix='cassnap_bench_')
+      self.data_dirs = [os.path.join(self.workdir, 'data%d' % i) for i in range(arg.disks)]
+      self.restore_dir = os.path.join(self.workdir, 'restore')
+      self.config = os.path.join(self.workdir, 'cassandra.yaml')
+      self.dest_dir = '/backup'
+      self.results = []
+
+      with open(self.config, 'w') as f:
+         f.write("cluster_name: 'Bench Cluster'\n")
+         f.write('data_file_directories:\n')
+         for data_dir in self.data_dirs:
+            f.write('    - %s\n' % data_dir)
+
+      self.cluster = MockCluster(os.path.join(self.workdir, 'hdfs'), datanodes=arg.datanodes, latency=arg.latency,
+                                 bandwidth=arg.bandwidth * MB if arg.bandwidth else None,
+                                 slow_datanodes=arg.slow_datanodes, slow_bandwidth=arg.slow_bandwidth * MB).start()
+      self.generator = datagen.DataGenerator(self.data_dirs, arg.keyspaces, arg.tables, arg.sstables,
+                                             int(arg.data_size * MB), seed=arg.seed)
+
+   def operation(self):
+      """
+      Build a fresh client for a scenario
+
+      :rtype: BenchSnapshot
+      """
+      metrics = cassnap_manage.RunMetrics(progress_interval=0)
+      storage = None
+      if self.arg.storage == cassnap_manage.LocalBackend.name:
+         # Same layout as the mock cluster, which only serves as a folder then
+         storage = cassnap_manage.LocalBackend(os.path.join(self.cluster.root, self.dest_dir.strip('/')), metrics)
+      return BenchSnapshot(None, None, False, None, None, self.config, self.cluster.url,
+                           self.dest_dir, False, workers=self.arg.workers, metrics=metrics, storage=storage,
+                           pack_threshold=self.arg.pack_threshold * 1024 if self.arg.pack_small_files else None,
+                           disk_readers=self.arg.disk_readers,
+                           transfer_monitor=cassnap_manage.TransferMonitor(slow_ratio=self.arg.slow_transfer_ratio,
+                                                                           grace=1))
+
+   def meta_path(self, operation, date):
+      return os.path.join(self.cluster.root, self.dest_dir.strip('/'), operation.meta_dir, operation.cluster_name,
+                          operation.hostname, 'cass_snap_' + date)
+
+   def make_history(self, operation, days):
+      """
+      Add older snapshots on the mock cluster: each one references the
+      current snapshot files plus some files of its own
+
+      :type operation: BenchSnapshot
+      :param days: number of daily snapshots to create
+      """
+      today = datetime.date.today()
+      current = self.meta_path(operation, today.strftime('%Y_%m_%d'))
+      with open(current) as f:
+         current_files = [line.strip() for line in f if line.strip()]
+
+      cluster_dir = os.path.join(self.cluster.root, self.dest_dir.strip('/'), operation.cluster_name)
+      for day in range(1, days + 1):
+         date = (today - datetime.timedelta(days=day)).strftime('%Y_%m_%d')
+         own = ['/'.join(['ks_history', 'day%d' % day, 'mc-%d-big-Data.db' % i]) for i in range(self.arg.history_files)]
+         for path in own:
+            local = os.path.join(cluster_dir, path)
+            if not os.path.isdir(os.path.dirname(local)):
+               os.makedirs(os.path.dirname(local))
+            datagen.write_file(local, 4096)
+         with open(self.meta_path(operation, date), 'w') as f:
+            f.write('\n'.join(current_files + own) + '\n')
+      return (today - datetime.timedelta(days=days)).strftime('%Y_%m_%d')
+
+   def make_deletion(self, operation):
+      """
+      Add files to delete on the mock cluster, in table directories of which
+      one out of two also holds a file to keep, like tables still written
+
+      :type operation: BenchSnapshot
+      :return: paths of the files to delete and directories holding files to
+               keep, relative to the destination folder
+      :rtype: tuple
+      """
+      cluster_dir = os.path.join(self.cluster.root, self.dest_dir.strip('/'), operation.cluster_name)
+      paths = []
+      referenced_dirs = []
+      for table in range(self.arg.delete_tables):
+         directory = '/'.join(['ks_delete', 'table%d' % table])
+         os.makedirs(os.path.join(cluster_dir, directory))
+         names = ['mc-%d-big-Data.db' % i for i in range(self.arg.delete_files)]
+         if table % 2:
+            names.append('mc-kept-big-Data.db')
+            referenced_dirs.append('/'.join([operation.cluster_name, directory]))
+         for name in names:
+            datagen.write_file(os.path.join(cluster_dir, directory, name), 1024)
+         paths += ['/'.join([operation.cluster_name, directory, name]) for name in names if 'kept' not in name]
+      return paths, referenced_dirs
+
+   def measure(self, name, action, files=None):
+      """
+      Run a scenario and record its result
+
+      :param name: scenario name
+      :param action: callable receiving a client
+      :param files: number of processed items when the metrics do not report them
+      """
+      operation = self.operation()
+      before = dict(self.cluster.stats)
+      start = time.time()
+      with contextlib.redirect_stdout(io.StringIO()):
+         action(operation)
+      duration = time.time() - start
+      operation.metrics.finish()
+
+      m = operation.metrics
+      processed = sum(m.files[s] for s in ('uploaded', 'skipped', 'downloaded', 'deleted'))
+      phases = {}
+      for phase, seconds in m.phases:
+         phases[phase] = round(phases.get(phase, 0) + seconds, 3)
+      moved = m.bytes['uploaded'] + m.bytes['downloaded']
+      if files is not None:
+         processed = files
+      requests = sum(self.cluster.stats.values()) - sum(before.values())
+      if self.arg.storage != cassnap_manage.WebHdfsBackend.name:
+         requests = sum(h['count'] for h in m.latencies.values())
+
+      result = {'scenario': name, 'duration': round(duration, 3), 'files': processed,
+                'mb': round(moved / MB, 3), 'files_s': round(processed / duration, 1) if duration else 0,
+                'mb_s': round(moved / MB / duration, 2) if duration else 0, 'requests': requests,
+                'failed': m.files['failed'], 'phases': phases}
+      self.results.append(result)
+      logging.getLogger('bench').info('%(scenario)s: %(duration).2fs, %(files)d files (%(files_s).1f/s), '
+                                      '%(mb).1f MB (%(mb_s).2f MB/s), %(requests)d requests' % result +
+                                      ''.join(', %s %.2fs' % (p, phases[p]) for p in sorted(phases)))
+
+   def run(self, scenarios):
+      """
+      Run the selected scenarios in order
+
+      :type scenarios: list
+      """
+      files, size = self.generator.generate()
+      logging.getLogger('bench').info('Generated %d files (%.1f MB) in %s' % (files, size / MB, self.workdir))
+
+      oldest = None
+      for name in SCENARIOS:
+         if name not in scenarios:
+            continue
+         if name == 'snapshot_full':
+            self.measure(name, lambda o: o.make_snapshot())
+         elif name == 'snapshot_incremental':
+            self.generator.flush(self.arg.flush_ratio)
+            self.measure(name, lambda o: o.make_snapshot())
+         elif name == 'list_snapshots':
+            oldest = self.make_history(self.operation(), self.arg.history_days)
+            self.measure(name, lambda o: o.list_snapshots(), files=self.arg.history_days + 1)
+         elif name == 'flush_snapshot' and oldest is not None:
+            self.measure(name, lambda o: o.flush_snapshot(None, oldest))
+         elif name == 'retention' and oldest is not None:
+            policy = cassnap_manage.RetentionPolicy(keep_daily=self.arg.keep_daily)
+            self.measure(name, lambda o: o.apply_retention(policy))
+         elif name == 'delete':
+            paths, referenced_dirs = self.make_deletion(self.operation())
+
+            def delete(o):
+               with o.metrics.phase('delete'):
+                  o.metrics.add('failed', files=len(o._bulk_delete_in_hadoop(paths, referenced_dirs)))
+            self.measure(name, delete, files=len(paths))
+         elif name == 'restore':
+            today = datetime.date.today().strftime('%Y_%m_%d')
+            self.measure(name, lambda o: o.restore_snapshot(None, today, self.restore_dir))
+
+   def close(self):
+      self.cluster.stop()
+      if not self.arg.keep:
+         shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def report(results, baseline=None):
+   """
+   Print results, with the relative change against a baseline if given
+
+   :type results: list
+   :type baseline: list
+   """
+   previous = dict((r['scenario'], r) for r in baseline or [])
+   print('%-22s %10s %10s %10s %10s %10s' % ('scenario', 'seconds', 'files/s', 'MB/s', 'requests', 'vs base'))
+   for r in results:
+      change = ''
+      base = previous.get(r['scenario'])
+      if base and base['duration'] > 0:
+         change = '%+.1f%%' % ((base['duration'] - r['duration']) / base['duration'] * 100)
+      print('%-22s %10.2f %10.1f %10.2f %10d %10s' % (r['scenario'], r['duration'], r['files_s'], r['mb_s'],
+                                                       r['requests'], change))
+
+
+def main():
+   parser = argparse.ArgumentParser(description='cassnap_manage benchmark suite',
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+   parser.add_argument('--scenarios', nargs='+', default=SCENARIOS, choices=SCENARIOS, help='Scenarios to run')
+   parser.add_argument('--keyspaces', type=int, default=4, help='Number of user keyspaces')
+   parser.add_argument('--tables', type=int, default=5, help='Number of tables per keyspace')
+   parser.add_argument('--sstables', type=int, default=8, help='Number of SSTables per table')
+   parser.add_argument('--data_size', type=float, default=2, help='Median Data.db size in MB')
+   parser.add_argument('--disks', type=int, default=1, help='Number of data directories')
+   parser.add_argument('--flush_ratio', type=float, default=0.2, help='Ratio of tables flushed before the '
+                                                                       'incremental snapshot')
+   parser.add_argument('--history_days', type=int, default=30, help='Number of older snapshots on the cluster')
+   parser.add_argument('--history_files', type=int, default=50, help='Files of their own per older snapshot')
+   parser.add_argument('--keep_daily', type=int, default=7, help='Daily snapshots kept by the retention scenario')
+   parser.add_argument('--delete_tables', type=int, default=20, help='Table directories of the delete scenario')
+   parser.add_argument('--delete_files', type=int, default=50, help='Files deleted per table directory by the '
+                                                                    'delete scenario')
+   parser.add_argument('--storage', default='webhdfs', choices=['webhdfs', 'local'],
+                       help='Storage backend: the WebHDFS mock cluster, or its folder written directly')
+   parser.add_argument('--datanodes', type=int, default=3, help='Number of mock datanodes')
+   parser.add_argument('--slow_datanodes', type=int, nargs='*', default=[], help='Indexes of degraded datanodes')
+   parser.add_argument('--slow_bandwidth', type=float, default=0.5, help='Degraded datanode bandwidth in MB/s')
+   parser.add_argument('--slow_transfer_ratio', type=float, default=0.1, help='Client slow write ratio, 0 to '
+                                                                              'disable')
+   parser.add_argument('--latency', type=float, default=0.002, help='Latency per request in seconds')
+   parser.add_argument('--bandwidth', type=float, default=None, help='Per transfer bandwidth in MB/s')
+   parser.add_argument('--workers', type=int, default=8, help='Client workers')
+   parser.add_argument('--disk_readers', type=int, default=2, help='Concurrent uploads per physical disk')
+   parser.add_argument('--pack_small_files', action='store_true', default=False,
+                       help='Pack small SSTable components in bundles')
+   parser.add_argument('--pack_threshold', type=int, default=4096, help='Packing threshold in KB')
+   parser.add_argument('--seed', type=int, default=42, help='Random seed of the synthetic data')
+   parser.add_argument('--output', default=None, help='Save results to a JSON file')
+   parser.add_argument('--compare', default=None, help='Compare with results saved in a JSON file')
+   parser.add_argument('--keep', action='store_true', default=False, help='Keep the workspace')
+   parser.add_argument('-v', '--verbosity', default='ERROR', help='cassnap_manage log level')
+   arg = parser.parse_args()
+
+   cassnap_manage.setup_log(name='cassnap_manage', level=arg.verbosity)
+   cassnap_manage.setup_log(name='bench', level='INFO')
+
+   bench = Bench(arg)
+   try:
+      bench.run(arg.scenarios)
+   finally:
+      bench.close()
+
+   baseline = None
+   if arg.compare:
+      with open(arg.compare) as f:
+         baseline = json.load(f)['results']
+   report(bench.results, baseline)
+
+   if arg.output:
+      with open(arg.output, 'w') as f:
+         json.dump({'args': vars(arg), 'results': bench.results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# Local WebHDFS stand-in used by the benchmark suite.
+#
+# It emulates a namenode answering metadata operations and redirecting data
+# operations (CREATE, APPEND, OPEN, GETFILECHECKSUM) to one of several
+# datanodes, each one being a small HTTP server with its own optional
+# latency and bandwidth limits. Files are stored in a local directory.
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+try:
+   from http.server import BaseHTTPRequestHandler, HTTPServer
+   from socketserver import ThreadingMixIn
+   from urllib.parse import urlparse, parse_qs, urlencode, quote, unquote
+except ImportError:
+   from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+   from SocketServer import ThreadingMixIn
+   from urlparse import urlparse, parse_qs
+   from urllib import urlencode, quote, unquote
+
+PREFIX = '/webhdfs/v1'
+CHUNK = 64 * 1024
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+   daemon_threads = True
+   allow_reuse_address = True
+   request_queue_size = 256
+
+
+class Throttle:
+   def __init__(self, bandwidth=None):
+      """
+      Limit a single transfer to a bandwidth in bytes per second
+
+      :type bandwidth: int
+      """
+      self.bandwidth = bandwidth
+      self.start = time.time()
+      self.done = 0
+
+   def consume(self, size):
+      self.done += size
+      if not self.bandwidth:
+         return
+      ahead = self.done / float(self.bandwidth) - (time.time() - self.start)
+      if ahead > 0:
+         time.sleep(ahead)
+
+
+class MockCluster:
+   def __init__(self, root, host='127.0.0.1', port=0, datanodes=3, latency=0.0, bandwidth=None,
+                slow_datanodes=None, slow_bandwidth=None, error_rate=0.0, legacy_500=True, user='cassnap'):
+      """
+      A namenode plus several datanodes serving the same storage root
+
+      :param root: local directory used as the HDFS namespace root
+      :param latency: seconds added to every request (namenode and datanodes)
+      :param bandwidth: per transfer bandwidth limit in bytes per second
+      :param slow_datanodes: indexes of datanodes which are degraded
+      :param slow_bandwidth: bandwidth of degraded datanodes in bytes per second
+      :param error_rate: ratio of namenode requests answered with a 503
+      :param legacy_500: answer 500 instead of 400 to data-less datanode writes, like the
+                         gateways the tool was originally written against
+      """
+      self.root = os.path.abspath(root)
+      self.host = host
+      self.latency = latency
+      self.bandwidth = bandwidth
+      self.slow_datanodes = set(slow_datanodes or [])
+      self.slow_bandwidth = slow_bandwidth
+      self.error_rate = error_rate
+      self.legacy_500 = legacy_500
+      self.user = user
+      self.lock = threading.Lock()
+      self.counter = 0
+      self.stats = {}
+      if not os.path.isdir(self.root):
+         os.makedirs(self.root)
+
+      self.namenode = ThreadedHTTPServer((host, port), self._handler('namenode'))
+      self.datanodes = [ThreadedHTTPServer((self.datanode_host(i), 0), self._handler(i)) for i in range(datanodes)]
+      self.threads = []
+
+   @property
+   def url(self):
+      return 'http://%s:%d%s' % (self.host, self.namenode.server_address[1], PREFIX)
+
+   def datanode_host(self, idx):
+      # Each datanode gets its own loopback address, so they can be excluded by host name
+      if self.host == '127.0.0.1':
+         return '127.0.0.%d' % (idx + 2)
+      return self.host
+
+   def datanode_address(self, idx):
+      return '%s:%d' % (self.datanode_host(idx), self.datanodes[idx].server_address[1])
+
+   def start(self):
+      for server in [self.namenode] + self.datanodes:
+         t = threading.Thread(target=server.serve_forever)
+         t.daemon = True
+         t.start()
+         self.threads.append(t)
+      return self
+
+   def stop(self):
+      for server in [self.namenode] + self.datanodes:
+         server.shutdown()
+         server.server_close()
+
+   def count(self, op):
+      with self.lock:
+         self.stats[op] = self.stats.get(op, 0) + 1
+         self.counter += 1
+         return self.counter
+
+   def local_path(self, path):
+      path = '/'.join([p for p in path.split('/') if p not in ('', '.', '..')])
+      return os.path.join(self.root, path)
+
+   def pick_datanode(self, excluded):
+      candidates = [i for i in range(len(self.datanodes))
+                    if self.datanode_address(i) not in excluded and self.datanode_host(i) not in excluded]
+      if not candidates:
+         candidates = list(range(len(self.datanodes)))
+      with self.lock:
+         self.counter += 1
+         return candidates[self.counter % len(candidates)]
+
+   def _handler(self, role):
+      cluster = self
+
+      class Handler(BaseHTTPRequestHandler):
+         protocol_version = 'HTTP/1.1'
+         disable_nagle_algorithm = True
+
+         def log_message(self, *args):
+            pass
+
+         def _reply(self, code, body=None, headers=None):
+            payload = b''
+            if body is not None:
+               payload = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            for k, v in (headers or {}).items():
+               self.send_header(k, v)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+         def _error(self, code, exception, message):
+            self._reply(code, {'RemoteException': {'exception': exception, 'message': message}})
+
+         def _drain(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            while length > 0:
+               data = self.rfile.read(min(CHUNK, length))
+               if not data:
+                  break
+               length -= len(data)
+
+         def _parse(self):
+            parsed = urlparse(self.path)
+            query = dict((k.lower(), v[-1]) for k, v in parse_qs(parsed.query).items())
+            path = unquote(parsed.path)
+            if path.startswith(PREFIX):
+               path = path[len(PREFIX):]
+            return path, query
+
+         def _status(self, local, name):
+            st = os.stat(local)
+            return {'pathSuffix': name,
+                    'type': 'DIRECTORY' if os.path.isdir(local) else 'FILE',
+                    'length': 0 if os.path.isdir(local) else st.st_size,
+                    'modificationTime': int(st.st_mtime * 1000),
+                    'accessTime': int(st.st_atime * 1000),
+                    'blockSize': 134217728, 'replication': 3,
+                    'owner': cluster.user, 'group': 'hadoop', 'permission': '755'}
+
+         def _dispatch(self, method):
+            path, query = self._parse()
+            op = query.get('op', '').upper()
+            cluster.count(op)
+            if cluster.latency:
+               time.sleep(cluster.latency)
+            if role == 'namenode':
+               if cluster.error_rate and (hash((time.time(), path)) % 1000) < cluster.error_rate * 1000:
+                  self._drain()
+                  return self._error(503, 'RetriableException', 'Mock namenode is busy')
+               return self._namenode(method, op, path, query)
+            return self._datanode(method, op, path, query)
+
+         def _redirect(self, path, query):
+            excluded = set(filter(None, query.get('excludedatanodes', '').split(',')))
+            idx = cluster.pick_datanode(excluded)
+            self._drain()
+            location = 'http://%s%s%s?%s' % (cluster.datanode_address(idx), PREFIX, quote(path), urlencode(query))
+            self._reply(307, None, {'Location': location})
+
+         def _namenode(self, method, op, path, query):
+            local = cluster.local_path(path)
+            if op == 'GETHOMEDIRECTORY':
+               return self._reply(200, {'Path': '/user/' + cluster.user})
+            if op == 'MKDIRS' and method == 'PUT':
+               if not os.path.isdir(local):
+                  os.makedirs(local)
+               return self._reply(200, {'boolean': True})
+            if op == 'CREATE' and method == 'PUT':
+               if os.path.exists(local) and query.get('overwrite', 'false').lower() != 'true':
+                  self._drain()
+                  return self._error(403, 'FileAlreadyExistsException', '%s already exists' % path)
+               return self._redirect(path, query)
+            if op in ('OPEN', 'GETFILECHECKSUM') and method == 'GET':
+               if not os.path.isfile(local):
+                  return self._error(404, 'FileNotFoundException', 'File does not exist: %s' % path)
+               return self._redirect(path, query)
+            if op == 'APPEND' and method == 'POST':
+               if not os.path.isfile(local):
+                  self._drain()
+                  return self._error(404, 'FileNotFoundException', 'File does not exist: %s' % path)
+               return self._redirect(path, query)
+            if op == 'DELETE' and method == 'DELETE':
+               if not os.path.exists(local):
+                  return self._reply(200, {'boolean': False})
+               if os.path.isdir(local):
+                  if os.listdir(local) and query.get('recursive', 'false').lower() != 'true':
+                     return self._error(403, 'PathIsNotEmptyDirectoryException', '%s is non empty' % path)
+                  shutil.rmtree(local)
+               else:
+                  os.remove(local)
+               return self._reply(200, {'boolean': True})
+            if op == 'LISTSTATUS' and method == 'GET':
+               if not os.path.exists(local):
+                  return self._error(404, 'FileNotFoundException', 'File %s does not exist.' % path)
+               if os.path.isfile(local):
+                  entries = [self._status(local, '')]
+               else:
+                  entries = [self._status(os.path.join(local, n), n) for n in sorted(os.listdir(local))]
+               return self._reply(200, {'FileStatuses': {'FileStatus': entries}})
+            if op == 'GETFILESTATUS' and method == 'GET':
+               if not os.path.exists(local):
+                  return self._error(404, 'FileNotFoundException', 'File does not exist: %s' % path)
+               return self._reply(200, {'FileStatus': self._status(local, '')})
+            if op == 'RENAME' and method == 'PUT':
+               dest = cluster.local_path(query.get('destination', ''))
+               if not os.path.exists(local) or os.path.exists(dest):
+                  return self._reply(200, {'boolean': False})
+               os.rename(local, dest)
+               return self._reply(200, {'boolean': True})
+            self._drain()
+            return self._error(400, 'IllegalArgumentException', 'Invalid operation %s' % op)
+
+         def _datanode(self, method, op, path, query):
+            local = cluster.local_path(path)
+            bandwidth = cluster.bandwidth
+            if role in cluster.slow_datanodes:
+               bandwidth = cluster.slow_bandwidth
+            throttle = Throttle(bandwidth)
+
+            if op in ('CREATE', 'APPEND'):
+               length = int(self.headers.get('Content-Length') or 0)
+               chunked = self.headers.get('Transfer-Encoding', '').lower() == 'chunked'
+               if self.headers.get('Content-Type') != 'application/octet-stream' and not length and not chunked:
+                  return self._error(500 if cluster.legacy_500 else 400, 'IllegalArgumentException',
+                                     'Data upload requests must have content-type set to application/octet-stream')
+               parent = os.path.dirname(local)
+               if not os.path.isdir(parent):
+                  os.makedirs(parent)
+               tmp = '%s.__mock_%d' % (local, threading.current_thread().ident)
+               if op == 'APPEND':
+                  shutil.copyfile(local, tmp)
+               received = 0
+               with open(tmp, 'ab') as f:
+                  for data in self._body(length, chunked):
+                     throttle.consume(len(data))
+                     f.write(data)
+                     received += len(data)
+               if not chunked and received < length:
+                  # The client went away, like HDFS do not commit a truncated write
+                  os.remove(tmp)
+                  self.close_connection = True
+                  return
+               if op == 'CREATE' and query.get('overwrite', 'false').lower() != 'true':
+                  # Like HDFS, the file is created without overwrite only if nobody created it meanwhile
+                  try:
+                     os.link(tmp, local)
+                  except OSError:
+                     return self._error(403, 'FileAlreadyExistsException', '%s already exists' % path)
+                  finally:
+                     os.remove(tmp)
+               else:
+                  os.rename(tmp, local)
+               if op == 'APPEND':
+                  return self._reply(200)
+               return self._reply(201, None, {'Location': 'hdfs://mock%s' % path})
+
+            if op == 'OPEN':
+               offset = int(query.get('offset', 0))
+               size = os.path.getsize(local)
+               length = int(query.get('length', size - offset))
+               length = max(0, min(length, size - offset))
+               self.send_response(200)
+               self.send_header('Content-Type', 'application/octet-stream')
+               self.send_header('Content-Length', str(length))
+               self.end_headers()
+               with open(local, 'rb') as f:
+                  f.seek(offset)
+                  while length > 0:
+                     data = f.read(min(CHUNK, length))
+                     if not data:
+                        break
+                     throttle.consume(len(data))
+                     self.wfile.write(data)
+                     length -= len(data)
+               return
+
+            if op == 'GETFILECHECKSUM':
+               md5 = hashlib.md5()
+               with open(local, 'rb') as f:
+                  for data in iter(lambda: f.read(CHUNK), b''):
+                     md5.update(data)
+               return self._reply(200, {'FileChecksum': {'algorithm': 'MD5-of-0MD5-of-512CRC32C',
+                                                         'bytes': md5.hexdigest(), 'length': 28}})
+
+            return self._error(400, 'IllegalArgumentException', 'Invalid datanode operation %s' % op)
+
+         def _body(self, length, chunked):
+            if chunked:
+               while True:
+                  size = int(self.rfile.readline().strip().split(b';')[0], 16)
+                  if size == 0:
+                     self.rfile.readline()
+                     break
+                  remaining = size
+                  while remaining > 0:
+                     data = self.rfile.read(min(CHUNK, remaining))
+                     if not data:
+                        return
+                     remaining -= len(data)
+                     yield data
+                  self.rfile.readline()
+               return
+            while length > 0:
+               data = self.rfile.read(min(CHUNK, length))
+               if not data:
+                  break
+               length -= len(data)
+               yield data
+
+         def do_GET(self):
+            self._dispatch('GET')
+
+         def do_PUT(self):
+            self._dispatch('PUT')
+
+         def do_POST(self):
+            self._dispatch('POST')
+
+         def do_DELETE(self):
+            self._dispatch('DELETE')
+
+      return Handler
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Local WebHDFS stand-in',
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+   parser.add_argument('--root', required=True, help='Local directory used as HDFS root')
+   parser.add_argument('--port', type=int, default=50070, help='Namenode port')
+   parser.add_argument('--datanodes', type=int, default=3, help='Number of datanodes')
+   parser.add_argument('--latency', type=float, default=0.0, help='Latency per request in seconds')
+   parser.add_argument('--bandwidth', type=float, default=None, help='Per transfer bandwidth in MB/s')
+   parser.add_argument('--slow_datanodes', type=int, nargs='*', default=[], help='Indexes of degraded datanodes')
+   parser.add_argument('--slow_bandwidth', type=float, default=1, help='Degraded datanode bandwidth in MB/s')
+   parser.add_argument('--error_rate', type=float, default=0.0, help='Ratio of namenode requests failing with 503')
+   arg = parser.parse_args()
+
+   mb = 1024 * 1024
+   cluster = MockCluster(arg.root, port=arg.port, datanodes=arg.datanodes, latency=arg.latency,
+                         bandwidth=arg.bandwidth * mb if arg.bandwidth else None,
+                         slow_datanodes=arg.slow_datanodes, slow_bandwidth=arg.slow_bandwidth * mb,
+                         error_rate=arg.error_rate).start()
+   print('WebHDFS mock listening on %s' % cluster.url)
+   try:
+      while True:
+         time.sleep(3600)
+   except KeyboardInterrupt:
+      cluster.stop()
+
+
+if __name__ == '__main__':
+   main()
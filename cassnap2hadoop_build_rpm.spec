@@ -7,8 +7,8 @@ Group:          Backup Client
 License:        GPL
 URL:            https://github.com/deimosfr/cassandra_snap_to_hadoop
 
-BuildRequires:  python python-pip gcc krb5-devel python-devel libcurl-devel python-virtualenv libyaml-devel
-Requires:       /usr/bin/python
+BuildRequires:  python3 >= 3.7 python3-pip gcc krb5-devel python3-devel libcurl-devel libyaml-devel
+Requires:       python3 >= 3.7
 Source0:  %{name}-%{version}.tgz
 
 %description
@@ -28,6 +28,7 @@ mkdir -p %{buildroot}/usr/bin
 cp -Rf %{_builddir}/%{name}-%{version}/* %{buildroot}/%{_datadir}/%{name}
 cp -Rf %{_builddir}/%{name}-%{version}/scripts/* %{buildroot}/usr/bin
 rm -rf %{buildroot}/%{_datadir}/%{name}/scripts
+%{_builddir}/%{name}-%{version}/bin/python -m compileall -q %{buildroot}/%{_datadir}/%{name}/cassnap_manage.py
 
 %clean
 rm -Rf %{_builddir}
@@ -16,7 +16,6 @@
 # Todo: vérifier qu'il n'y a plus de ligne du type:  [ERROR] Can't read system-sstable_activity-jb-4473-Index.db, check if file exists and permissions
 # Todo: les gets table doivent foirer du fait de la dernière modif sur les paths
 # Todo: lorsqu'un fichier existe déjà, faire un test de checksum avant d'override
-# Todo: ajouter le clear des snapshots
 # Todo: ajouter l'exclusion des
 
 __version__ = '0.1'
@@ -30,16 +29,69 @@ except:
    import ConfigParser as configparser
 import datetime
 import logging
-import requests
-from requests_kerberos import HTTPKerberosAuth, OPTIONAL
+import time
+import contextlib
+import importlib
 import socket
 import random
-import urllib3
 import re
 import subprocess
+import shutil
 import json
-import yaml
-from prettytable import PrettyTable
+import io
+import tarfile
+import tempfile
+import gzip
+import calendar
+import math
+import hashlib
+import threading
+import ctypes
+import ctypes.util
+import select
+import signal
+import queue
+import socketserver
+import functools
+import array
+import heapq
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+class LazyModule:
+   def __init__(self, name):
+      """
+      Module imported on first use. Heavy dependencies are only loaded by the
+      actions needing them, so short-lived commands (version, daemon control,
+      commitlog archiving) start fast.
+
+      :param name: module name
+      :type name: str
+      """
+      self._name = name
+      self._module = None
+      self._lock = threading.Lock()
+
+   def __getattr__(self, attr):
+      if self._module is None:
+         with self._lock:
+            if self._module is None:
+               self._module = importlib.import_module(self._name)
+      return getattr(self._module, attr)
+
+
+class SlowTransferError(IOError):
+   """
+   A transfer was abandoned because it ran far below the usual throughput
+   """
+
+
+requests = LazyModule('requests')
+urllib3 = LazyModule('urllib3')
+yaml = LazyModule('yaml')
 
 LVL = {'INFO': logging.INFO,
        'DEBUG': logging.DEBUG,
@@ -60,117 +112,2815 @@ def setup_log(name=__name__, level='INFO', log=None, console=True, form='%(ascti
    :param log: File to which log information
    :type log: str
 
-   :param console: If log information sent to console as well
-   :type console: Boolean
+   :param console: If log information sent to console as well
+   :type console: Boolean
+
+   :param form: The format in which the log will be displayed
+   :type form: str
+
+   :returns: The object logger
+   :rtype: logger object
+   """
+   level = level.upper()
+   if level not in LVL:
+      logging.warning("Option of log level %s incorrect, using INFO." % level)
+      level = 'INFO'
+   level = LVL[level]
+   formatter = logging.Formatter(form)
+   logger = logging.getLogger(name)
+   logger.setLevel(level)
+   if log is not None:
+      filehdl = logging.FileHandler(log)
+      filehdl.setFormatter(formatter)
+      logger.addHandler(filehdl)
+   if console is True:
+      consolehdl = logging.StreamHandler()
+      consolehdl.setFormatter(formatter)
+      logger.addHandler(consolehdl)
+   return logger
+
+
+_yaml_cache = {}
+
+
+def read_yaml_keys(path, keys):
+   """
+   Read some top-level keys of a YAML file. Only the blocks of these keys
+   are parsed: plain one-line values directly, others with the C loader of
+   PyYAML when available. Results are cached until the file changes.
+
+   :param path: YAML file path
+   :type path: str
+   :param keys: keys to read
+   :type keys: tuple
+   :return: key -> value of the keys set in the file
+   :rtype: dict
+   """
+   stat = os.stat(path)
+   cache_key = (path, tuple(keys), stat.st_mtime, stat.st_size)
+   if cache_key in _yaml_cache:
+      return dict(_yaml_cache[cache_key])
+
+   blocks = {}
+   current = None
+   with open(path, 'r') as stream:
+      for line in stream:
+         if line[:1] not in ('', ' ', '\t', '#', '\n', '\r', '-'):
+            key = line.split(':', 1)[0].strip()
+            current = key if key in keys else None
+            if current is not None:
+               blocks[current] = []
+         if current is not None:
+            blocks[current].append(line)
+
+   settings = {}
+   for key, lines in blocks.items():
+      value = lines[0].split(':', 1)[1].split(' #', 1)[0].strip()
+      rest = [l for l in lines[1:] if l.strip() and not l.lstrip().startswith('#')]
+      if not rest and re.match(r'''^(?:[\w./-]+|'[^'\\]*'|"[^"\\]*")$''', value):
+         settings[key] = value[1:-1] if value[0] in '\'"' else value
+         if value in ('null', '~', 'Null', 'NULL'):
+            settings[key] = None
+         continue
+      loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+      try:
+         document = yaml.load(''.join(lines), Loader=loader)
+      except yaml.YAMLError as e:
+         raise ValueError(str(e))
+      if isinstance(document, dict):
+         settings[key] = document.get(key)
+
+   settings = dict((k, v) for k, v in settings.items() if v is not None)
+   _yaml_cache[cache_key] = settings
+   return dict(settings)
+
+
+def create_connection_replacement(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None,
+                                  socket_options=None):
+   """
+   Overriding urllib3 to avoid possible 404 issue with Hadoop gateways
+
+   Sometimes, during a connexion to an hadoop cluster, you may not be able to
+   reach an hadoop web gateway (404 return). As 404 is not considered as
+   failed, urllib3 try to switch to another server in a round robin DNS case.
+   This override will permit to randomize the connexion IP when initializing
+   the first connexion to hadoop to avoid a such issue.
+   """
+   host, port = address
+   if host.startswith('['):
+      host = host.strip('[]')
+   err = None
+
+   addrinfo = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+   while len(addrinfo) > 0:
+      idx = random.randint(0, len(addrinfo) - 1)
+      af, socktype, proto, canonname, sa = addrinfo[idx]
+      del addrinfo[idx]
+
+      sock = None
+      try:
+         sock = socket.socket(af, socktype, proto)
+
+         # If provided, set socket level options before connecting.
+         # This is the only addition urllib3 makes to this function.
+         urllib3.util.connection._set_socket_options(sock, socket_options)
+
+         if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(timeout)
+         if source_address:
+            sock.bind(source_address)
+         sock.connect(sa)
+         return sock
+
+      except socket.error as _:
+         err = _
+         if sock is not None:
+            sock.close()
+            sock = None
+
+   if err is not None:
+      raise err
+   else:
+      raise socket.error("getaddrinfo returns an empty list")
+
+
+class TransferMonitor:
+   def __init__(self, slow_ratio=0.1, grace=5.0, min_samples=5, min_size=1024 * 1024, window=100,
+                logger=__name__):
+      """
+      Watch the throughput of datanode writes. A transfer running longer than
+      the grace period at less than slow_ratio of the median throughput of
+      recent transfers is abandoned, and its datanode is avoided for the rest
+      of the run.
+
+      :param slow_ratio: ratio of the median throughput under which a transfer
+                         is slow, 0 to disable
+      :type slow_ratio: float
+      :param grace: seconds before a transfer can be found slow
+      :type grace: float
+      :param min_samples: completed transfers required to get a median
+      :type min_samples: int
+      :param min_size: smaller transfers are dominated by latency and not
+                       used for the median
+      :type min_size: int
+      :param window: number of recent transfers used for the median
+      :type window: int
+      :type logger: str
+      """
+      self.slow_ratio = slow_ratio
+      self.grace = grace
+      self.min_samples = min_samples
+      self.min_size = min_size
+      self.window = window
+      self.logger = logging.getLogger(logger)
+      self.samples = []
+      self.slow_datanodes = set()
+      self._median = None
+      self._lock = threading.Lock()
+
+   def record(self, size, duration):
+      """
+      Record a completed transfer
+
+      :param size: bytes sent
+      :type size: int
+      :param duration: transfer duration in seconds
+      :type duration: float
+      """
+      if size < self.min_size or duration <= 0:
+         return
+      with self._lock:
+         self.samples.append(size / duration)
+         del self.samples[:-self.window]
+         if len(self.samples) >= self.min_samples:
+            self._median = sorted(self.samples)[len(self.samples) // 2]
+
+   def is_slow(self, size, elapsed):
+      """
+      Check if a running transfer is slow
+
+      :param size: bytes sent so far
+      :type size: int
+      :param elapsed: seconds since the transfer started
+      :type elapsed: float
+      :rtype: bool
+      """
+      if not self.slow_ratio or self._median is None or elapsed < self.grace:
+         return False
+      return size / elapsed < self._median * self.slow_ratio
+
+   def mark_slow(self, datanode):
+      """
+      Avoid a datanode for the rest of the run
+
+      :type datanode: str
+      """
+      with self._lock:
+         if datanode not in self.slow_datanodes:
+            self.logger.warning('Datanode %s is slow, avoiding it from now' % datanode)
+            self.slow_datanodes.add(datanode)
+
+
+class MonitoredBody:
+   def __init__(self, body, monitor, datanode):
+      """
+      File-like request body checking the transfer throughput on each read
+
+      :param body: file-like object with a known length
+      :type monitor: TransferMonitor
+      :param datanode: datanode receiving the body
+      :type datanode: str
+      """
+      self.body = body
+      self.monitor = monitor
+      self.datanode = datanode
+      self.sent = 0
+      self.slow = False
+      self.start = time.time()
+      if hasattr(body, '__len__'):
+         self.size = len(body)
+      else:
+         position = body.tell()
+         self.size = body.seek(0, os.SEEK_END) - position
+         body.seek(position)
+
+   def __len__(self):
+      return self.size
+
+   def check_slow(self):
+      """
+      Check the throughput of the transfer so far. Also called once a send
+      blocked between two reads timed out.
+
+      :return: True if the transfer is slow
+      :rtype: bool
+      """
+      if not self.slow and self.monitor.is_slow(self.sent, time.time() - self.start):
+         self.slow = True
+      return self.slow
+
+   def read(self, size=-1):
+      if self.check_slow():
+         raise SlowTransferError('Transfer to %s abandoned after %d bytes in %.1fs' % (
+            self.datanode, self.sent, time.time() - self.start))
+      data = self.body.read(size)
+      self.sent += len(data)
+      return data
+
+   def close(self):
+      if hasattr(self.body, 'close'):
+         self.body.close()
+
+
+class RetryPolicy:
+   # Hadoop exceptions which are worth a retry even with a 4xx status (HA failover, safe mode...)
+   RETRIABLE_EXCEPTIONS = ('StandbyException', 'RetriableException', 'SafeModeException',
+                           'AlreadyBeingCreatedException', 'RecoveryInProgressException')
+
+   def __init__(self, max_attempts=5, base_delay=0.5, max_delay=30, budget=500, logger=__name__):
+      """
+      Retry policy shared by all the Hadoop requests of a run. Delays between
+      attempts grow exponentially with full jitter, so many nodes retrying at
+      the same time do not hit the gateways together. The budget caps the
+      total number of retries of the run: once spent, requests fail at their
+      first error instead of piling up on a sick cluster.
+
+      :param max_attempts: maximum attempts for a single request
+      :type max_attempts: int
+      :param base_delay: delay before the first retry in seconds
+      :type base_delay: float
+      :param max_delay: maximum delay between two attempts in seconds
+      :type max_delay: float
+      :param budget: maximum number of retries for the whole run
+      :type budget: int
+      :type logger: str
+      """
+      self.max_attempts = max_attempts
+      self.base_delay = base_delay
+      self.max_delay = max_delay
+      self.budget = budget
+      self.retries = 0
+      self.logger = logging.getLogger(logger)
+      self._lock = threading.Lock()
+
+   def classify(self, response=None, error=None):
+      """
+      Classify the result of a request
+
+      :param response: the response if one was received
+      :type response: requests.Response
+      :param error: the exception raised by the request
+      :type error: Exception
+      :return: 'ok', 'retry' or 'fail'
+      :rtype: str
+      """
+      if error is not None:
+         if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                               requests.exceptions.ChunkedEncodingError, SlowTransferError)):
+            return 'retry'
+         return 'fail'
+
+      status = response.status_code
+      if status < 400:
+         return 'ok'
+      if status >= 500 or status == 429:
+         return 'retry'
+      try:
+         if any(e in response.text for e in self.RETRIABLE_EXCEPTIONS):
+            return 'retry'
+      except Exception:
+         pass
+      return 'fail'
+
+   def reset(self):
+      """
+      Give back the whole budget, for a new run of a long-running process
+      """
+      with self._lock:
+         self.retries = 0
+
+   def delay(self, attempt):
+      """
+      Get the delay to wait before an attempt
+
+      :param attempt: attempt number, starting at 1 for the first retry
+      :type attempt: int
+      :rtype: float
+      """
+      return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+   def _consume(self):
+      """
+      Take a retry from the run budget
+
+      :rtype: bool
+      """
+      with self._lock:
+         if self.retries >= self.budget:
+            return False
+         self.retries += 1
+         if self.retries == self.budget:
+            self.logger.error('Retry budget of %d retries exhausted, failing fast from now' % self.budget)
+         return True
+
+   def run(self, request, description=''):
+      """
+      Run a request until it succeeds, fails with a non retriable error or
+      runs out of attempts. The last response is returned whatever its
+      status, the last exception is raised if no response was received.
+
+      :param request: callable making the request and returning the response
+      :param description: request description for logs
+      :type description: str
+      :rtype: requests.Response
+      """
+      attempt = 0
+      while True:
+         response, error = None, None
+         try:
+            response = request()
+         except (requests.exceptions.RequestException, SlowTransferError) as e:
+            error = e
+
+         verdict = self.classify(response, error)
+         if verdict == 'ok':
+            return response
+
+         reason = error if error is not None else response.status_code
+         attempt += 1
+         if verdict == 'fail' or attempt >= self.max_attempts or not self._consume():
+            self.logger.debug('Giving up %s after %d attempt(s): %s' % (description, attempt, reason))
+            if response is None:
+               raise error
+            return response
+
+         wait = self.delay(attempt)
+         self.logger.warning('Retrying %s in %.1fs (attempt %d): %s' % (description, wait, attempt + 1, reason))
+         time.sleep(wait)
+
+
+class RateLimiter:
+   def __init__(self, rate=None):
+      """
+      Space calls of several threads evenly to stay under a rate
+
+      :param rate: maximum calls per second, None or 0 for no limit
+      :type rate: float
+      """
+      self.rate = rate
+      self._next = 0
+      self._lock = threading.Lock()
+
+   def wait(self):
+      """
+      Wait for the turn of the next call
+      """
+      if not self.rate:
+         return
+      with self._lock:
+         now = time.time()
+         start = max(now, self._next)
+         self._next = start + 1.0 / self.rate
+      if start > now:
+         time.sleep(start - now)
+
+
+class RunMetrics:
+   STAGES = ('discovered', 'skipped', 'uploaded', 'downloaded', 'verified', 'failed', 'deleted')
+   # Latency histogram buckets in seconds
+   BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+   def __init__(self, action='', progress_interval=60, profiler=None, logger=__name__):
+      """
+      Collect metrics of a run: files and bytes per stage, Hadoop requests
+      latencies and retries per operation, and time spent in each phase.
+
+      :param action: action name reported with the metrics
+      :type action: str
+      :param progress_interval: seconds between two progress logs, 0 to disable
+      :type progress_interval: int
+      :param profiler: records phases and requests as trace spans
+      :type profiler: Profiler
+      :type logger: str
+      """
+      self.action = action
+      self.profiler = profiler if profiler is not None else Profiler(logger=logger)
+      self.progress_interval = progress_interval
+      self.logger = logging.getLogger(logger)
+      self.start_time = time.time()
+      self.end_time = None
+      self.files = dict((stage, 0) for stage in self.STAGES)
+      self.bytes = dict((stage, 0) for stage in self.STAGES)
+      self.latencies = {}
+      self.retries = {}
+      self.phases = []
+      self.planned_files = 0
+      self.planned_bytes = 0
+      self.upload_start = None
+      self._lock = threading.Lock()
+      self._progress = None
+      self._stop = threading.Event()
+
+   def add(self, stage, files=1, size=0):
+      """
+      Account files in a stage
+
+      :param stage: one of STAGES
+      :type stage: str
+      :type files: int
+      :param size: size in bytes
+      :type size: int
+      """
+      with self._lock:
+         self.files[stage] += files
+         self.bytes[stage] += size
+
+   def observe(self, op, duration):
+      """
+      Record the latency of a Hadoop request
+
+      :param op: WebHDFS operation (CREATE, OPEN...)
+      :type op: str
+      :param duration: request duration in seconds
+      :type duration: float
+      """
+      with self._lock:
+         histogram = self.latencies.setdefault(op, {'buckets': [0] * (len(self.BUCKETS) + 1), 'sum': 0.0,
+                                                    'count': 0})
+         idx = len(self.BUCKETS)
+         for i, bound in enumerate(self.BUCKETS):
+            if duration <= bound:
+               idx = i
+               break
+         histogram['buckets'][idx] += 1
+         histogram['sum'] += duration
+         histogram['count'] += 1
+
+   def retry(self, op):
+      """
+      Record a retry of a Hadoop request
+
+      :type op: str
+      """
+      with self._lock:
+         self.retries[op] = self.retries.get(op, 0) + 1
+
+   @contextlib.contextmanager
+   def phase(self, name):
+      """
+      Measure the time spent in a phase of the run
+
+      :type name: str
+      """
+      start = time.time()
+      try:
+         with self.profiler.span(name):
+            yield
+      finally:
+         with self._lock:
+            self.phases.append((name, time.time() - start))
+
+   def start_upload(self, files, size):
+      """
+      Start the upload progress reporting
+
+      :param files: number of files to upload
+      :param size: bytes to upload
+      """
+      self.planned_files = files
+      self.planned_bytes = size
+      self.upload_start = time.time()
+
+      if self.progress_interval > 0 and self._progress is None:
+         self._progress = threading.Thread(target=self._report_progress)
+         self._progress.daemon = True
+         self._progress.start()
+
+   def stop_upload(self):
+      """
+      Stop the upload progress reporting
+      """
+      self._stop.set()
+      if self._progress is not None:
+         self._progress.join()
+         self._progress = None
+
+   def throughput(self):
+      """
+      Get the upload throughput in bytes per second
+
+      :rtype: float
+      """
+      if self.upload_start is None:
+         return 0.0
+      elapsed = (self.end_time or time.time()) - self.upload_start
+      return self.bytes['uploaded'] / elapsed if elapsed > 0 else 0.0
+
+   def eta(self):
+      """
+      Estimate the remaining upload time in seconds from the measured throughput
+
+      :return: seconds, None before the first upload completes
+      :rtype: float
+      """
+      throughput = self.throughput()
+      if not throughput:
+         return None
+      remaining = self.planned_bytes - self.bytes['uploaded'] - self.bytes['failed']
+      return max(0.0, remaining / throughput)
+
+   def _report_progress(self):
+      while not self._stop.wait(self.progress_interval):
+         self.logger.info(self.progress())
+
+   def progress(self):
+      """
+      Get a progress line of the upload
+
+      :rtype: str
+      """
+      mb = 1024.0 * 1024
+      done = self.files['uploaded'] + self.files['failed']
+      eta = self.eta()
+      return 'Progress: %d/%d files, %.1f/%.1f MB uploaded, %d failed, %.2f MB/s, ETA %s' % (
+         done, self.planned_files, self.bytes['uploaded'] / mb, self.planned_bytes / mb, self.files['failed'],
+         self.throughput() / mb, 'unknown' if eta is None else datetime.timedelta(seconds=int(eta)))
+
+   def summary(self):
+      """
+      Get the run summary
+
+      :rtype: dict
+      """
+      with self._lock:
+         end = self.end_time or time.time()
+         latencies = {}
+         for op, histogram in self.latencies.items():
+            latencies[op] = {'count': histogram['count'], 'sum': round(histogram['sum'], 6),
+                             'buckets': dict(zip([str(b) for b in self.BUCKETS] + ['+Inf'], histogram['buckets']))}
+
+         return {'action': self.action,
+                 'start': self.start_time,
+                 'duration': round(end - self.start_time, 3),
+                 'files': dict(self.files),
+                 'bytes': dict(self.bytes),
+                 'throughput_mb_s': round(self.throughput() / (1024.0 * 1024), 3),
+                 'retries': dict(self.retries),
+                 'latencies': latencies,
+                 'phases': [{'name': n, 'duration': round(d, 3)} for n, d in self.phases]}
+
+   def finish(self, json_file=None, prometheus_file=None):
+      """
+      End the run, log its summary and write it to files if requested
+
+      :param json_file: path of a JSON summary file
+      :type json_file: str
+      :param prometheus_file: path of a Prometheus node exporter textfile
+      :type prometheus_file: str
+      """
+      self.stop_upload()
+      self.end_time = time.time()
+      summary = self.summary()
+      self.logger.info('Run summary: %s' % json.dumps(summary, sort_keys=True))
+
+      if json_file is not None:
+         self._write_file(json_file, json.dumps(summary, indent=2, sort_keys=True))
+      if prometheus_file is not None:
+         self._write_file(prometheus_file, self.prometheus(summary))
+
+   def prometheus(self, summary):
+      """
+      Format a summary in Prometheus text format
+
+      :type summary: dict
+      :rtype: str
+      """
+      action = 'action="%s"' % summary['action']
+      lines = ['# TYPE cassnap_files gauge']
+      lines += ['cassnap_files{%s,stage="%s"} %d' % (action, k, v) for k, v in sorted(summary['files'].items())]
+      lines += ['# TYPE cassnap_bytes gauge']
+      lines += ['cassnap_bytes{%s,stage="%s"} %d' % (action, k, v) for k, v in sorted(summary['bytes'].items())]
+      lines += ['# TYPE cassnap_throughput_bytes_per_second gauge',
+                'cassnap_throughput_bytes_per_second{%s} %f' % (action, summary['throughput_mb_s'] * 1024 * 1024),
+                '# TYPE cassnap_run_duration_seconds gauge',
+                'cassnap_run_duration_seconds{%s} %f' % (action, summary['duration']),
+                '# TYPE cassnap_last_run_timestamp_seconds gauge',
+                'cassnap_last_run_timestamp_seconds{%s} %f' % (action, summary['start'] + summary['duration']),
+                '# TYPE cassnap_phase_duration_seconds gauge']
+      lines += ['cassnap_phase_duration_seconds{%s,phase="%s"} %f' % (action, p['name'], p['duration'])
+                for p in summary['phases']]
+      lines += ['# TYPE cassnap_retries gauge']
+      lines += ['cassnap_retries{%s,op="%s"} %d' % (action, k, v) for k, v in sorted(summary['retries'].items())]
+      lines += ['# TYPE cassnap_request_duration_seconds histogram']
+      for op, histogram in sorted(summary['latencies'].items()):
+         total = 0
+         for bound in [str(b) for b in self.BUCKETS] + ['+Inf']:
+            total += histogram['buckets'][bound]
+            lines.append('cassnap_request_duration_seconds_bucket{%s,op="%s",le="%s"} %d' % (action, op, bound, total))
+         lines.append('cassnap_request_duration_seconds_sum{%s,op="%s"} %f' % (action, op, histogram['sum']))
+         lines.append('cassnap_request_duration_seconds_count{%s,op="%s"} %d' % (action, op, histogram['count']))
+      return '\n'.join(lines) + '\n'
+
+   def _write_file(self, path, content):
+      """
+      Atomically write a file, readers never see a partial content
+
+      :type path: str
+      :type content: str
+      """
+      try:
+         tmp = '%s.%d.tmp' % (path, os.getpid())
+         with open(tmp, 'w') as f:
+            f.write(content)
+         os.rename(tmp, path)
+      except (IOError, OSError) as e:
+         self.logger.error('Could not write metrics to %s: %s' % (path, e))
+
+
+class Profiler:
+   def __init__(self, trace_file=None, cpu_file=None, memory=False, logger=__name__):
+      """
+      Record timing spans of a run (phases, Hadoop requests) and write them as
+      a Chrome trace, to open in chrome://tracing or Perfetto. cProfile and
+      tracemalloc can run along. A profiler without any output only hands
+      out empty spans.
+
+      :param trace_file: path of the Chrome trace JSON file
+      :type trace_file: str
+      :param cpu_file: path of the cProfile statistics file, for pstats or snakeviz
+      :type cpu_file: str
+      :param memory: trace Python allocations with tracemalloc
+      :type memory: bool
+      :type logger: str
+      """
+      self.trace_file = trace_file
+      self.cpu_file = cpu_file
+      self.memory = memory
+      self.enabled = trace_file is not None or cpu_file is not None or memory
+      self.logger = logging.getLogger(logger)
+      self.events = []
+      self._threads = {}
+      self._profiles = []
+      self._origin = time.perf_counter()
+      self._lock = threading.Lock()
+
+   def start(self):
+      """
+      Start cProfile and tracemalloc if requested. cProfile follows threads
+      started afterwards, like the worker pools.
+      """
+      if self.memory:
+         import tracemalloc
+         tracemalloc.start()
+      if self.cpu_file is not None:
+         self._profile_thread()
+         # From Python 3.12 a single profiler sees every thread
+         if sys.version_info < (3, 12):
+            threading.setprofile(self._profile_thread)
+
+   def _profile_thread(self, *args):
+      """
+      Profile the current thread, called by the first profiling event of
+      each new thread
+      """
+      import cProfile
+      sys.setprofile(None)
+      profile = cProfile.Profile()
+      with self._lock:
+         self._profiles.append(profile)
+      profile.enable()
+
+   def _now(self):
+      """
+      :return: microseconds since the profiler creation
+      :rtype: float
+      """
+      return (time.perf_counter() - self._origin) * 1000000
+
+   @contextlib.contextmanager
+   def span(self, name, category='phase', **args):
+      """
+      Measure a block as a complete trace event of the current thread. The
+      yielded dict holds the event arguments, the block can add results
+      to them (HTTP status, bytes...).
+
+      :type name: str
+      :param category: event category, to filter events in the trace viewer
+      :type category: str
+      """
+      if not self.enabled:
+         yield args
+         return
+      start = self._now()
+      try:
+         yield args
+      finally:
+         self.add(name, category, start, self._now() - start, args)
+
+   def add(self, name, category, start, duration, args=None):
+      """
+      Add a complete trace event of the current thread
+
+      :type name: str
+      :type category: str
+      :param start: microseconds since the profiler creation
+      :type start: float
+      :param duration: microseconds
+      :type duration: float
+      :type args: dict
+      """
+      if self.trace_file is None:
+         return
+      thread = threading.current_thread()
+      event = {'name': name, 'cat': category, 'ph': 'X', 'ts': round(start, 1), 'dur': round(duration, 1),
+               'pid': os.getpid(), 'tid': thread.ident, 'args': args or {}}
+      memory = None
+      if self.memory:
+         import tracemalloc
+         memory = {'name': 'python memory', 'ph': 'C', 'ts': event['ts'] + event['dur'], 'pid': event['pid'],
+                   'args': {'traced MB': round(tracemalloc.get_traced_memory()[0] / (1024.0 * 1024), 3)}}
+      with self._lock:
+         self._threads.setdefault(thread.ident, thread.name)
+         self.events.append(event)
+         if memory is not None:
+            self.events.append(memory)
+
+   def finish(self):
+      """
+      Stop profiling and write the requested outputs. Worker threads must be
+      stopped beforehand.
+      """
+      if not self.enabled:
+         return
+      other = {'version': __version__, 'argv': sys.argv[1:]}
+
+      if self._profiles:
+         import pstats
+         threading.setprofile(None)
+         for profile in self._profiles:
+            profile.disable()
+         stats = pstats.Stats(*self._profiles)
+         try:
+            stats.dump_stats(self.cpu_file)
+         except (IOError, OSError) as e:
+            self.logger.error('Could not write CPU profile to %s: %s' % (self.cpu_file, e))
+         top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:10]
+         other['cpu_top_cumulative'] = [{'function': '%s:%d(%s)' % key, 'calls': value[1],
+                                         'cumulative_s': round(value[3], 3)} for key, value in top]
+         self._profiles = []
+
+      if self.memory:
+         import tracemalloc
+         current, peak = tracemalloc.get_traced_memory()
+         top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+         tracemalloc.stop()
+         other['memory_peak_mb'] = round(peak / (1024.0 * 1024), 3)
+         other['memory_top_allocations'] = [{'line': str(stat.traceback), 'size_kb': round(stat.size / 1024.0, 1),
+                                             'count': stat.count} for stat in top]
+         self.logger.info('Python memory peak: %.1f MB' % other['memory_peak_mb'])
+
+      if self.trace_file is not None:
+         events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                   for tid, name in self._threads.items()]
+         try:
+            with open(self.trace_file, 'w') as f:
+               json.dump({'traceEvents': events + self.events, 'displayTimeUnit': 'ms', 'otherData': other}, f)
+            self.logger.info('Profiling trace written to %s' % self.trace_file)
+         except (IOError, OSError) as e:
+            self.logger.error('Could not write profiling trace to %s: %s' % (self.trace_file, e))
+
+
+class Manifest:
+   __slots__ = ('_dirs', '_dir_col', '_names', '_offsets', '_sizes', '_locations', '_location_col')
+
+   def __init__(self, entries=()):
+      """
+      Files of a snapshot with their size and location, sorted by path.
+      Manifests of large nodes hold millions of files and many of them are
+      kept in memory at once, so entries are stored in columns: directories
+      and locations are stored once and referenced by index, file names are
+      packed in a single buffer, numbers are arrays. An entry takes a few
+      tens of bytes instead of hundreds for a dict of strings, and union or
+      difference of sorted manifests are merges.
+
+      :param entries: iterable of (path, size, location), size None if
+                      unknown and location '' if none. The last entry of a
+                      duplicated path is kept.
+      """
+      entries = list(entries)
+      if any(a[0] >= b[0] for a, b in zip(entries, entries[1:])):
+         entries.sort(key=lambda e: e[0])
+
+      self._dirs = []
+      self._locations = ['']
+      dir_ids = {}
+      location_ids = {'': 0}
+      dir_col, names, offsets, sizes, location_col = [], [], [0], [], []
+      length = 0
+      last = len(entries) - 1
+      for i, (path, size, location) in enumerate(entries):
+         if i < last and entries[i + 1][0] == path:
+            continue
+         directory, _, name = path.rpartition('/')
+         dir_id = dir_ids.get(directory)
+         if dir_id is None:
+            dir_id = dir_ids[directory] = len(self._dirs)
+            self._dirs.append(directory)
+         location_id = location_ids.get(location)
+         if location_id is None:
+            location_id = location_ids[location] = len(self._locations)
+            self._locations.append(location)
+         names.append(name)
+         length += len(name)
+         dir_col.append(dir_id)
+         offsets.append(length)
+         sizes.append(-1 if size is None else size)
+         location_col.append(location_id)
+      # An ASCII str takes a byte per character
+      self._names = ''.join(names)
+      self._dir_col = array.array('I', dir_col)
+      self._offsets = array.array('L', offsets)
+      self._sizes = array.array('q', sizes)
+      self._location_col = array.array('I', location_col)
+
+   def __len__(self):
+      return len(self._sizes)
+
+   def _path(self, i):
+      name = self._names[self._offsets[i]:self._offsets[i + 1]]
+      directory = self._dirs[self._dir_col[i]]
+      return directory + '/' + name if directory else name
+
+   def _entry(self, i):
+      size = self._sizes[i]
+      return (None if size < 0 else size, self._locations[self._location_col[i]])
+
+   def _find(self, path):
+      """
+      Binary search of a path
+
+      :return: entry index, -1 if missing
+      :rtype: int
+      """
+      low, high = 0, len(self)
+      while low < high:
+         middle = (low + high) // 2
+         if self._path(middle) < path:
+            low = middle + 1
+         else:
+            high = middle
+      return low if low < len(self) and self._path(low) == path else -1
+
+   def __iter__(self):
+      names, offsets = self._names, self._offsets
+      prefixes = [d + '/' if d else '' for d in self._dirs]
+      start = 0
+      for dir_id, end in zip(self._dir_col, itertools.islice(offsets, 1, None)):
+         yield prefixes[dir_id] + names[start:end]
+         start = end
+
+   def __contains__(self, path):
+      return self._find(path) >= 0
+
+   def __getitem__(self, path):
+      i = self._find(path)
+      if i < 0:
+         raise KeyError(path)
+      return self._entry(i)
+
+   def get(self, path, default=None):
+      i = self._find(path)
+      return self._entry(i) if i >= 0 else default
+
+   def items(self):
+      """
+      :return: iterator of (path, (size, location)) sorted by path
+      """
+      locations = self._locations
+      for path, size, location_id in zip(self, self._sizes, self._location_col):
+         yield path, (None if size < 0 else size, locations[location_id])
+
+   def dirs(self):
+      """
+      :return: directories of the files
+      :rtype: set
+      """
+      return set(self._dirs)
+
+   def size(self):
+      """
+      :return: total size of the files of known size
+      :rtype: int
+      """
+      return sum(size for size in self._sizes if size > 0)
+
+   def difference(self, other):
+      """
+      :return: entries whose path is not in another manifest
+      :rtype: Manifest
+      """
+      def entries():
+         others = iter(other)
+         current = next(others, None)
+         for path, (size, location) in self.items():
+            while current is not None and current < path:
+               current = next(others, None)
+            if current != path:
+               yield path, size, location
+      return Manifest(entries())
+
+   @staticmethod
+   def union(manifests):
+      """
+      :param manifests: list of manifests, the first one holding a path gives its entry
+      :type manifests: list
+      :rtype: Manifest
+      """
+      def ranked(rank, manifest):
+         # (path, rank) is unique, entries are never compared: sizes may be None
+         for path, entry in manifest.items():
+            yield path, rank, entry
+
+      def entries():
+         last = None
+         streams = [ranked(rank, m) for rank, m in enumerate(manifests)]
+         for path, rank, (size, location) in heapq.merge(*streams):
+            if path != last:
+               last = path
+               yield path, size, location
+      return Manifest(entries())
+
+   def objects(self):
+      """
+      Get the Hadoop objects holding the files: the files stored alone, and
+      the bundles and their index for packed files
+
+      :rtype: Manifest
+      """
+      def entries():
+         locations = set()
+         for path, (size, location) in self.items():
+            if not location:
+               yield path, size, ''
+            elif location not in locations:
+               locations.add(location)
+         for location in locations:
+            yield location, None, ''
+            yield location + '.idx', None, ''
+      return Manifest(entries())
+
+
+class ManifestCache:
+   def __init__(self, max_files=2000000):
+      """
+      Least recently used manifests, up to a total number of files. Metadata
+      files of past days are kept for the next runs of a long-running
+      process, without growing with the history of the cluster.
+
+      :param max_files: maximum number of files of the cached manifests
+      :type max_files: int
+      """
+      self.max_files = max_files
+      self.files = 0
+      self._manifests = collections.OrderedDict()
+      self._lock = threading.Lock()
+
+   def get(self, path):
+      """
+      :return: the cached manifest of a metadata file, None if not cached
+      :rtype: Manifest
+      """
+      with self._lock:
+         manifest = self._manifests.get(path)
+         if manifest is not None:
+            self._manifests.move_to_end(path)
+         return manifest
+
+   def put(self, path, manifest):
+      """
+      Cache the manifest of a metadata file, dropping the least recently
+      used ones beyond max_files
+      """
+      with self._lock:
+         self._pop(path)
+         if len(manifest) > self.max_files:
+            return
+         self._manifests[path] = manifest
+         self.files += len(manifest)
+         while self.files > self.max_files:
+            self._pop(next(iter(self._manifests)))
+
+   def pop(self, path):
+      """
+      Forget the manifest of a deleted metadata file
+      """
+      with self._lock:
+         self._pop(path)
+
+   def _pop(self, path):
+      manifest = self._manifests.pop(path, None)
+      if manifest is not None:
+         self.files -= len(manifest)
+
+
+class TarBundle:
+   BLOCK_SIZE = 512
+
+   def __init__(self, members):
+      """
+      Tar archive streamed from local files, without writing it on disk.
+      Member offsets are known before streaming, so the sidecar index can be
+      built up front and a member can be read back with a range request.
+
+      :param members: list of (member name, local path, size)
+      :type members: list
+      """
+      self.members = []
+      self.index = {}
+      offset = 0
+      for name, path, size in members:
+         info = tarfile.TarInfo(name)
+         info.size = size
+         info.mode = 0o644
+         info.mtime = int(os.path.getmtime(path))
+         header = info.tobuf(format=tarfile.GNU_FORMAT)
+         self.index[name] = [offset + len(header), size]
+         self.members.append((header, path, size))
+         offset += len(header) + size + (-size % self.BLOCK_SIZE)
+      # End of archive marker
+      self.size = offset + 2 * self.BLOCK_SIZE
+
+   def open(self):
+      """
+      Get a file-like object streaming the archive
+
+      :rtype: TarBundleReader
+      """
+      return TarBundleReader(self)
+
+
+class TarBundleReader:
+   def __init__(self, bundle):
+      """
+      File-like object reading a TarBundle. Its length is known, so HTTP
+      uploads send a Content-Length instead of a chunked body.
+
+      :type bundle: TarBundle
+      """
+      self.bundle = bundle
+      self._chunks = self._generate()
+      self._chunk = b''
+      self._pos = 0
+      self._done = False
+
+   def __len__(self):
+      return self.bundle.size
+
+   def _generate(self):
+      for header, path, size in self.bundle.members:
+         yield header
+         remaining = size
+         with open(path, 'rb') as f:
+            while remaining > 0:
+               data = f.read(min(65536, remaining))
+               if not data:
+                  raise IOError('%s is shorter than expected' % path)
+               remaining -= len(data)
+               yield data
+         yield b'\0' * (-size % TarBundle.BLOCK_SIZE)
+      yield b'\0' * (2 * TarBundle.BLOCK_SIZE)
+
+   def read(self, size=-1):
+      parts = []
+      while size != 0 and not self._done:
+         if self._pos >= len(self._chunk):
+            self._chunk = next(self._chunks, None)
+            self._pos = 0
+            if self._chunk is None:
+               self._chunk = b''
+               self._done = True
+            continue
+         end = len(self._chunk) if size < 0 else min(len(self._chunk), self._pos + size)
+         parts.append(self._chunk[self._pos:end])
+         if size > 0:
+            size -= end - self._pos
+         self._pos = end
+      return b''.join(parts)
+
+
+class UploadScheduler:
+   def __init__(self, workers=8, disk_readers=2, executor=None, logger=__name__):
+      """
+      Run upload tasks largest first (LPT), so the biggest files do not end
+      up as a long tail. Each disk has its own queue and a worker takes the
+      largest pending task of any disk not already read by disk_readers
+      uploads, so idle workers steal work from the busiest disks.
+
+      :param workers: number of concurrent uploads
+      :type workers: int
+      :param disk_readers: number of concurrent uploads reading from a same
+                           physical disk
+      :type disk_readers: int
+      :param executor: thread pool of at least workers threads to run on,
+                       a temporary one is used if None
+      :type executor: ThreadPoolExecutor
+      :type logger: str
+      """
+      self.workers = workers
+      self.disk_readers = disk_readers
+      self.executor = executor
+      self.logger = logging.getLogger(logger)
+
+   def run(self, tasks, on_done=None):
+      """
+      Run tasks and wait for their completion
+
+      :param tasks: list of (disk, size in bytes, callable)
+      :type tasks: list
+      :param on_done: callable run by the worker threads with the index and
+                      the result of each task once done
+      :return: results in the tasks order
+      :rtype: list
+      """
+      queues = {}
+      for idx, (disk, size, task) in enumerate(tasks):
+         queues.setdefault(disk, []).append((size, idx))
+      # Smallest first, so pop() gives the largest task of a disk
+      for disk_queue in queues.values():
+         disk_queue.sort()
+      active = dict.fromkeys(queues, 0)
+      condition = threading.Condition()
+      results = [None] * len(tasks)
+
+      def take():
+         with condition:
+            while True:
+               candidates = [disk for disk, disk_queue in queues.items()
+                             if disk_queue and active[disk] < self.disk_readers]
+               if candidates:
+                  disk = max(candidates, key=lambda d: queues[d][-1])
+                  active[disk] += 1
+                  return disk, queues[disk].pop()[1]
+               if not any(queues.values()):
+                  return None, None
+               condition.wait()
+
+      def work():
+         while True:
+            disk, idx = take()
+            if idx is None:
+               return
+            try:
+               results[idx] = tasks[idx][2]()
+            finally:
+               with condition:
+                  active[disk] -= 1
+                  condition.notify_all()
+            if on_done is not None:
+               on_done(idx, results[idx])
+
+      workers = max(1, min(self.workers, self.disk_readers * len(queues), len(tasks)))
+      self.logger.debug("Scheduling %d uploads on %d disk(s) with %d worker(s)" % (len(tasks), len(queues), workers))
+      if self.executor is not None:
+         for future in [self.executor.submit(work) for _ in range(workers)]:
+            future.result()
+         return results
+      with ThreadPoolExecutor(max_workers=workers) as pool:
+         for future in [pool.submit(work) for _ in range(workers)]:
+            future.result()
+      return results
+
+
+class BackupWatcher:
+   IN_CLOSE_WRITE = 0x8
+   IN_MOVED_TO = 0x80
+   IN_CREATE = 0x100
+
+   def __init__(self, logger=__name__):
+      """
+      Wait for new files in Cassandra backups directories with inotify, or
+      with a plain timeout when inotify is not available: the caller scans
+      the directories after each wait anyway.
+
+      :type logger: str
+      """
+      self.logger = logging.getLogger(logger)
+      self.fd = None
+      self._libc = None
+      try:
+         libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+         fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+         if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+         self._libc = libc
+         self.fd = fd
+      except (OSError, AttributeError, TypeError) as e:
+         self.logger.info('inotify is not available (%s), polling backups directories' % e)
+
+   def watch(self, path):
+      """
+      Watch a directory, watching it again is a no-op
+
+      :type path: str
+      """
+      if self.fd is None:
+         return
+      wd = self._libc.inotify_add_watch(self.fd, path.encode('utf-8'),
+                                        self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+      if wd < 0:
+         self.logger.debug('Could not watch %s: %s' % (path, os.strerror(ctypes.get_errno())))
+
+   def wait(self, timeout):
+      """
+      Wait for a change in a watched directory
+
+      :param timeout: seconds
+      :type timeout: float
+      :return: True if a change happened before the timeout
+      :rtype: bool
+      """
+      if self.fd is None:
+         time.sleep(timeout)
+         return False
+      readable, _, _ = select.select([self.fd], [], [], timeout)
+      if not readable:
+         return False
+      try:
+         while os.read(self.fd, 65536):
+            pass
+      except OSError:
+         pass
+      return True
+
+   def close(self):
+      if self.fd is not None:
+         os.close(self.fd)
+         self.fd = None
+
+
+class CronSchedule:
+   # Ranges of minutes, hours, days of month, months and days of week (0 and 7 are Sunday)
+   FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+   ALIASES = {'@hourly': '0 * * * *', '@daily': '0 0 * * *', '@weekly': '0 0 * * 0', '@monthly': '0 0 1 * *'}
+
+   def __init__(self, expression):
+      """
+      Cron-like schedule: 'minute hour day-of-month month day-of-week', each
+      field accepting *, lists, ranges and steps (*/15, 1-5, 0,30)
+
+      :type expression: str
+      """
+      self.expression = expression.strip()
+      fields = self.ALIASES.get(self.expression, self.expression).split()
+      if len(fields) != 5:
+         raise ValueError('Invalid cron expression: %s' % expression)
+      self.minutes, self.hours, self.days, self.months, self.weekdays = [
+         self._parse(field, low, high) for field, (low, high) in zip(fields, self.FIELDS)]
+      self.weekdays = set(day % 7 for day in self.weekdays)
+      self.any_day = fields[2] == '*'
+      self.any_weekday = fields[4] == '*'
+
+   @staticmethod
+   def _parse(field, low, high):
+      values = set()
+      for part in field.split(','):
+         step = 1
+         if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+         if part == '*':
+            start, end = low, high
+         elif '-' in part:
+            start, end = [int(v) for v in part.split('-', 1)]
+         else:
+            start = int(part)
+            end = high if step > 1 else start
+         if start < low or end > high or start > end or step < 1:
+            raise ValueError('Invalid cron field: %s' % field)
+         values.update(range(start, end + 1, step))
+      return values
+
+   def _day_matches(self, t):
+      day = t.day in self.days
+      weekday = (t.weekday() + 1) % 7 in self.weekdays
+      # Like cron, restricted days of month and days of week are alternatives
+      if not self.any_day and not self.any_weekday:
+         return day or weekday
+      return day and weekday
+
+   def next_run(self, after):
+      """
+      Get the next run time strictly after a time
+
+      :param after: timestamp
+      :type after: float
+      :rtype: float
+      """
+      t = datetime.datetime.fromtimestamp(after).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+      limit = t + datetime.timedelta(days=366 * 5)
+      while t < limit:
+         if t.month not in self.months:
+            t = (t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+         elif not self._day_matches(t):
+            t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+         elif t.hour not in self.hours:
+            t = t.replace(minute=0) + datetime.timedelta(hours=1)
+         elif t.minute not in self.minutes:
+            t += datetime.timedelta(minutes=1)
+         else:
+            return time.mktime(t.timetuple())
+      raise ValueError('Cron expression never matches: %s' % self.expression)
+
+
+class Daemon:
+   def __init__(self, operation, jobs, socket_path=None, logger=__name__):
+      """
+      Long-running process running jobs on a schedule with the same
+      ManageSnapshot, so HTTP sessions, Kerberos contexts and metadata caches
+      stay warm between runs. Jobs run one at a time. A UNIX socket accepts
+      one command per connection: 'status', 'run <job>' or 'stop', and
+      answers with a JSON line.
+
+      :param operation: operation running the jobs
+      :type operation: ManageSnapshot
+      :param jobs: dict of job name -> (CronSchedule or None, callable)
+      :type jobs: dict
+      :param socket_path: path of the control socket, None to disable it
+      :type socket_path: str
+      :type logger: str
+      """
+      self.operation = operation
+      self.jobs = jobs
+      self.socket_path = socket_path
+      self.logger = logging.getLogger(logger)
+      self.queue = queue.Queue()
+      self.state = dict((name, {'schedule': schedule.expression if schedule else None, 'next_run': None,
+                                'last_start': None, 'last_duration': None, 'last_result': None, 'runs': 0,
+                                'running': False, 'queued': False})
+                        for name, (schedule, job) in jobs.items())
+      self._server = None
+      # Jobs are queued from the scheduler and the control socket threads
+      self._lock = threading.Lock()
+
+   def trigger(self, name):
+      """
+      Queue a job to run as soon as possible
+
+      :type name: str
+      :return: False if the job does not exist
+      :rtype: bool
+      """
+      if name not in self.jobs:
+         return False
+      with self._lock:
+         if not self.state[name]['queued']:
+            self.state[name]['queued'] = True
+            self.queue.put(name)
+      return True
+
+   def stop(self):
+      self.operation.stopping.set()
+      self.queue.put(None)
+
+   def command(self, line):
+      """
+      Run a control command
+
+      :type line: str
+      :rtype: dict
+      """
+      words = line.split()
+      if words == ['status']:
+         return {'ok': True, 'jobs': self.state}
+      if len(words) == 2 and words[0] == 'run':
+         if self.trigger(words[1]):
+            return {'ok': True, 'queued': words[1]}
+         return {'ok': False, 'error': 'Unknown job %s' % words[1]}
+      if words == ['stop']:
+         self.stop()
+         return {'ok': True}
+      return {'ok': False, 'error': 'Unknown command: %s' % line.strip()}
+
+   def _start_server(self):
+      daemon = self
+
+      class Handler(socketserver.StreamRequestHandler):
+         def handle(self):
+            line = self.rfile.readline().decode('utf-8', 'replace')
+            self.wfile.write((json.dumps(daemon.command(line), sort_keys=True) + '\n').encode('utf-8'))
+
+      class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+         daemon_threads = True
+
+      if os.path.exists(self.socket_path):
+         # Only a socket left by a dead daemon is replaced
+         probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+         try:
+            probe.connect(self.socket_path)
+         except socket.error:
+            self.logger.info('Removing stale control socket %s' % self.socket_path)
+            os.remove(self.socket_path)
+         else:
+            self.logger.critical('A daemon is already listening on %s' % self.socket_path)
+            raise OperationError('Daemon already running')
+         finally:
+            probe.close()
+      self._server = Server(self.socket_path, Handler)
+      os.chmod(self.socket_path, 0o600)
+      thread = threading.Thread(target=self._server.serve_forever)
+      thread.daemon = True
+      thread.start()
+      self.logger.info('Listening for commands on %s' % self.socket_path)
+
+   def _run_job(self, name):
+      state = self.state[name]
+      with self._lock:
+         state['queued'] = False
+      state['running'] = True
+      state['last_start'] = time.time()
+      self.logger.info('Starting job %s' % name)
+      try:
+         result = self.jobs[name][1]()
+         state['last_result'] = 'failed' if result is False else 'ok'
+      except (OperationError, SystemExit):
+         # Already logged where it happened
+         state['last_result'] = 'failed'
+      except Exception as e:
+         self.logger.exception('Job %s failed: %s' % (name, e))
+         state['last_result'] = 'error: %s' % e
+      finally:
+         state['running'] = False
+         state['runs'] += 1
+         state['last_duration'] = round(time.time() - state['last_start'], 3)
+      self.logger.info('Job %s done in %.1fs: %s' % (name, state['last_duration'], state['last_result']))
+
+   def run(self):
+      """
+      Run jobs until stopped
+      """
+      if self.socket_path:
+         self._start_server()
+      now = time.time()
+      for name, (schedule, job) in self.jobs.items():
+         if schedule is not None:
+            self.state[name]['next_run'] = schedule.next_run(now)
+
+      try:
+         while not self.operation.stopping.is_set():
+            now = time.time()
+            for name, (schedule, job) in sorted(self.jobs.items()):
+               if schedule is not None and self.state[name]['next_run'] <= now:
+                  self.trigger(name)
+                  self.state[name]['next_run'] = schedule.next_run(now)
+
+            next_runs = [s['next_run'] for s in self.state.values() if s['next_run'] is not None]
+            timeout = min(next_runs) - time.time() if next_runs else 60
+            try:
+               # Signal handlers only set stopping, wake up regularly to check it
+               name = self.queue.get(timeout=min(5, max(0.1, timeout)))
+            except queue.Empty:
+               continue
+            if name is not None:
+               self._run_job(name)
+      finally:
+         if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            os.remove(self.socket_path)
+
+
+def control(socket_path, command):
+   """
+   Send a command to a running daemon
+
+   :param socket_path: path of the daemon control socket
+   :type socket_path: str
+   :type command: str
+   :return: the daemon answer
+   :rtype: dict
+   """
+   client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+   try:
+      client.connect(socket_path)
+      client.sendall((command + '\n').encode('utf-8'))
+      answer = b''
+      while not answer.endswith(b'\n'):
+         data = client.recv(65536)
+         if not data:
+            break
+         answer += data
+   finally:
+      client.close()
+   return json.loads(answer.decode('utf-8'))
+
+
+class Coordinator:
+   def __init__(self, max_uploads=4, lease_ttl=600, stagger_window=0, timeout=3600, poll_interval=30,
+                replica_dedup=False, logger=__name__):
+      """
+      Coordinate the nodes of a cluster backing up to the same Hadoop
+      cluster. Uploads need one of max_uploads lease files under
+      cass_snap_metadata/<cluster>/_coordination: a lease is taken by
+      creating its file without overwrite, renewed while uploading and
+      deleted at the end. Leases of crashed nodes expire after lease_ttl.
+      Nodes also start in their own time slot of the stagger window, from a
+      hash of their name.
+
+      :param max_uploads: maximum number of nodes uploading at once, 0 for
+                          no limit
+      :type max_uploads: int
+      :param lease_ttl: seconds before a lease which is not renewed expires
+      :type lease_ttl: int
+      :param stagger_window: seconds over which node start times are spread
+      :type stagger_window: int
+      :param timeout: maximum seconds waiting for a lease
+      :type timeout: int
+      :param poll_interval: mean seconds between two attempts to take a lease
+      :type poll_interval: int
+      :param replica_dedup: only back up keyspaces for which the node is
+                            elected to hold a copy of some token ranges
+      :type replica_dedup: bool
+      :type logger: str
+      """
+      self.max_uploads = max_uploads
+      self.lease_ttl = lease_ttl
+      self.stagger_window = stagger_window
+      self.timeout = timeout
+      self.poll_interval = poll_interval
+      self.replica_dedup = replica_dedup
+      self.logger = logging.getLogger(logger)
+      self.lease = None
+      self.lost = False
+
+   def _lease_path(self, operation, slot):
+      return '/'.join([operation.meta_dir, operation.cluster_name, '_coordination', 'upload_%d' % slot])
+
+   def _read_lease(self, operation, slot, path=None):
+      """
+      Read a lease file
+
+      :param path: lease file path, the slot lease file if None
+      :return: lease content, an empty dict if it is corrupted, None if it
+               does not exist or could not be read
+      :rtype: dict
+      """
+      try:
+         content = operation.storage.get(path if path is not None else self._lease_path(operation, slot))
+      except StorageError as e:
+         self.logger.debug('Could not read lease %d: %s' % (slot, e))
+         return None
+      if content is None:
+         return None
+      try:
+         return json.loads(content.decode('utf-8'))
+      except ValueError:
+         return {}
+
+   def _move_lease(self, operation, source, destination):
+      """
+      Rename a lease file, a rename succeeds for only one node
+
+      :rtype: bool
+      """
+      try:
+         return operation.storage.rename(source, destination)
+      except StorageError as e:
+         self.logger.debug('Could not rename lease %s: %s' % (source, e))
+         return False
+
+   def _write_lease(self, operation, slot, overwrite):
+      now = time.time()
+      content = json.dumps({'node': operation.hostname, 'acquired': now, 'expires': now + self.lease_ttl})
+      try:
+         return operation.storage.put(self._lease_path(operation, slot), lambda: io.BytesIO(content.encode('utf-8')),
+                                      overwrite)
+      except StorageError as e:
+         self.logger.debug('Could not write lease %d: %s' % (slot, e))
+         return False
+
+   def _try_slot(self, operation, slot):
+      """
+      Try to take a lease, taking over an expired one. The expired lease is
+      renamed first so that only one of the nodes seeing it expired takes
+      it over.
+
+      :rtype: bool
+      """
+      if self._write_lease(operation, slot, False):
+         return True
+      lease = self._read_lease(operation, slot)
+      if lease is None or lease.get('expires', 0) > time.time():
+         return False
+
+      path = self._lease_path(operation, slot)
+      expired = '%s.expired.%s.%d' % (path, operation.hostname, time.time() * 1000)
+      if not self._move_lease(operation, path, expired):
+         return False
+      moved = self._read_lease(operation, slot, expired)
+      if moved is not None and moved.get('expires', 0) > time.time():
+         # Another node renewed or took over the lease meanwhile, give it back
+         self._move_lease(operation, expired, path)
+         return False
+      operation._delete_file_in_hadoop(expired)
+      self.logger.warning('Lease %d of %s expired, taking it over' % (slot, lease.get('node')))
+      return self._write_lease(operation, slot, False)
+
+   def acquire(self, operation):
+      """
+      Wait for an upload lease
+
+      :type operation: ManageSnapshot
+      :return: True once a lease is held, False on timeout
+      :rtype: bool
+      """
+      deadline = time.time() + self.timeout
+      operation._hadoop_create_folders(['/'.join([operation.meta_dir, operation.cluster_name, '_coordination'])])
+      while not operation.stopping.is_set():
+         for slot in random.sample(range(self.max_uploads), self.max_uploads):
+            if self._try_slot(operation, slot):
+               self.lease = slot
+               self.lost = False
+               self.logger.info('Upload lease %d taken' % slot)
+               return True
+         if time.time() >= deadline:
+            break
+         wait = min(random.uniform(0.5, 1.5) * self.poll_interval, max(0, deadline - time.time()))
+         self.logger.info('All %d upload leases are taken, waiting %.0fs' % (self.max_uploads, wait))
+         operation.stopping.wait(wait)
+      return False
+
+   def renew(self, operation):
+      """
+      Extend the held lease, only rewritten when it is read back as held by
+      this node. When another node took it over, or it can't be read (it
+      may be missing during a takeover), a lease is taken again through a
+      creation without overwrite, or lost is set and uploads stop.
+      """
+      if self.lost:
+         return
+      lease = self._read_lease(operation, self.lease)
+      if lease is not None and lease.get('node') == operation.hostname:
+         self._write_lease(operation, self.lease, True)
+         return
+
+      if lease is None:
+         self.logger.error('Upload lease %d could not be read' % self.lease)
+      else:
+         self.logger.error('Upload lease %d was taken over by %s' % (self.lease, lease.get('node')))
+      for slot in random.sample(range(self.max_uploads), self.max_uploads):
+         if self._try_slot(operation, slot):
+            self.logger.warning('Upload lease %d taken again' % slot)
+            self.lease = slot
+            return
+      self.logger.error('No upload lease left, stopping uploads')
+      self.lost = True
+
+   def release(self, operation):
+      """
+      Give the held lease back
+      """
+      if self.lease is None:
+         return
+      lease = self._read_lease(operation, self.lease)
+      if lease is not None and lease.get('node') == operation.hostname:
+         operation._delete_file_in_hadoop(self._lease_path(operation, self.lease))
+      self.logger.info('Upload lease %d released' % self.lease)
+      self.lease = None
+
+   @contextlib.contextmanager
+   def upload_slot(self, operation):
+      """
+      Hold an upload lease, renewed in background, for the block duration
+
+      :type operation: ManageSnapshot
+      :return: True if the lease was granted
+      """
+      if not self.max_uploads:
+         yield True
+         return
+      if not self.acquire(operation):
+         yield False
+         return
+      done = threading.Event()
+
+      def keep_alive():
+         while not done.wait(self.lease_ttl / 3.0):
+            self.renew(operation)
+
+      thread = threading.Thread(target=keep_alive)
+      thread.daemon = True
+      thread.start()
+      try:
+         yield True
+      finally:
+         done.set()
+         thread.join()
+         self.release(operation)
+
+   def stagger(self, operation):
+      """
+      Wait for the time slot of the node in the stagger window
+      """
+      if not self.stagger_window:
+         return
+      key = '/'.join([operation.cluster_name, operation.hostname]).encode('utf-8')
+      offset = int(hashlib.md5(key).hexdigest(), 16) % self.stagger_window
+      self.logger.info('Waiting %ds for the time slot of this node' % offset)
+      operation.stopping.wait(offset)
+
+   @staticmethod
+   def elect_replicas(ranges):
+      """
+      Elect the nodes backing up a keyspace: each token range needs one of
+      its replicas elected, nodes holding most of the remaining ranges are
+      elected first. Every node computes the same election from the same
+      ring.
+
+      :param ranges: list of replica endpoints lists, one per token range
+      :type ranges: list
+      :rtype: set
+      """
+      uncovered = [set(endpoints) for endpoints in ranges if endpoints]
+      elected = set()
+      while uncovered:
+         counts = {}
+         for endpoints in uncovered:
+            for endpoint in endpoints:
+               counts[endpoint] = counts.get(endpoint, 0) + 1
+         best = min(counts, key=lambda e: (-counts[e], e))
+         elected.add(best)
+         uncovered = [endpoints for endpoints in uncovered if best not in endpoints]
+      return elected
+
+
+class RetentionPolicy:
+   def __init__(self, keep_daily=None, keep_weekly=None, keep_monthly=None, max_age=None, scope='node'):
+      """
+      Define which snapshots have to be kept on Hadoop. Count rules keep the
+      most recent snapshot of each of the last N days, weeks or months, a
+      snapshot is kept as soon as one rule selects it. Without count rules,
+      all snapshots are candidates. The max age (in days) then expires any
+      snapshot older than it. The latest snapshot of a node is never expired.
+
+      :type keep_daily: int
+      :type keep_weekly: int
+      :type keep_monthly: int
+      :type max_age: int
+      :param scope: 'node' to apply rules on each node history, 'cluster' to
+                    apply them on the dates of the whole cluster
+      :type scope: str
+      """
+      self.keep_daily = keep_daily
+      self.keep_weekly = keep_weekly
+      self.keep_monthly = keep_monthly
+      self.max_age = max_age
+      self.scope = scope
+
+   def is_empty(self):
+      """
+      Check if the policy has at least one rule
+
+      :rtype: bool
+      """
+      return all(rule is None for rule in [self.keep_daily, self.keep_weekly, self.keep_monthly, self.max_age])
+
+   @staticmethod
+   def parse_date(date):
+      """
+      Convert a snapshot date (2015_10_01) to a date object
+
+      :type date: str
+      :rtype: datetime.date
+      """
+      try:
+         return datetime.datetime.strptime(date, '%Y_%m_%d').date()
+      except ValueError:
+         return None
+
+   def _keep_dates(self, dates, today):
+      """
+      Return the dates kept by the policy in a list of dates
+
+      :type dates: list
+      :type today: datetime.date
+      :rtype: set
+      """
+      dates = sorted(set(dates), reverse=True)
+      rules = [(self.keep_daily, lambda d: d),
+               (self.keep_weekly, lambda d: tuple(d.isocalendar()[:2])),
+               (self.keep_monthly, lambda d: (d.year, d.month))]
+
+      if all(count is None for count, _ in rules):
+         keep = set(dates)
+      else:
+         keep = set()
+         for count, bucket in rules:
+            if count is None:
+               continue
+            seen = set()
+            for d in dates:
+               if bucket(d) in seen:
+                  continue
+               if len(seen) >= count:
+                  break
+               seen.add(bucket(d))
+               keep.add(d)
+
+      if self.max_age is not None:
+         limit = today - datetime.timedelta(days=self.max_age)
+         keep = set(d for d in keep if d >= limit)
+
+      return keep
+
+   def select_expired(self, snapshots, today=None):
+      """
+      Return the snapshots to expire from a list of snapshots ({'node': x, 'date': y})
+
+      :type snapshots: list
+      :type today: datetime.date
+      :rtype: list
+      """
+      if today is None:
+         today = datetime.date.today()
+
+      # Group snapshots depending on the scope, unknown date formats are always kept
+      groups = {}
+      latest = {}
+      for snapshot in snapshots:
+         date = self.parse_date(snapshot['date'])
+         if date is None:
+            continue
+         key = snapshot['node'] if self.scope == 'node' else None
+         groups.setdefault(key, []).append(date)
+         if date > latest.get(snapshot['node'], datetime.date.min):
+            latest[snapshot['node']] = date
+
+      kept = dict((key, self._keep_dates(dates, today)) for key, dates in groups.items())
+
+      expired = []
+      for snapshot in snapshots:
+         date = self.parse_date(snapshot['date'])
+         if date is None or date == latest[snapshot['node']]:
+            continue
+         if date not in kept[snapshot['node'] if self.scope == 'node' else None]:
+            expired.append(snapshot)
+
+      return expired
+
+
+class OperationError(Exception):
+   """
+   An action can't go on. The command line exits with an error, the daemon
+   marks the job failed and keeps running.
+   """
+
+
+class StorageError(IOError):
+   """
+   A storage request failed or was refused
+   """
+
+
+class StorageBackend:
+   # Requests are accounted under the WebHDFS operation names on every backend
+   name = None
+
+   def __init__(self, metrics=None, logger=__name__):
+      """
+      Storage holding the snapshots. Paths are relative to the destination
+      folder and use '/' separators. Requests which fail raise StorageError.
+
+      :param metrics: metrics of the run, requests latencies are recorded in it
+      :type metrics: RunMetrics
+      :type logger: str
+      """
+      self.metrics = metrics if metrics is not None else RunMetrics(logger=logger)
+      self.logger = logging.getLogger(logger)
+
+   @contextlib.contextmanager
+   def _measure(self, op, path):
+      """
+      Account a request in the metrics and the profiling trace
+
+      :param op: operation name
+      :type op: str
+      :type path: str
+      """
+      start = time.time()
+      try:
+         with self.metrics.profiler.span(op, self.name, path=path) as span:
+            yield span
+      finally:
+         self.metrics.observe(op, time.time() - start)
+
+   def check(self):
+      """
+      Check that the storage can be reached with the current credentials
+      """
+      raise NotImplementedError
+
+   def put(self, path, data, overwrite=True):
+      """
+      Write a file, creating its missing parent folders
+
+      :type path: str
+      :param data: callable returning the content as a file object, called
+                   again when a write is retried
+      :param overwrite: replace an existing file
+      :type overwrite: bool
+      :return: False if the file exists and overwrite is False
+      :rtype: bool
+      """
+      raise NotImplementedError
+
+   def append(self, path, content):
+      """
+      Append content to a file, creating it if it does not exist. Backends
+      without appends rewrite the whole file.
+
+      :type path: str
+      :type content: bytes
+      """
+      current = self.get(path) or b''
+      self.put(path, lambda: io.BytesIO(current + content))
+
+   def get(self, path, offset=0, length=None):
+      """
+      Read a file, or a range of it
+
+      :type path: str
+      :type offset: int
+      :param length: bytes to read, None up to the end of the file
+      :type length: int
+      :return: content, None if the file does not exist
+      :rtype: bytes
+      """
+      raise NotImplementedError
+
+   def read(self, path, offset=0, length=None, chunk_size=1024 * 1024):
+      """
+      Stream a file, or a range of it, by chunks
+
+      :type path: str
+      :type offset: int
+      :param length: bytes to read, None up to the end of the file
+      :type length: int
+      :type chunk_size: int
+      :rtype: generator
+      """
+      raise NotImplementedError
+
+   def list(self, path):
+      """
+      List a folder
+
+      :type path: str
+      :return: dict of entry name -> {'type': 'FILE' or 'DIRECTORY', 'size',
+               'mtime' in ms}, None if the folder does not exist
+      :rtype: dict
+      """
+      raise NotImplementedError
+
+   def mkdirs(self, path):
+      """
+      Create a folder and its missing parents
+
+      :type path: str
+      """
+      raise NotImplementedError
+
+   def delete(self, path, recursive=False):
+      """
+      Delete a file, or a folder and all its content. Deleting a missing
+      path is not an error.
+
+      :type path: str
+      :type recursive: bool
+      """
+      raise NotImplementedError
+
+   def rename(self, source, destination):
+      """
+      Move a file, unless the destination exists
+
+      :type source: str
+      :type destination: str
+      :return: False if the source does not exist or the destination does
+      :rtype: bool
+      """
+      raise NotImplementedError
+
+   def checksum(self, path):
+      """
+      Get a checksum of a file computed by the storage, which fails if the
+      file can't be read back
+
+      :type path: str
+      :rtype: str
+      """
+      raise NotImplementedError
+
+
+class WebHdfsBackend(StorageBackend):
+   name = 'webhdfs'
+   HEADERS = {'content-type': 'application/octet-stream'}
+   TIMEOUT = (10, 120)
+
+   def __init__(self, url, dest_dir, retry_policy=None, metrics=None, transfer_monitor=None, timeout=None,
+                logger=__name__):
+      """
+      Hadoop cluster reached through WebHDFS, with Kerberos authentication
+
+      :param url: WebHDFS URL, like http://namenode:50070/webhdfs/v1
+      :type url: str
+      :param dest_dir: destination folder in HDFS
+      :type dest_dir: str
+      :param retry_policy: retry policy shared by all the requests
+      :type retry_policy: RetryPolicy
+      :type metrics: RunMetrics
+      :param transfer_monitor: throughput monitor of datanode writes
+      :type transfer_monitor: TransferMonitor
+      :param timeout: connect and read timeouts of the requests in seconds,
+                      the read one also bounds a stalled send
+      :type timeout: tuple
+      :type logger: str
+      """
+      super().__init__(metrics, logger)
+      self.url = url
+      self.dest_dir = dest_dir
+      self.timeout = timeout if timeout is not None else self.TIMEOUT
+      self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy(logger=logger)
+      self.transfer_monitor = transfer_monitor if transfer_monitor is not None else TransferMonitor(logger=logger)
+      self._local = threading.local()
+
+   def _url(self, path, op, **params):
+      """
+      Build the URL of an operation on a path of the destination folder
+
+      :type path: str
+      :type op: str
+      :rtype: str
+      """
+      return ''.join([self.url, self.dest_dir, '/', path, '?op=', op] +
+                     ['&%s=%s' % (k, v) for k, v in sorted(params.items())])
+
+   def _get_session(self):
+      """
+      Get the HTTP session of the current thread, created on its first
+      request. Sessions and Kerberos contexts are not shared between
+      threads, so each worker gets its own one.
+
+      :rtype: requests.Session
+      """
+      session = getattr(self._local, 'session', None)
+      if session is None:
+         from requests_kerberos import HTTPKerberosAuth, OPTIONAL
+         session = requests.Session()
+         session.auth = HTTPKerberosAuth(mutual_authentication=OPTIONAL)
+         self._local.session = session
+      return session
+
+   def _request(self, method, url, data=None, headers=None, stream=False):
+      """
+      Make a WebHDFS request following the retry policy. Operations sent to
+      a datanode (CREATE, APPEND, OPEN...) are made in two steps: the
+      namenode answers with a redirection, then the body is sent directly to
+      the datanode. Gateways answering 500 instead of redirecting get the
+      body on the same url. Writes far slower than usual are abandoned and
+      sent again to another datanode, slow datanodes being excluded from
+      the following redirections.
+
+      :param method: HTTP method
+      :type method: str
+      :param url: full URL to request to Hadoop cluster
+      :type url: str
+      :param data: callable returning the request body, called on each attempt
+      :param headers: headers sent with the body
+      :type headers: dict
+      :param stream: do not download the response content immediately
+      :type stream: bool
+      :rtype: requests.Response
+      """
+      session = self._get_session()
+      op = re.search(r'[?&]op=(\w+)', url, re.IGNORECASE)
+      op = op.group(1).upper() if op else method
+      attempts = [0]
+      profiler = self.metrics.profiler
+
+      def attempt():
+         attempts[0] += 1
+         if attempts[0] > 1:
+            self.metrics.retry(op)
+
+         request_url = url
+         if data is not None and self.transfer_monitor.slow_datanodes:
+            request_url += '&excludedatanodes=' + ','.join(sorted(self.transfer_monitor.slow_datanodes))
+
+         start = time.time()
+         with profiler.span(op, 'webhdfs', path=urllib3.util.parse_url(url).path, attempt=attempts[0]) as span:
+            try:
+               with profiler.span('namenode', 'http') as namenode:
+                  r = session.request(method, request_url, allow_redirects=False, timeout=self.timeout)
+                  # Kerberos negotiation answers 401 first
+                  namenode.update(status=r.status_code, auth_round_trips=len(r.history))
+               if r.is_redirect or (r.status_code == 500 and data is not None):
+                  target = r.headers['Location'] if r.is_redirect else r.url
+                  datanode = urllib3.util.parse_url(target).host
+                  body = data() if data is not None else None
+                  if body is not None:
+                     body = MonitoredBody(body, self.transfer_monitor, datanode)
+                  try:
+                     transfer_start = time.time()
+                     with profiler.span('datanode', 'http', host=datanode) as transfer:
+                        try:
+                           r = session.request(method, target, data=body, headers=headers, stream=stream,
+                                               timeout=self.timeout)
+                           transfer['status'] = r.status_code
+                           if not stream:
+                              transfer['bytes_received'] = len(r.content)
+                        finally:
+                           transfer['bytes_sent'] = body.sent if body is not None else 0
+                     if body is not None and r.status_code < 300:
+                        self.transfer_monitor.record(body.sent, time.time() - transfer_start)
+                  except (requests.exceptions.RequestException, SlowTransferError):
+                     # The HTTP stack may wrap the abandon in a connection error, a stalled send ends
+                     # with the read timeout
+                     if body is not None and body.check_slow():
+                        self.transfer_monitor.mark_slow(datanode)
+                        raise SlowTransferError('Write to %s abandoned after %d bytes' % (datanode, body.sent))
+                     raise
+                  finally:
+                     if hasattr(body, 'close'):
+                        body.close()
+               span['status'] = r.status_code
+               return r
+            finally:
+               self.metrics.observe(op, time.time() - start)
+
+      self.logger.debug('used url: %s' % url)
+      try:
+         return self.retry_policy.run(attempt, ' '.join([method, url]))
+      except (requests.exceptions.RequestException, SlowTransferError) as e:
+         raise StorageError(str(e))
+
+   def _fail(self, op, path, r):
+      raise StorageError('%s %s answered %d' % (op, path, r.status_code))
+
+   def check(self):
+      r = self._request('GET', '/'.join([self.url, '?op=GETHOMEDIRECTORY']))
+      if r.status_code != 200:
+         self._fail('GETHOMEDIRECTORY', '', r)
+
+   def put(self, path, data, overwrite=True):
+      r = self._request('PUT', self._url(path, 'CREATE', overwrite=str(overwrite).lower()), data=data,
+                        headers=self.HEADERS)
+      if r.status_code == 201:
+         return True
+      if not overwrite and r.status_code == 403 and 'FileAlreadyExistsException' in r.text:
+         return False
+      self._fail('CREATE', path, r)
+
+   def append(self, path, content):
+      r = self._request('POST', self._url(path, 'APPEND'), data=lambda: io.BytesIO(content), headers=self.HEADERS)
+      if r.status_code == 404:
+         r = self._request('PUT', self._url(path, 'CREATE', overwrite='false'), data=lambda: io.BytesIO(content),
+                           headers=self.HEADERS)
+      if r.status_code not in (200, 201):
+         self._fail('APPEND', path, r)
+
+   def _open_url(self, path, offset, length):
+      params = {}
+      if offset:
+         params['offset'] = offset
+      if length is not None:
+         params['length'] = length
+      return self._url(path, 'OPEN', **params)
+
+   def get(self, path, offset=0, length=None):
+      r = self._request('GET', self._open_url(path, offset, length))
+      if r.status_code == 404:
+         return None
+      if r.status_code != 200:
+         self._fail('OPEN', path, r)
+      return r.content
+
+   def read(self, path, offset=0, length=None, chunk_size=1024 * 1024):
+      r = self._request('GET', self._open_url(path, offset, length), stream=True)
+      if r.status_code != 200:
+         self._fail('OPEN', path, r)
+      try:
+         for chunk in r.iter_content(chunk_size=chunk_size):
+            yield chunk
+      except requests.exceptions.RequestException as e:
+         raise StorageError(str(e))
+
+   def list(self, path):
+      r = self._request('GET', self._url(path, 'LISTSTATUS'))
+      if r.status_code == 404:
+         return None
+      if r.status_code != 200:
+         self._fail('LISTSTATUS', path, r)
+      return dict((s['pathSuffix'], {'type': s['type'], 'size': s['length'], 'mtime': s['modificationTime']})
+                  for s in r.json()['FileStatuses']['FileStatus'])
+
+   def mkdirs(self, path):
+      # Todo: rajouter une option pour les permissions
+      r = self._request('PUT', self._url(path, 'MKDIRS'))
+      if r.status_code != 200:
+         self._fail('MKDIRS', path, r)
+
+   def delete(self, path, recursive=False):
+      # A missing file answers 200 with a false boolean, it is already deleted
+      r = self._request('DELETE', self._url(path, 'DELETE', **({'recursive': 'true'} if recursive else {})))
+      if r.status_code != 200:
+         self._fail('DELETE', path, r)
+
+   def rename(self, source, destination):
+      r = self._request('PUT', self._url(source, 'RENAME', destination=''.join([self.dest_dir, '/', destination])))
+      try:
+         return r.status_code == 200 and r.json().get('boolean', False)
+      except ValueError:
+         return False
+
+   def checksum(self, path):
+      # Computed by the datanodes from the block checksums
+      r = self._request('GET', self._url(path, 'GETFILECHECKSUM'))
+      if r.status_code != 200:
+         self._fail('GETFILECHECKSUM', path, r)
+      return r.json()['FileChecksum']['bytes']
+
+
+class LocalBackend(StorageBackend):
+   name = 'local'
+   # ioctl cloning a whole file on filesystems sharing blocks (btrfs, XFS...)
+   FICLONE = 0x40049409
+   # Files being written by put
+   TMP_FILE = re.compile(r'\.\d+\.\d+\.tmp$')
+
+   def __init__(self, root, metrics=None, logger=__name__):
+      """
+      Local or network (NFS...) filesystem. Local files are copied with
+      reflinks or copy_file_range when the filesystem supports them, so
+      the data does not go through the process.
+
+      :param root: destination folder
+      :type root: str
+      :type metrics: RunMetrics
+      :type logger: str
+      """
+      super().__init__(metrics, logger)
+      self.root = root
+
+   def _path(self, path):
+      return os.path.join(self.root, path.strip('/'))
+
+   @contextlib.contextmanager
+   def _errors(self, op, path):
+      with self._measure(op, path):
+         try:
+            yield
+         except OSError as e:
+            raise StorageError('%s %s: %s' % (op, path, e))
+
+   def _copy(self, source, target):
+      """
+      Copy a file object into a file. Regular files are cloned or copied in
+      the kernel when the filesystem can, other streams are read.
+
+      :type source: file
+      :type target: file
+      """
+      try:
+         source_fd = source.fileno()
+         size = os.fstat(source_fd).st_size if source.tell() == 0 else None
+      except (AttributeError, io.UnsupportedOperation, OSError):
+         size = None
+
+      if size is not None:
+         try:
+            import fcntl
+            fcntl.ioctl(target.fileno(), self.FICLONE, source_fd)
+            return
+         except (ImportError, OSError):
+            pass
+         offset = 0
+         try:
+            while offset < size:
+               copied = os.copy_file_range(source_fd, target.fileno(), size - offset, offset, offset)
+               if not copied:
+                  break
+               offset += copied
+            if offset == size:
+               return
+         except (AttributeError, OSError):
+            # Not supported by this filesystem, or kernel
+            if offset:
+               raise
+      shutil.copyfileobj(source, target, 1024 * 1024)
+
+   def check(self):
+      with self._errors('GETHOMEDIRECTORY', ''):
+         os.makedirs(self.root, exist_ok=True)
+         if not os.access(self.root, os.W_OK):
+            raise StorageError('%s is not writable' % self.root)
+
+   def put(self, path, data, overwrite=True):
+      target = self._path(path)
+      tmp = '%s.%d.%d.tmp' % (target, os.getpid(), threading.get_ident())
+      with self._errors('CREATE', path):
+         os.makedirs(os.path.dirname(target), exist_ok=True)
+         body = data()
+         try:
+            with open(tmp, 'wb') as f:
+               self._copy(body, f)
+            if overwrite:
+               os.replace(tmp, target)
+            else:
+               # A link fails if the file exists, even if it was created meanwhile
+               os.link(tmp, target)
+         except FileExistsError:
+            return False
+         finally:
+            if hasattr(body, 'close'):
+               body.close()
+            if os.path.exists(tmp):
+               os.remove(tmp)
+      return True
 
-   :param form: The format in which the log will be displayed
-   :type form: str
+   def append(self, path, content):
+      target = self._path(path)
+      with self._errors('APPEND', path):
+         os.makedirs(os.path.dirname(target), exist_ok=True)
+         with open(target, 'ab') as f:
+            f.write(content)
 
-   :returns: The object logger
-   :rtype: logger object
-   """
-   level = level.upper()
-   if level not in LVL:
-      logging.warning("Option of log level %s incorrect, using INFO." % level)
-      level = 'INFO'
-   level = LVL[level]
-   formatter = logging.Formatter(form)
-   logger = logging.getLogger(name)
-   logger.setLevel(level)
-   if log is not None:
-      filehdl = logging.FileHandler(log)
-      filehdl.setFormatter(formatter)
-      logger.addHandler(filehdl)
-   if console is True:
-      consolehdl = logging.StreamHandler()
-      consolehdl.setFormatter(formatter)
-      logger.addHandler(consolehdl)
-   return logger
+   def get(self, path, offset=0, length=None):
+      with self._errors('OPEN', path):
+         try:
+            with open(self._path(path), 'rb') as f:
+               f.seek(offset)
+               return f.read() if length is None else f.read(length)
+         except FileNotFoundError:
+            return None
+
+   def read(self, path, offset=0, length=None, chunk_size=1024 * 1024):
+      with self._errors('OPEN', path):
+         f = open(self._path(path), 'rb')
+      with f:
+         f.seek(offset)
+         left = length
+         while left is None or left > 0:
+            try:
+               chunk = f.read(chunk_size if left is None else min(chunk_size, left))
+            except OSError as e:
+               raise StorageError('OPEN %s: %s' % (path, e))
+            if not chunk:
+               break
+            if left is not None:
+               left -= len(chunk)
+            yield chunk
+
+   def list(self, path):
+      with self._errors('LISTSTATUS', path):
+         try:
+            entries = list(os.scandir(self._path(path)))
+         except FileNotFoundError:
+            return None
+         listing = {}
+         for entry in entries:
+            if self.TMP_FILE.search(entry.name):
+               continue
+            st = entry.stat()
+            listing[entry.name] = {'type': 'DIRECTORY' if entry.is_dir() else 'FILE',
+                                   'size': 0 if entry.is_dir() else st.st_size, 'mtime': int(st.st_mtime * 1000)}
+         return listing
+
+   def mkdirs(self, path):
+      with self._errors('MKDIRS', path):
+         os.makedirs(self._path(path), exist_ok=True)
+
+   def delete(self, path, recursive=False):
+      target = self._path(path)
+      with self._errors('DELETE', path):
+         try:
+            if not os.path.isdir(target):
+               os.remove(target)
+            elif recursive:
+               shutil.rmtree(target)
+            else:
+               os.rmdir(target)
+         except FileNotFoundError:
+            pass
+
+   def rename(self, source, destination):
+      src, dst = self._path(source), self._path(destination)
+      with self._errors('RENAME', source):
+         os.makedirs(os.path.dirname(dst), exist_ok=True)
+         if os.path.isdir(src):
+            if os.path.exists(dst):
+               return False
+            os.rename(src, dst)
+            return True
+         # Like HDFS, only one of concurrent renames of a file succeeds
+         try:
+            os.link(src, dst)
+         except (FileExistsError, FileNotFoundError):
+            return False
+         try:
+            os.remove(src)
+         except FileNotFoundError:
+            os.remove(dst)
+            return False
+      return True
 
+   def checksum(self, path):
+      with self._errors('GETFILECHECKSUM', path):
+         digest = hashlib.sha256()
+         with open(self._path(path), 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+               digest.update(chunk)
+         return 'sha256:' + digest.hexdigest()
 
-def create_connection_replacement(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None,
-                                  socket_options=None):
-   """
-   Overriding urllib3 to avoid possible 404 issue with Hadoop gateways
 
-   Sometimes, during a connexion to an hadoop cluster, you may not be able to
-   reach an hadoop web gateway (404 return). As 404 is not considered as
-   failed, urllib3 try to switch to another server in a round robin DNS case.
-   This override will permit to randomize the connexion IP when initializing
-   the first connexion to hadoop to avoid a such issue.
-   """
-   host, port = address
-   if host.startswith('['):
-      host = host.strip('[]')
-   err = None
+class S3Backend(StorageBackend):
+   name = 's3'
+   PART_SIZE = 64 * 1024 * 1024
 
-   addrinfo = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
-   while len(addrinfo) > 0:
-      idx = random.randint(0, len(addrinfo) - 1)
-      af, socktype, proto, canonname, sa = addrinfo[idx]
-      del addrinfo[idx]
+   def __init__(self, endpoint_url, dest_dir, max_attempts=5, metrics=None, timeout=None, logger=__name__):
+      """
+      S3 compatible object store (AWS, MinIO, Ceph...), through boto3 and
+      its usual credentials chain. Folders are emulated with key prefixes
+      and empty marker objects. Renames are a copy then a delete which may
+      overwrite the destination, so upload leases of --coordinate are not
+      available. Appends are conditional writes on the object ETag.
+
+      :param endpoint_url: S3 endpoint, None for AWS
+      :type endpoint_url: str
+      :param dest_dir: /bucket/prefix
+      :type dest_dir: str
+      :param max_attempts: attempts of a request, boto3 retries them
+      :type max_attempts: int
+      :type metrics: RunMetrics
+      :param timeout: connect and read timeouts of the requests in seconds
+      :type timeout: tuple
+      :type logger: str
+      """
+      super().__init__(metrics, logger)
+      try:
+         import boto3
+         import boto3.s3.transfer
+         import botocore.config
+         import botocore.exceptions
+      except ImportError:
+         raise StorageError('boto3 is required for the S3 storage')
+      self.bucket, _, self.prefix = dest_dir.strip('/').partition('/')
+      connect_timeout, read_timeout = timeout if timeout is not None else WebHdfsBackend.TIMEOUT
+      self.client = boto3.client('s3', endpoint_url=endpoint_url, config=botocore.config.Config(
+         retries={'max_attempts': max_attempts, 'mode': 'adaptive'}, connect_timeout=connect_timeout,
+         read_timeout=read_timeout))
+      # Parallelism comes from the upload workers, not from the parts of a file
+      self.transfer_config = boto3.s3.transfer.TransferConfig(multipart_threshold=self.PART_SIZE,
+                                                               multipart_chunksize=self.PART_SIZE, use_threads=False)
+      self._client_errors = (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError)
+      self._client_error = botocore.exceptions.ClientError
+
+   def _key(self, path):
+      return '/'.join(p for p in (self.prefix, path.strip('/')) if p)
+
+   def _code(self, error):
+      return error.response.get('Error', {}).get('Code') if isinstance(error, self._client_error) else None
+
+   @contextlib.contextmanager
+   def _errors(self, op, path):
+      with self._measure(op, path):
+         try:
+            yield
+         except self._client_errors as e:
+            raise StorageError('%s %s: %s' % (op, path, e))
+
+   def _range(self, offset, length):
+      if length is not None:
+         return 'bytes=%d-%d' % (offset, offset + length - 1)
+      return 'bytes=%d-' % offset
+
+   def check(self):
+      with self._errors('GETHOMEDIRECTORY', ''):
+         self.client.head_bucket(Bucket=self.bucket)
+
+   def put(self, path, data, overwrite=True):
+      with self._errors('CREATE', path):
+         body = data()
+         try:
+            if overwrite:
+               self.client.upload_fileobj(body, self.bucket, self._key(path), Config=self.transfer_config)
+            else:
+               self.client.put_object(Bucket=self.bucket, Key=self._key(path), Body=body.read(), IfNoneMatch='*')
+         except self._client_error as e:
+            if self._code(e) == 'PreconditionFailed':
+               return False
+            raise
+         finally:
+            if hasattr(body, 'close'):
+               body.close()
+      return True
 
-      sock = None
+   def get(self, path, offset=0, length=None):
+      kwargs = {'Range': self._range(offset, length)} if offset or length is not None else {}
+      with self._errors('OPEN', path):
+         try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(path), **kwargs)['Body'].read()
+         except self._client_error as e:
+            if self._code(e) == 'NoSuchKey':
+               return None
+            raise
+
+   def read(self, path, offset=0, length=None, chunk_size=1024 * 1024):
+      kwargs = {'Range': self._range(offset, length)} if offset or length is not None else {}
+      with self._errors('OPEN', path):
+         body = self.client.get_object(Bucket=self.bucket, Key=self._key(path), **kwargs)['Body']
       try:
-         sock = socket.socket(af, socktype, proto)
+         for chunk in body.iter_chunks(chunk_size):
+            yield chunk
+      except self._client_errors as e:
+         raise StorageError('OPEN %s: %s' % (path, e))
+      finally:
+         body.close()
+
+   def list(self, path):
+      prefix = self._key(path) + '/' if self._key(path) else ''
+      listing = {}
+      found = False
+      with self._errors('LISTSTATUS', path):
+         paginator = self.client.get_paginator('list_objects_v2')
+         for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            for entry in page.get('CommonPrefixes', []):
+               found = True
+               listing[entry['Prefix'][len(prefix):].rstrip('/')] = {'type': 'DIRECTORY', 'size': 0, 'mtime': 0}
+            for entry in page.get('Contents', []):
+               found = True
+               name = entry['Key'][len(prefix):]
+               # The folder marker
+               if name:
+                  listing[name] = {'type': 'FILE', 'size': entry['Size'],
+                                   'mtime': int(calendar.timegm(entry['LastModified'].utctimetuple()) * 1000)}
+      return listing if found or not prefix else None
+
+   def mkdirs(self, path):
+      with self._errors('MKDIRS', path):
+         self.client.put_object(Bucket=self.bucket, Key=self._key(path) + '/', Body=b'')
+
+   def delete(self, path, recursive=False):
+      key = self._key(path)
+      with self._errors('DELETE', path):
+         keys = [key, key + '/']
+         if recursive:
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=key + '/'):
+               keys += [entry['Key'] for entry in page.get('Contents', []) if entry['Key'] != key + '/']
+         for i in range(0, len(keys), 1000):
+            r = self.client.delete_objects(Bucket=self.bucket, Delete={
+               'Objects': [{'Key': k} for k in keys[i:i + 1000]], 'Quiet': True})
+            if r.get('Errors'):
+               raise StorageError('DELETE %s: %s' % (path, r['Errors'][0].get('Message')))
+
+   def rename(self, source, destination):
+      with self._errors('RENAME', source):
+         try:
+            self.client.copy_object(Bucket=self.bucket, Key=self._key(destination),
+                                    CopySource={'Bucket': self.bucket, 'Key': self._key(source)})
+         except self._client_error as e:
+            if self._code(e) == 'NoSuchKey':
+               return False
+            raise
+         self.client.delete_object(Bucket=self.bucket, Key=self._key(source))
+      return True
 
-         # If provided, set socket level options before connecting.
-         # This is the only addition urllib3 makes to this function.
-         urllib3.util.connection._set_socket_options(sock, socket_options)
+   def append(self, path, content):
+      key = self._key(path)
+      with self._errors('APPEND', path):
+         while True:
+            try:
+               r = self.client.get_object(Bucket=self.bucket, Key=key)
+               current, condition = r['Body'].read(), {'IfMatch': r['ETag']}
+            except self._client_error as e:
+               if self._code(e) != 'NoSuchKey':
+                  raise
+               current, condition = b'', {'IfNoneMatch': '*'}
+            try:
+               self.client.put_object(Bucket=self.bucket, Key=key, Body=current + content, **condition)
+               return
+            except self._client_error as e:
+               # Another writer changed the object since it was read
+               if self._code(e) not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                  raise
+            time.sleep(random.uniform(0.05, 0.5))
 
-         if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
-            sock.settimeout(timeout)
-         if source_address:
-            sock.bind(source_address)
-         sock.connect(sa)
-         return sock
+   def checksum(self, path):
+      # ETags are computed when the object is written, the object is read back instead
+      digest = hashlib.sha256()
+      for chunk in self.read(path):
+         digest.update(chunk)
+      return 'sha256:' + digest.hexdigest()
 
-      except socket.error as _:
-         err = _
-         if sock is not None:
-            sock.close()
-            sock = None
 
-   if err is not None:
-      raise err
-   else:
-      raise socket.error("getaddrinfo returns an empty list")
+STORAGES = (WebHdfsBackend.name, LocalBackend.name, S3Backend.name)
 
 
 class ManageSnapshot:
+   # Keys of the cassandra configuration file read by this tool
+   CASSANDRA_SETTINGS = ('cluster_name', 'data_file_directories', 'broadcast_address', 'listen_address')
+   DEFAULT_DATA_PATH = '/var/lib/cassandra/data'
+
    def __init__(self, username, realm, kerberos, keytab, cassandra_data_path, cassandra_config, hadoop_url,
-                hadoop_dest_dir, dry_run, logger=__name__):
+                hadoop_dest_dir, dry_run, workers=8, delete_batch_size=100, retry_policy=None, metrics=None,
+                pack_threshold=None, disk_readers=2, transfer_monitor=None, cluster_name=None, bootstrap=True,
+                coordinator=None, clear_snapshot=False, state_dir=None, storage=None, timeout=None,
+                logger=__name__):
       """
       :type username: str
       :type realm: str
       :type dry_run: bool
       :type keytab: str
-      :type cassandra_data_path: str
+      :param cassandra_data_path: data directory or list of data directories,
+                                  if None data_file_directories of the
+                                  Cassandra configuration file are used
+      :type cassandra_data_path: str or list
       :type cassandra_config: str
       :type kerberos: bool
       :type hadoop_dest_dir: str
       :type hadoop_url: str
+      :param workers: number of concurrent Hadoop requests for bulk operations
+      :type workers: int
+      :param delete_batch_size: number of files deleted by a worker batch
+      :type delete_batch_size: int
+      :param retry_policy: retry policy shared by all the Hadoop requests
+      :type retry_policy: RetryPolicy
+      :param metrics: metrics of the run
+      :type metrics: RunMetrics
+      :param pack_threshold: size in bytes under which SSTable components
+                             (except Data.db and Index.db) are packed in a
+                             bundle per table, None to disable packing
+      :type pack_threshold: int
+      :param disk_readers: number of concurrent uploads reading from a same
+                           physical disk
+      :type disk_readers: int
+      :param transfer_monitor: throughput monitor of datanode writes
+      :type transfer_monitor: TransferMonitor
+      :param cluster_name: Cassandra cluster name, read from the Cassandra
+                           configuration file if None
+      :type cluster_name: str
+      :param bootstrap: check requirements and connect to Hadoop, short-lived
+                        commands like commitlog archiving skip it
+      :type bootstrap: bool
+      :param coordinator: coordination of the uploads across the cluster,
+                          None for uncoordinated snapshots
+      :type coordinator: Coordinator
+      :param clear_snapshot: remove the local snapshot of each table once
+                             uploaded, then the whole snapshot at the end
+      :type clear_snapshot: bool
+      :param state_dir: local folder keeping state between runs, like the
+                        measured upload throughput, None or empty to
+                        keep nothing
+      :type state_dir: str
+      :param storage: storage holding the snapshots, WebHDFS at hadoop_url
+                      if None
+      :type storage: StorageBackend
+      :param timeout: connect and read timeouts of the WebHDFS requests in
+                      seconds, None for the default ones
+      :type timeout: tuple
       :type logger: str
       """
       self.username = username
       self.realm = realm
       self.kerberos = kerberos
       self.keytab = keytab
-      self.cassandra_data_path = cassandra_data_path
       self.cassandra_config = cassandra_config
       self.hadoop_url = hadoop_url
       self.hadoop_dest_dir = hadoop_dest_dir
       self.dry_run = dry_run
+      self.workers = workers
+      self.delete_batch_size = delete_batch_size
+      self.pack_threshold = pack_threshold
+      self.disk_readers = disk_readers
       self.hostname = socket.gethostname()
 
       self.meta_dir = 'cass_snap_metadata'
+      # Folders of the metadata directory which are not Cassandra nodes start with '_'
+      self.incremental_dir = '_incremental'
+      self.verify_dir = '_verify'
+      self.stopping = threading.Event()
       self.logger = logging.getLogger(logger)
-      self.cluster_name = self._get_cluster_name()
-      self.session = requests.Session()
-      self.auth = HTTPKerberosAuth(mutual_authentication=OPTIONAL)
+      self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy(logger=logger)
+      self.transfer_monitor = transfer_monitor if transfer_monitor is not None else TransferMonitor(logger=logger)
+      self.storage = storage if storage is not None else WebHdfsBackend(hadoop_url, hadoop_dest_dir,
+                                                                        self.retry_policy, metrics,
+                                                                        self.transfer_monitor, timeout, logger)
+      self.metrics = metrics if metrics is not None else RunMetrics(logger=logger)
+      self.coordinator = coordinator
+      self.clear_snapshot = clear_snapshot
+      self.state_dir = state_dir
+      self.plan = None
+      self.commitlog_dir = 'commitlog'
+      self._cassandra_settings = None
+      self._cassandra_data_path = cassandra_data_path
+      self._data_dirs = None
+      self._cluster_name = cluster_name
+      self._pool = None
+      self._metadata_cache = ManifestCache()
+
+      if bootstrap:
+         with self.metrics.profiler.span('requirements'):
+            self.check_requirements()
+         with self.metrics.profiler.span('connect', 'kerberos'):
+            self.connect_to_hadoop()
+
+   @property
+   def metrics(self):
+      """
+      Metrics of the current run, shared with the storage
+      :rtype: RunMetrics
+      """
+      return self._metrics
 
-      self.check_requirements()
-      self.connect_to_hadoop()
+   @metrics.setter
+   def metrics(self, metrics):
+      self._metrics = metrics
+      self.storage.metrics = metrics
+
+   @property
+   def cassandra_settings(self):
+      """
+      Settings of the cassandra configuration file, read on first use
+      :rtype: dict
+      """
+      if self._cassandra_settings is None:
+         self._cassandra_settings = self._get_cassandra_settings()
+      return self._cassandra_settings
+
+   @property
+   def cluster_name(self):
+      """
+      Cassandra cluster name, read on first use
+      :rtype: str
+      """
+      if self._cluster_name is None:
+         self._cluster_name = self._get_cluster_name()
+      return self._cluster_name
+
+   @property
+   def data_dirs(self):
+      """
+      Cassandra data directories
+      :rtype: list
+      """
+      if self._data_dirs is None:
+         paths = self._cassandra_data_path
+         if paths is None:
+            paths = self.cassandra_settings.get('data_file_directories') or self.DEFAULT_DATA_PATH
+         if isinstance(paths, str):
+            paths = [paths]
+         self._data_dirs = [os.path.normpath(d) for d in paths]
+      return self._data_dirs
 
    def check_requirements(self):
       """
@@ -185,23 +2935,29 @@ class ManageSnapshot:
          self.logger.debug("Keytab file is readable (%s)" % self.keytab)
 
       # Check cassandra data path permissions
-      try:
-         if not os.access(self.cassandra_data_path, os.R_OK):
-            self.logger.critical("Can't have permissions to read (%s) Cassandra data folder" % self.cassandra_data_path)
-            sys.exit(1)
-         else:
-            self.logger.debug(
-               'Cassandra data path permission (%s): ok' % self.cassandra_data_path)
-      except Exception as e:
-         self.logger.debug('Cassandra data path permission (%s) failed: %s' % (self.cassandra_data_path, e))
+      for data_dir in self.data_dirs:
+         try:
+            if not os.access(data_dir, os.R_OK):
+               self.logger.critical("Can't have permissions to read (%s) Cassandra data folder" % data_dir)
+               sys.exit(1)
+            else:
+               self.logger.debug('Cassandra data path permission (%s): ok' % data_dir)
+         except Exception as e:
+            self.logger.debug('Cassandra data path permission (%s) failed: %s' % (data_dir, e))
 
    def connect_to_hadoop(self):
       """
       Connect to Hadoop and validate authentication
       """
-      self.logger.info("Checking connexion to Hadoop")
-      # Authenticate to kerberos if requested
-      if self.kerberos is True:
+      self.logger.info("Checking connexion to %s storage" % self.storage.name)
+      # Authenticate to kerberos if requested, other storages use their own credentials
+      if self.storage.name != WebHdfsBackend.name:
+         try:
+            self.storage.check()
+         except StorageError as e:
+            self.logger.critical("Can't connect to %s storage : %s" % (self.storage.name, e))
+            sys.exit(1)
+      elif self.kerberos is True:
          self.connect_hadoop_kerberos()
 
    def connect_hadoop_kerberos(self):
@@ -211,93 +2967,98 @@ class ManageSnapshot:
 
       # Connect with Keytab
       if self.keytab is not None:
-         # Try to connect 3 times to Hadoop
-         try_con = 0
-         while try_con < 3:
-
-            try:
-               self.logger.debug('Trying to authenticate to Hadoop')
-
-               r = self.session.get('/'.join([self.hadoop_url, '?op=GETHOMEDIRECTORY']), auth=self.auth)
-               if r.status_code != 200:
-                  self.logger.error("Can't get Hadoop connexion : %s" % str(r.status_code))
-                  self.session.close()
-                  try_con += 1
-               else:
-                  self.logger.debug('Connexion to Hadoop: successful')
-                  try_con = 4
-
-            except IndexError as e:
-               self.logger.critical("Can't connect to Kerberos : %s" % e)
-               sys.exit(1)
-
-         if try_con != 4:
+         self.logger.debug('Trying to authenticate to Hadoop')
+         try:
+            self.storage.check()
+         except StorageError as e:
+            self.logger.critical("Can't get Hadoop connexion : %s" % e)
             sys.exit(1)
+         self.logger.debug('Connexion to Hadoop: successful')
       else:
          print('Could not connect without Kerberos keytab to Hadoop Cluster')
          sys.exit(1)
 
-   def _ask_hadoop(self, url):
+   @contextlib.contextmanager
+   def _worker_pool(self):
       """
-      Make a request to Hadoop and return the json result
+      Get the thread pool running concurrent Hadoop requests. It lives as long
+      as this object, so its threads keep their HTTP sessions from one bulk
+      operation to the next.
 
-      :param url: full URL to request to Hadoop cluster
-      :return: dict
+      :rtype: ThreadPoolExecutor
       """
-      try:
-         self.logger.debug(''.join(['used url: ', url]))
+      if self._pool is None:
+         self._pool = ThreadPoolExecutor(max_workers=self.workers)
+      yield self._pool
+
+   def close(self):
+      """
+      Release the worker threads
+      """
+      if self._pool is not None:
+         self._pool.shutdown()
+         self._pool = None
 
-         r = self.session.get(url, auth=self.auth)
-         if r.status_code != 200:
-            raise Exception("Failed to make Hadoop request: " + str(r.status_code))
+   def _ask_hadoop(self, path):
+      """
+      List a folder of the storage, failing the action if it can't be listed
 
-      except IndexError as e:
-         self.logger.critical("Can't connect to Kerberos : %s" % e)
-         sys.exit(1)
+      :param path: folder path relative to the destination folder
+      :return: dict of entry name -> status, empty if the folder does not exist
+      :rtype: dict
+      """
+      try:
+         listing = self.storage.list(path)
+      except StorageError as e:
+         self.logger.critical("Can't connect to Hadoop : %s" % e)
+         raise OperationError("Can't list %s" % path)
 
-      return json.loads(r._content)
+      return listing or {}
 
    def list_snapshots(self):
       """
       List available snapshots from Hadoop
       """
 
-      def node_snapshot(url, node_name):
+      def node_snapshot(path, node_name):
          """
          List available snapshot for a specific node
-         :param url: hadoop url to metadata dir node
+         :param path: metadata dir of the cluster
          :param node_name: the node name to look on
          """
-         snapshots_json = self._ask_hadoop(''.join([url, '/', node_name, '?op=liststatus']))
-
-         for s in snapshots_json['FileStatuses']['FileStatus']:
-            snap_date = re.sub('cass_snap_', r'', s['pathSuffix'])
+         for name in sorted(self._ask_hadoop('/'.join([path, node_name]))):
+            snap_date = re.sub('cass_snap_', r'', name)
             all_snapshots.add_row([node_name, snap_date])
 
       self.logger.info("Listing available Cassandra snapshots on Hadoop cluster")
 
       # Get list of available Cassandra nodes
-      url = '/'.join([self.hadoop_url, self.hadoop_dest_dir, self.meta_dir, self.cluster_name])
-      nodes_json = self._ask_hadoop(url + '?op=liststatus')
+      path = '/'.join([self.meta_dir, self.cluster_name])
+      nodes = self._ask_hadoop(path)
 
       # Add to the snapshots array the list of snapshots per nodes
+      from prettytable import PrettyTable
       all_snapshots = PrettyTable(['Nodes', 'Dates'])
-      for s in nodes_json['FileStatuses']['FileStatus']:
-         node_snapshot(url, s['pathSuffix'])
+      for name in sorted(nodes):
+         if not name.startswith('_'):
+            node_snapshot(path, name)
 
       print(all_snapshots)
       return
 
    def _get_keyspaces_list(self):
       """
-      Get the keyspaces and table list
+      Get the keyspaces list of all the data directories
 
       :rtype list
       """
       self.logger.debug('Getting cassandra keyspaces and tables lists')
-      ks_list = os.listdir(self.cassandra_data_path)
+      ks_list = set()
+      for data_dir in self.data_dirs:
+         if os.path.isdir(data_dir):
+            ks_list.update(os.listdir(data_dir))
       # self.logger.debug("Keyspaces: %s" % str(ks_list))
-      return ks_list
+      return sorted(ks_list)
 
    def _get_tables_list(self, ks_list):
       """
@@ -306,87 +3067,137 @@ class ManageSnapshot:
       :type ks_list: list
       :rtype list
       """
-      tables_list = []
+      tables_list = set()
 
       for table in ks_list:
-         ks_tables = os.listdir('/'.join([self.cassandra_data_path, table]))
-         tables_list += ['/'.join([table, file]) for file in ks_tables]
+         for data_dir in self.data_dirs:
+            ks_path = '/'.join([data_dir, table])
+            if os.path.isdir(ks_path):
+               tables_list.update('/'.join([table, file]) for file in os.listdir(ks_path))
          # self.logger.debug("Tables: %s" % str(tables_list))
 
-      return tables_list
+      return sorted(tables_list)
 
    def _get_current_snapshot_files(self, snap_name, tables_list):
       """
-      Get the list of current tables in a snapshot folder
+      Get the list of current tables in a snapshot folder of every data directory
 
+      :param snap_name: snapshot name, None to list the live files of the
+                        tables, the ones a snapshot would hold
       :type snap_name: str
       :type tables_list: list
-      :rtype: list
+      :return: file path (keyspace/table/file) -> (size, local snapshot folder)
+      :rtype: Manifest
       """
       current_snapshot = []
+      # Written by Cassandra in the snapshot folder of each data directory: the manifest only lists the
+      # files of its directory, the schema is the same in all of them and is kept once
+      schemas = set()
 
       try:
 
-         for table in tables_list:
-            snap_path = '/'.join([self.cassandra_data_path, table, 'snapshots', snap_name])
-            if not os.path.isdir(snap_path):
-               continue
-
-            for i in os.listdir(snap_path):
-               current_snapshot.append('/'.join([table, i]))
-            current_snapshot.sort()
+         for data_dir in self.data_dirs:
+            for table in tables_list:
+               snap_path = '/'.join([data_dir, table, 'snapshots', snap_name] if snap_name else [data_dir, table])
+               if not os.path.isdir(snap_path):
+                  continue
+
+               for entry in os.scandir(snap_path):
+                  if snap_name is None and not entry.is_file():
+                     continue
+                  if entry.name == 'manifest.json':
+                     continue
+                  if entry.name == 'schema.cql':
+                     if table in schemas:
+                        continue
+                     schemas.add(table)
+                  size = entry.stat().st_size if entry.is_file() else 0
+                  current_snapshot.append(('/'.join([table, entry.name]), size, snap_path))
 
       except Exception as e:
-         self.logger.critical("Could not list tables in cassandra data dir")
+         self.logger.critical("Could not list tables in cassandra data dir: %s" % e)
 
-      return current_snapshot
+      return Manifest(current_snapshot)
 
-   def _create_snapshot_file(self, snap_name, tables_list):
+   def _get_disk(self, path):
       """
-      Create a snapshot list with list of files which will be stored on the
-      Hadoop Cluster. You need to pass snapshot name number in argument. This
-      will return a list of files made by the snapshot.
+      Get the physical disk holding a local file
 
-      :type snap_name: str
-      :type tables_list: list
-      :rtype: list, str
+      :type path: str
+      :return: device id
+      :rtype: int
+      """
+      try:
+         return os.stat(path).st_dev
+      except OSError:
+         return None
+
+   def _create_snapshot_file(self, entries):
+      """
+      Create a snapshot file with the list of files stored on the Hadoop
+      Cluster. Each line holds a file path, its size and the bundle it is
+      packed in (empty when stored as a single file), separated by tabs.
+
+      :param entries: file path -> (size, bundle location)
+      :type entries: Manifest
+      :rtype: str
       """
       today = datetime.datetime.now().strftime('%Y_%m_%d')
       snap_file = ''.join(['/tmp/', 'cass_snap_', today])
-      current_snap = self._get_current_snapshot_files(snap_name, tables_list)
 
       try:
          self.logger.debug("Storing file information in %s" % snap_file)
-         with open(snap_file, 'a') as f:
-            for table in current_snap:
-               f.write(re.sub(r"/\n$", "\n" ,'/'.join([table, "\n"])))
+         with open(snap_file, 'w') as f:
+            for table, (size, location) in entries.items():
+               f.write('\t'.join([table, str(size), location]) + '\n')
       except Exception as e:
          self.logger.critical("Could not write tables list to file: %s" % e)
 
-      return current_snap, snap_file
+      return snap_file
+
+   @staticmethod
+   def _parse_snapshot_file(content):
+      """
+      Parse the content of a snapshot file. Files written before sizes and
+      bundles were recorded only hold paths.
+
+      :type content: str
+      :return: file path -> (size or None, bundle location)
+      :rtype: Manifest
+      """
+      def entries():
+         for line in content.split('\n'):
+            if not line:
+               continue
+            fields = line.split('\t')
+            size = int(fields[1]) if len(fields) > 1 and fields[1] else None
+            yield fields[0], size, fields[2] if len(fields) > 2 else ''
+      return Manifest(entries())
 
    def _get_last_snapshot_file(self):
       """
-      Get the last snapshot_file on Hadoop
+      Get the last snapshot_file of the current node on Hadoop
 
       :rtype: str
       """
       self.logger.debug('Listing metadata directory from Hadoop')
-      url = ''.join([self.hadoop_url, self.hadoop_dest_dir, '/', self.meta_dir, '/full?op=LISTSTATUS'])
-      self.logger.debug(''.join(['used url: ', url]))
-
-      r = self.session.get(url, auth=self.auth)
+      path = '/'.join([self.meta_dir, self.cluster_name, self.hostname])
 
-      if r.status_code == 404:
-         self.logger.info("Cannot get meta file, folder does not exist : %s" % str(r.status_code))
-         #self.session.close()
+      try:
+         listing = self.storage.list(path)
+      except StorageError as e:
+         # Without the last snapshot every file would be sent again
+         self.logger.critical("Can't list metadata files : %s" % e)
+         raise OperationError("Can't list %s" % path)
+
+      if listing is None:
+         self.logger.info("Cannot get meta file, folder does not exist : %s" % path)
          return None
 
-      # Deserialize json and get the latest snapshot meta file
-      snaps_json = json.loads(r._content)
+      # Get the latest snapshot meta file
       all_snaps = {}
-      for s in snaps_json['FileStatuses']['FileStatus']:
-         all_snaps[s['pathSuffix']] = s['modificationTime']
+      for name, status in listing.items():
+         all_snaps[name] = status['mtime']
       self.logger.debug("Found %d snapshot(s) on Hadoop" % len(all_snaps))
 
       # Check if empty
@@ -399,6 +3210,17 @@ class ManageSnapshot:
 
       return latest
 
+   def _get_cassandra_settings(self):
+      """
+      Read the settings used by this tool in the cassandra configuration file
+      :return: dict
+      """
+      try:
+         return read_yaml_keys(self.cassandra_config, self.CASSANDRA_SETTINGS)
+      except (IOError, ValueError) as e:
+         self.logger.debug('Could not read cassandra config file %s: %s' % (self.cassandra_config, e))
+      return {}
+
    def _get_cluster_name(self):
       """
       Get the cluster name from cassandra configuration file
@@ -406,19 +3228,11 @@ class ManageSnapshot:
       """
       self.logger.debug("Getting cluster name in cassandra config file: %s" % self.cassandra_config)
 
-      try:
-         stream = open(self.cassandra_config, 'r')
-         config = yaml.load_all(stream)
-
-         for line in config:
-            for k,v in list(line.items()):
-               if k == 'cluster_name':
-                  self.logger.debug("Cluster name found: %s" % v)
-                  return v
-
-      except IndexError as e:
-         self.logger.debug('Cluster name not found, using default one instead')
+      if self.cassandra_settings.get('cluster_name'):
+         self.logger.debug("Cluster name found: %s" % self.cassandra_settings['cluster_name'])
+         return self.cassandra_settings['cluster_name']
 
+      self.logger.debug('Cluster name not found, using default one instead')
       return 'cassandra_cluster'
 
    def _hadoop_create_folders(self, folders):
@@ -428,184 +3242,990 @@ class ManageSnapshot:
       :type folders: list
       """
 
-      for folder in folders:
-
-         try:
-            # Todo: rajouter une option pour les permissions
-            url = ''.join([self.hadoop_url, self.hadoop_dest_dir, '/', folder, '?op=MKDIRS'])
+      for folder in folders:
+
+         try:
+            self.storage.mkdirs(folder)
+         except StorageError as e:
+            self.logger.critical('Failed to create %s directory: %s' % (folder, e))
+            raise OperationError('Failed to create %s directory' % folder)
+
+   def _push_file_to_hadoop(self, file_path, dst_path=''):
+      """
+      Push files to Hadoop
+      You need to set the file name (with path) from the source path to the destination path
+
+      :type file_path: str
+      :type dst_path: str
+
+      """
+      # Get source file and path
+      file = os.path.basename(file_path)
+      self.logger.debug("Uploading: %s" % file_path)
+
+      # Check permissions
+      if not os.access(file_path, os.R_OK):
+         self.logger.error("Can't read %s, check if file exists and permissions" % file_path)
+         return False
+
+      try:
+         self.storage.put('/'.join([dst_path, file]), lambda: open(file_path, 'rb'))
+      except (StorageError, IOError) as e:
+         self.logger.error("Could not upload %s: %s" % (file_path, e))
+         return False
+      return True
+
+   def _is_packable(self, table, size):
+      """
+      Check if a file has to be packed in its table bundle
+
+      :type table: str
+      :type size: int
+      :rtype: bool
+      """
+      if self.pack_threshold is None or size > self.pack_threshold:
+         return False
+      return not table.endswith(('Data.db', 'Index.db'))
+
+   def _push_bundle_to_hadoop(self, location, members, sizes):
+      """
+      Stream small files of a table in a tar bundle on Hadoop, with a sidecar
+      JSON index giving each member offset and size
+
+      :param location: bundle path relative to the cluster folder
+      :type location: str
+      :param members: dict of file path -> local path of the files to pack
+      :type members: dict
+      :param sizes: dict of file path -> size
+      :type sizes: dict
+      :return: True if the bundle and its index were uploaded
+      :rtype: bool
+      """
+      bundle = TarBundle([(os.path.basename(t), members[t], sizes[t]) for t in sorted(members)])
+      path = '/'.join([self.cluster_name, location])
+      index = json.dumps(bundle.index, sort_keys=True).encode('utf-8')
+      self.logger.debug("Uploading bundle %s with %d files" % (location, len(members)))
+
+      try:
+         self.storage.put(path, bundle.open)
+         self.storage.put(path + '.idx', lambda: io.BytesIO(index))
+      except (StorageError, IOError, OSError) as e:
+         self.logger.error("Could not upload bundle %s: %s" % (location, e))
+         return False
+      return True
+
+   def _push_tables_to_hadoop(self, files, snap_name, sizes, on_done=None):
+      """
+      Push tables in the list to Hadoop cluster. This will use the cluster name
+      as well and create a dedicated folder for it, just in case you're using
+      the same Hadoop account for several cassandra clusters. When packing is
+      enabled, small files of a table are sent together in a bundle.
+
+      :param files: dict of file path -> local path of the files to upload
+      :type files: dict
+      :type snap_name: str
+      :param sizes: dict of file path -> size
+      :type sizes: dict
+      :param on_done: callable run from the upload threads with the list of
+                      files of an upload and the dict of the uploaded ones,
+                      once the upload is done
+      :return: dict of uploaded file path -> bundle location (empty for single files)
+      :rtype: dict
+      """
+      # Split files between bundles, one per table snapshot folder, and single files
+      groups = {}
+      for table in files:
+         if self._is_packable(table, sizes[table]):
+            groups.setdefault((os.path.dirname(table), os.path.dirname(files[table])), []).append(table)
+      bundles = {}
+      for (table_dir, snap_dir), members in sorted(groups.items()):
+         if len(members) < 2:
+            continue
+         # A table spread over several data directories gets one bundle per directory
+         count = len([b for b in bundles if os.path.dirname(os.path.dirname(b)) == table_dir])
+         name = snap_name if count == 0 else '%s.%d' % (snap_name, count)
+         bundles['/'.join([table_dir, 'bundles', name + '.tar'])] = members
+      packed = set(t for members in bundles.values() for t in members)
+      single_files = sorted(t for t in files if t not in packed)
+
+      # Create mandatory folders to manage snapshots
+      self.logger.debug('Creating mandatory folders in hadoop if do not exist')
+      self._hadoop_create_folders([self.cluster_name, self.meta_dir])
+
+      # Create Cassandra folders from Cassandra snapshot tables list
+      self.logger.debug('Creating cassandra snapshot folder in hadoop if do not exist')
+      folders = set('/'.join([self.cluster_name, os.path.dirname(table)]) for table in single_files)
+      folders.update('/'.join([self.cluster_name, os.path.dirname(location)]) for location in bundles)
+      self._hadoop_create_folders(sorted(folders))
+
+      def lease_lost():
+         return self.coordinator is not None and self.coordinator.lost
+
+      def push_file(table):
+         if not lease_lost() and self._push_file_to_hadoop(files[table], '/'.join([self.cluster_name, os.path.dirname(table)])):
+            self.metrics.add('uploaded', size=sizes[table])
+            return {table: ''}
+         self.metrics.add('failed', size=sizes[table])
+         return {}
+
+      def push_bundle(location):
+         members = bundles[location]
+         if not lease_lost() and self._push_bundle_to_hadoop(location, dict((t, files[t]) for t in members), sizes):
+            self.metrics.add('uploaded', files=len(members), size=sum(sizes[t] for t in members))
+            return dict((t, location) for t in members)
+         self.metrics.add('failed', files=len(members), size=sum(sizes[t] for t in members))
+         return {}
+
+      tasks = [(self._get_disk(files[t]), sizes[t], functools.partial(push_file, t)) for t in single_files]
+      tasks += [(self._get_disk(files[bundles[b][0]]), sum(sizes[t] for t in bundles[b]),
+                 functools.partial(push_bundle, b)) for b in sorted(bundles)]
+      members = [[t] for t in single_files] + [bundles[b] for b in sorted(bundles)]
+
+      def done(idx, result):
+         if on_done is not None:
+            on_done(members[idx], result)
+
+      # Push sstables to Hadoop
+      self.logger.info('Pushing snapshot tables to hadoop, please wait...')
+      uploaded = {}
+      with self._worker_pool() as pool:
+         scheduler = UploadScheduler(self.workers, self.disk_readers, executor=pool, logger=self.logger.name)
+         for result in scheduler.run(tasks, done):
+            uploaded.update(result)
+
+      self.logger.debug("There are %d tables which could not be uploaded" % (len(files) - len(uploaded)))
+      return uploaded
+
+   def _take_local_snapshot(self):
+      """
+      Snapshot all keyspaces with nodetool and return the snapshot name
+
+      :rtype: str
+      """
+      try:
+         self.logger.info('Start snapshoting')
+         result = subprocess.Popen('nodetool snapshot', shell=True, stdout=subprocess.PIPE, universal_newlines=True)
+      except OSError as e:
+         self.logger.critical("Error during snapshot request : %s" % e)
+         raise OperationError('nodetool snapshot failed')
+
+      # Get snapshot name from nodetool result
+      snap_name = None
+      for line in result.stdout:
+         if re.match('Snapshot directory:', line):
+            snap_name = re.match(r"Snapshot directory: (\d+)", line).group(1)
+            self.logger.debug("Snapshot name: %s" % snap_name)
+      result.wait()
+
+      if snap_name is None:
+         self.logger.critical("Could not find snapshot name")
+         raise OperationError('nodetool snapshot failed')
+      return snap_name
+
+   def _get_local_addresses(self):
+      """
+      Get the addresses the node may have in the ring, configured ones first
+      :rtype: list
+      """
+      addresses = [str(self.cassandra_settings[key]) for key in ('broadcast_address', 'listen_address')
+                   if self.cassandra_settings.get(key)]
+      try:
+         addresses += [info[4][0] for info in socket.getaddrinfo(self.hostname, None)]
+      except socket.error:
+         pass
+      addresses.append(self.hostname)
+      return addresses
+
+   def _get_token_ranges(self, keyspace):
+      """
+      Get the replicas of each token range of a keyspace with nodetool
+
+      :return: list of replica endpoints lists, empty if the ring could not be read
+      :rtype: list
+      """
+      try:
+         result = subprocess.Popen(['nodetool', 'describering', keyspace], stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, universal_newlines=True)
+         out, _ = result.communicate()
+      except OSError as e:
+         self.logger.warning('Could not describe ring of %s: %s' % (keyspace, e))
+         return []
+
+      ranges = []
+      for match in re.finditer(r'TokenRange\(start_token:([^,]+), end_token:([^,]+), endpoints:\[([^\]]*)\]', out):
+         ranges.append([e.strip() for e in match.group(3).split(',') if e.strip()])
+      return ranges
+
+   def _get_elected_keyspaces(self, ks_list):
+      """
+      Keep the keyspaces this node is elected to back up. Keyspaces whose
+      ring could not be read, like local system keyspaces, or in which the
+      node could not be found are always kept.
+
+      :type ks_list: list
+      :rtype: list
+      """
+      addresses = self._get_local_addresses()
+      elected = []
+      for keyspace in ks_list:
+         ranges = self._get_token_ranges(keyspace)
+         endpoints = set(endpoint for endpoints in ranges for endpoint in endpoints)
+         address = next((a for a in addresses if a in endpoints), None)
+         if not ranges:
+            elected.append(keyspace)
+         elif address is None:
+            self.logger.error('None of the addresses of this node (%s) is in the ring of %s, backing it up' % (
+               ', '.join(addresses), keyspace))
+            elected.append(keyspace)
+         elif address in Coordinator.elect_replicas(ranges):
+            elected.append(keyspace)
+         else:
+            self.logger.info('Keyspace %s is backed up by other replicas, skipping it' % keyspace)
+      return elected
+
+   def make_snapshot(self):
+      """
+      Performing Cassandra snapshot and pushing it to Hadoop
+      """
+      self.metrics.action = 'snapshot'
+
+      if self.coordinator is not None and not self.dry_run:
+         self.coordinator.stagger(self)
 
-            r = self.session.put(url, auth=self.auth)
-            #self.logger.debug(''.join(['url: ', url, ' / ', str(r.status_code)]))
+      # Get local keyspaces and tables list
+      with self.metrics.phase('discovery'):
+         ks_list = self._get_keyspaces_list()
+         if self.coordinator is not None and self.coordinator.replica_dedup:
+            ks_list = self._get_elected_keyspaces(ks_list)
+         tables_list = self._get_tables_list(ks_list)
+
+      # Locally snapshot all keyspaces, a plan uses the live files instead
+      snap_name = None
+      if not self.dry_run:
+         with self.metrics.phase('snapshot'):
+            snap_name = self._take_local_snapshot()
 
-            if r.status_code == 500:
-               action = self.session.put(r.url, auth=self.auth)
-               #self.logger.debug(''.join(['Fwd mkdir: ', r.url, ' / ', str(action.status_code)]))
+      # Generate a diff between last and current snap
+      with self.metrics.phase('diff'):
+         last_snapshot = self._get_last_snapshot_file()
+         current_snap = self._get_current_snapshot_files(snap_name, tables_list)
+
+         last_files = None
+         if last_snapshot is not None:
+            last_files = self._get_snapshot_metadata({'node': self.hostname,
+                                                      'date': re.sub('cass_snap_', r'', last_snapshot)})
+         if last_files is None:
+            last_files = Manifest()
+
+         sizes = {}
+         tables_to_upload = {}
+         for table, (size, snap_path) in current_snap.difference(last_files).items():
+            sizes[table] = size
+            tables_to_upload[table] = '/'.join([snap_path, os.path.basename(table)])
+         self.metrics.add('discovered', files=len(current_snap), size=current_snap.size())
+         self.metrics.add('skipped', files=len(current_snap) - len(tables_to_upload),
+                          size=current_snap.size() - sum(sizes.values()))
+         self.logger.debug("Tables changes before last snapshot: %d" % len( tables_to_upload))
+
+      if self.dry_run:
+         self._report_plan('upload', sizes, current_snap)
+         return
+
+      # Send diff tables to hadoop, once this node gets an upload lease when coordinated
+      slot = self.coordinator.upload_slot(self) if self.coordinator is not None else contextlib.nullcontext(True)
+      with slot as granted:
+         if not granted:
+            self.logger.critical('Could not get an upload lease in %ds' % self.coordinator.timeout)
+            raise OperationError('No upload lease')
+         self._upload_snapshot(snap_name, current_snap, tables_to_upload, last_files, sizes)
+         if self.coordinator is not None and self.coordinator.lost:
+            # Uploaded files are recorded, the next snapshot sends the other ones
+            self.logger.critical('Upload lease lost, snapshot is incomplete')
+            raise OperationError('Upload lease lost')
+
+   def _upload_snapshot(self, snap_name, current_snap, tables_to_upload, last_files, sizes):
+      """
+      Push the changed files and the snapshot metadata to Hadoop
 
-               if action.status_code != 200:
-                  raise Exception('Failed to create ' + folder + ' directory: ' + str(action.status_code))
-                  # Todo: ne pas sortir comme un sauvage, faire une fonction pour exit
-                  sys.exit(1)
+      :param snap_name: local snapshot name
+      :type snap_name: str
+      :param current_snap: file path (keyspace/table/file) -> (size, local snapshot folder)
+      :type current_snap: Manifest
+      :param tables_to_upload: file path -> local path of the files missing in Hadoop
+      :type tables_to_upload: dict
+      :param last_files: entries of the previous snapshot metadata
+      :type last_files: Manifest
+      :param sizes: file path -> size of the files missing in Hadoop
+      :type sizes: dict
+      """
+      on_done = self._clear_uploaded_folders(current_snap, tables_to_upload) if self.clear_snapshot else None
+      with self.metrics.phase('upload'):
+         self.metrics.start_upload(len(tables_to_upload),
+                                   self.metrics.bytes['discovered'] - self.metrics.bytes['skipped'])
+         uploaded = self._push_tables_to_hadoop(tables_to_upload, snap_name, sizes, on_done)
+         self.metrics.stop_upload()
+      if self.metrics.bytes['uploaded']:
+         self._record_throughput(self.metrics.bytes['uploaded'], time.time() - self.metrics.upload_start)
+
+      # Files which failed to upload are left out, the next snapshot will send them
+      def entries():
+         for table, (size, snap_path) in current_snap.items():
+            if table in uploaded:
+               yield table, size, uploaded[table]
+            elif table not in tables_to_upload:
+               yield table, size, last_files[table][1]
+      snap_file = self._create_snapshot_file(Manifest(entries()))
 
-         except IndexError as e:
-            self.logger.error(" %s" % e)
-            sys.exit(1)
+      # Push metadata to hadoop
+      with self.metrics.phase('metadata'):
+         self.logger.info('Pushing metadata to hadoop')
+         self._hadoop_create_folders(['/'.join([self.meta_dir, self.cluster_name, self.hostname])])
+         if not self._push_file_to_hadoop(snap_file, '/'.join([self.meta_dir, self.cluster_name, self.hostname])):
+            # The local snapshot is kept, nothing records the files it holds
+            self.logger.critical('Could not push metadata of snapshot %s' % snap_name)
+            raise OperationError('Metadata upload failed')
+
+      if self.clear_snapshot:
+         self._clear_local_snapshot(snap_name)
+
+   def _record_throughput(self, size, duration):
+      """
+      Keep the throughput of the last uploads in the state folder, plans
+      estimate their duration from it
 
-   def _push_file_to_hadoop(self, file_path, dst_path=''):
+      :param size: bytes uploaded
+      :type size: int
+      :param duration: upload duration in seconds
+      :type duration: float
       """
-      Push files to Hadoop
-      You need to set the file name (with path) from the source path to the destination path
+      if not self.state_dir or duration <= 0:
+         return
+      path = os.path.join(self.state_dir, 'throughput.json')
+      try:
+         with open(path) as f:
+            samples = json.load(f)['samples']
+      except (IOError, ValueError, KeyError):
+         samples = []
+      samples = (samples + [[int(time.time()), size, round(duration, 3)]])[-10:]
+      try:
+         if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+         with open(path + '.tmp', 'w') as f:
+            json.dump({'samples': samples}, f)
+         os.rename(path + '.tmp', path)
+      except (IOError, OSError) as e:
+         self.logger.warning('Could not record upload throughput in %s: %s' % (path, e))
+
+   def _get_recent_throughput(self):
+      """
+      Get the throughput of the last uploads
 
-      :type file_path: str
-      :type dst_path: str
+      :return: bytes per second, None if unknown
+      :rtype: float
+      """
+      if not self.state_dir:
+         return None
+      try:
+         with open(os.path.join(self.state_dir, 'throughput.json')) as f:
+            samples = json.load(f)['samples']
+      except (IOError, ValueError, KeyError):
+         return None
+      duration = sum(sample[2] for sample in samples)
+      return sum(sample[1] for sample in samples) / duration if duration > 0 else None
 
+   def _report_plan(self, action, sizes, current=None):
       """
-      # Required header to upload
-      headers = {'content-type': 'application/octet-stream'}
+      Print what a run would do per keyspace and table, without doing it
+
+      :param action: 'upload' or 'delete'
+      :type action: str
+      :param sizes: file path -> size of the files to upload or delete
+      :type sizes: dict
+      :param current: all the files of the snapshot, for uploads
+      :type current: Manifest
+      """
+      rows = {}
+      for path, size in sizes.items():
+         row = rows.setdefault(tuple(path.split('/')[:2]), [0, 0, 0])
+         row[0] += 1
+         row[1] += size
+      for path in current or ():
+         if path not in sizes:
+            rows.setdefault(tuple(path.split('/')[:2]), [0, 0, 0])[2] += 1
+
+      total_files = sum(row[0] for row in rows.values())
+      total_bytes = sum(row[1] for row in rows.values())
+      throughput = self._get_recent_throughput() if action == 'upload' else None
+      duration = total_bytes / throughput if throughput else None
+      self.plan = {'action': action, 'files': total_files, 'bytes': total_bytes,
+                   'estimated_seconds': round(duration, 1) if duration is not None else None,
+                   'throughput_mb_s': round(throughput / (1024.0 * 1024), 3) if throughput else None,
+                   'tables': [{'keyspace': key[0], 'table': key[1] if len(key) > 1 else '', 'files': row[0],
+                               'bytes': row[1], 'unchanged': row[2]}
+                              for key, row in sorted(rows.items(), key=lambda item: (-item[1][1], item[0]))]}
+
+      from prettytable import PrettyTable
+      columns = ['Keyspace', 'Table', 'Files to ' + action, 'MB to ' + action]
+      table = PrettyTable(columns + (['Unchanged files'] if current is not None else []))
+      for entry in self.plan['tables']:
+         if entry['files'] or current is None:
+            table.add_row([entry['keyspace'], entry['table'], entry['files'],
+                           round(entry['bytes'] / (1024.0 * 1024), 1)] +
+                          ([entry['unchanged']] if current is not None else []))
+      print(table)
+
+      summary = 'Plan: {0} {1} files ({2:.1f} MB)'.format(action, total_files, total_bytes / (1024.0 * 1024))
+      if action == 'upload':
+         if duration is not None:
+            summary += ', about {0} at the recent {1:.1f} MB/s'.format(datetime.timedelta(seconds=int(duration)),
+                                                                       throughput / (1024.0 * 1024))
+         else:
+            summary += ', no upload throughput measured yet to estimate its duration'
+      print(summary)
 
-      # Get source file and path
-      file = os.path.basename(file_path)
-      src_path = os.path.dirname(file_path)
-      #self.logger.debug("Source path: %s / file: %s / dest: %s" % (src_path, file, dst_path))
-      self.logger.debug("Uploading: %s/%s" % (src_path, file))
+   def _clear_uploaded_folders(self, current_snap, tables_to_upload):
+      """
+      Remove the local snapshot folder of a table as soon as all its files
+      are in Hadoop, so compacted SSTables only kept by the snapshot hardlinks
+      free their disk space while the other tables upload. Folders without
+      changes are removed at once.
+
+      :param current_snap: file path -> (size, local snapshot folder)
+      :type current_snap: Manifest
+      :param tables_to_upload: file path -> local path of the files missing in Hadoop
+      :type tables_to_upload: dict
+      :return: callable to run once an upload is done, see _push_tables_to_hadoop
+      """
+      pending = {}
+      for table, local in tables_to_upload.items():
+         folder = os.path.dirname(local)
+         pending[folder] = pending.get(folder, 0) + 1
+      failed = set()
+      lock = threading.Lock()
+
+      def remove(folder):
+         self.logger.debug('Removing uploaded snapshot folder %s' % folder)
+         try:
+            shutil.rmtree(folder)
+         except OSError as e:
+            self.logger.warning('Could not remove snapshot folder %s: %s' % (folder, e))
+
+      for folder in set(location for path, (size, location) in current_snap.items()) - set(pending):
+         remove(folder)
+
+      def on_done(tables, uploaded):
+         folders = []
+         with lock:
+            for table in tables:
+               folder = os.path.dirname(tables_to_upload[table])
+               if table not in uploaded:
+                  failed.add(folder)
+               pending[folder] -= 1
+               if pending[folder] == 0 and folder not in failed:
+                  folders.append(folder)
+         for folder in folders:
+            remove(folder)
+
+      return on_done
+
+   def _clear_local_snapshot(self, snap_name):
+      """
+      Remove a local snapshot with nodetool
 
-      # Check permissions
-      os.chdir(src_path)
-      if not os.access(file, os.R_OK):
-         self.logger.error("Can't read %s, check if file exists and permissions" % file)
+      :type snap_name: str
+      :rtype: bool
+      """
+      self.logger.info('Clearing local snapshot %s' % snap_name)
+      try:
+         result = subprocess.Popen(['nodetool', 'clearsnapshot', '-t', snap_name], stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, universal_newlines=True)
+         out, _ = result.communicate()
+      except OSError as e:
+         self.logger.error('Could not clear local snapshot %s: %s' % (snap_name, e))
          return False
+      if result.returncode != 0:
+         self.logger.error('Could not clear local snapshot %s: %s' % (snap_name, out.strip()))
+         return False
+      return True
 
-      # Build URL
-      url = ''.join([self.hadoop_url, self.hadoop_dest_dir, '/', dst_path, '/', file, '?op=CREATE&overwrite=true'])
-
-      try_con = 0
-      while try_con < 3:
+   def _get_backup_files(self):
+      """
+      Get the complete SSTables hardlinked by Cassandra incremental backups.
+      An SSTable is complete once all the components listed in its TOC are
+      in the backups folder.
 
-         try:
+      :return: list of backups folders, dict of file path (keyspace/table/file) -> local path,
+               list of SSTables as lists of file paths
+      :rtype: tuple
+      """
+      folders = []
+      files = {}
+      sstables = []
+      tables_list = self._get_tables_list(self._get_keyspaces_list())
+      for data_dir in self.data_dirs:
+         for table in tables_list:
+            backups = '/'.join([data_dir, table, 'backups'])
+            try:
+               names = set(e.name for e in os.scandir(backups) if e.is_file())
+            except OSError:
+               continue
+            folders.append(backups)
+
+            for toc in sorted(n for n in names if n.endswith('-TOC.txt')):
+               prefix = toc[:-len('TOC.txt')]
+               try:
+                  with open('/'.join([backups, toc])) as f:
+                     components = set(prefix + c.strip() for c in f if c.strip())
+               except (IOError, ValueError):
+                  continue
+               components.add(toc)
+               if components <= names:
+                  sstable = ['/'.join([table, name]) for name in sorted(components)]
+                  for path, name in zip(sstable, sorted(components)):
+                     files[path] = '/'.join([backups, name])
+                  sstables.append(sstable)
+      return folders, files, sstables
+
+   def _append_to_hadoop(self, path, content):
+      """
+      Append content to a file in Hadoop, creating it if it does not exist
 
-            if try_con == 4:
-               return False
+      :param path: file path relative to the destination folder
+      :type path: str
+      :type content: bytes
+      :rtype: bool
+      """
+      try:
+         self.storage.append(path, content)
+      except StorageError as e:
+         self.logger.error("Could not append to %s: %s" % (path, e))
+         return False
+      return True
 
-            r = self.session.put(url, auth=self.auth)
-            #self.logger.debug("Pushing: %s" % url)
+   def ship_backups(self):
+      """
+      Upload the SSTables of Cassandra incremental backups, record them in
+      the metadata file of the day and remove the local hardlinks of an
+      SSTable once both are confirmed for all its components
 
-            if r.status_code == 500:
-               with open(file, 'rb') as f:
-                  action = self.session.put(r.url, data=f, auth=self.auth, headers=headers)
+      :return: backups folders to watch
+      :rtype: list
+      """
+      folders, files, sstables = self._get_backup_files()
+      if not files:
+         return folders
 
-               if action.status_code == 201:
-                  return True
+      sizes = dict((table, os.path.getsize(local)) for table, local in files.items())
+      for table in files:
+         self.metrics.add('discovered', size=sizes[table])
+      self.logger.info('Shipping %d incremental backup files' % len(files))
 
-               self.logger.error("Failed to push table %s: %s" % (url, str(action.status_code)))
-               try_con += 1
-            else:
-               try_con += 1
+      with self.metrics.phase('upload'):
+         uploaded = self._push_tables_to_hadoop(files, 'incr_%d' % int(time.time() * 1000), sizes)
+      if not uploaded:
+         return folders
 
-         except IndexError as e:
-            self.logger.error("Could not upload %s: %s" % (table, e))
+      lines = ''.join('\t'.join([t, str(sizes[t]), uploaded[t]]) + '\n' for t in sorted(uploaded))
+      today = datetime.datetime.now().strftime('%Y_%m_%d')
+      meta_folder = '/'.join([self.meta_dir, self.cluster_name, self.incremental_dir, self.hostname])
+      with self.metrics.phase('metadata'):
+         self._hadoop_create_folders([meta_folder])
+         if not self._append_to_hadoop('/'.join([meta_folder, 'cass_incr_' + today]), lines.encode('utf-8')):
+            # Files will be sent again with the next metadata update
+            return folders
+
+      # Partially shipped SSTables are kept whole and sent again with the next scan
+      for sstable in sstables:
+         if not all(table in uploaded for table in sstable):
+            continue
+         for table in sstable:
+            try:
+               os.remove(files[table])
+            except OSError as e:
+               self.logger.warning('Could not remove backup hardlink %s: %s' % (files[table], e))
+      return folders
 
-   def _push_tables_to_hadoop(self, tables_list):
+   def follow_backups(self, poll_interval=10, settle=2):
       """
-      Push tables in the list to Hadoop cluster. This will use the cluster name
-      as well and create a dedicated folder for it, just in case you're using
-      the same Hadoop account for several cassandra clusters.
-
-      :type tables_list: list
+      Ship Cassandra incremental backups continuously, until stopping is set.
+      Backups folders are watched with inotify when available and scanned at
+      least every poll_interval seconds.
+
+      :param poll_interval: maximum seconds between two scans
+      :type poll_interval: float
+      :param settle: seconds to wait after a change, letting Cassandra link
+                     all the components of a flushed SSTable
+      :type settle: float
       """
+      self.metrics.action = 'follow'
+      self.logger.info('Following incremental backups of %s' % ', '.join(self.data_dirs))
+      watcher = BackupWatcher(logger=self.logger.name)
+      try:
+         while not self.stopping.is_set():
+            try:
+               folders = self.ship_backups()
+            except Exception as e:
+               self.logger.error('Could not ship incremental backups: %s' % e)
+               folders = []
+            for folder in folders:
+               watcher.watch(folder)
+            if watcher.wait(poll_interval) and not self.stopping.is_set():
+               self.stopping.wait(settle)
+      finally:
+         watcher.close()
+
+   def archive_commitlog(self, path):
+      """
+      Ship a commitlog segment to Hadoop, gzip compressed, and add it to the
+      segments index of the node. Meant to be run by Cassandra for each
+      segment, from commitlog_archiving.properties:
+      archive_command=/usr/bin/cassnap_manage.py --archive_commitlog %path
 
-      # Create mandatory folders to manage snapshots
-      self.logger.debug('Creating mandatory folders in hadoop if do not exist')
-      self._hadoop_create_folders([self.cluster_name, self.meta_dir])
-
-      # Create Cassandra folders from Cassandra snapshot tables list
-      self.logger.debug('Creating cassandra snapshot folder in hadoop if do not exist')
-      folders = ['/'.join([self.cluster_name, os.path.dirname(table)]) for table in tables_list]
-      self._hadoop_create_folders(list(set(folders)))
+      :param path: commitlog segment
+      :type path: str
+      :rtype: bool
+      """
+      name = os.path.basename(path)
+      folder = '/'.join([self.cluster_name, self.commitlog_dir, self.hostname])
+      segment_id = re.search(r'(\d+)\.log$', name)
 
-      # Push sstables to Hadoop
-      self.logger.info('Pushing snapshot tables to hadoop, please wait...')
-      failed_tables = [table for table in tables_list
-                       if not self._push_file_to_hadoop('/'.join([self.cassandra_data_path, table]),
-                                                        '/'.join([self.cluster_name, os.path.dirname(table)]))]
-      self.logger.debug("There are %d tables which could not be uploaded" % len(failed_tables))
+      # Segments are compressed by chunks to a temporary file, each upload attempt reads it again
+      with tempfile.NamedTemporaryFile(prefix='cass_commitlog_', suffix='.gz') as compressed:
+         try:
+            st = os.stat(path)
+            with open(path, 'rb') as f, gzip.GzipFile(name, 'wb', 1, compressed) as z:
+               shutil.copyfileobj(f, z, 1024 * 1024)
+            size = compressed.tell()
+            compressed.flush()
+         except (IOError, OSError) as e:
+            self.logger.error("Could not read commitlog segment %s: %s" % (path, e))
+            return False
+
+         # Writes make missing parent folders
+         try:
+            self.storage.put(''.join([folder, '/', name, '.gz']), lambda: open(compressed.name, 'rb'))
+         except (StorageError, IOError) as e:
+            self.logger.error("Could not upload commitlog segment %s: %s" % (path, e))
+            return False
+      self.metrics.add('uploaded', size=size)
+
+      line = '\t'.join([name, segment_id.group(1) if segment_id else '0', str(int(st.st_mtime * 1000)),
+                        str(int(time.time() * 1000)), str(st.st_size), str(size)])
+      if not self._append_to_hadoop('/'.join([folder, 'segments.idx']), (line + '\n').encode('utf-8')):
+         return False
+      self.logger.debug("Commitlog segment %s archived (%d -> %d bytes)" % (name, st.st_size, size))
+      return True
 
-   def make_snapshot(self):
+   def follow_commitlog(self, archive_dir, poll_interval=10, settle=2):
       """
-      Performing Cassandra snapshot and pushing it to Hadoop
+      Ship commitlog segments written in an archive directory, for instance
+      by archive_command=/bin/ln %path /backup/commitlog/%name, until
+      stopping is set. Shipped segments are removed from the directory.
+
+      :param archive_dir: directory where Cassandra archives segments
+      :type archive_dir: str
+      :param poll_interval: maximum seconds between two scans
+      :type poll_interval: float
+      :param settle: seconds without modification before a segment is shipped
+      :type settle: float
       """
-      # Get local keyspaces and tables list
-      ks_list = self._get_keyspaces_list()
-      tables_list = self._get_tables_list(ks_list)
-
-      # Locally snapshot all keyspaces
+      self.metrics.action = 'commitlog'
+      self.logger.info('Following commitlog archives of %s' % archive_dir)
+      watcher = BackupWatcher(logger=self.logger.name)
+      watcher.watch(archive_dir)
       try:
-         self.logger.info('Start snapshoting')
-         result = subprocess.Popen('nodetool snapshot', shell=True, stdout=subprocess.PIPE)
-      except IndexError as e:
-         self.logger.critical("Error during snapshot request : %s" % e)
-         sys.exit(1)
+         while not self.stopping.is_set():
+            now = time.time()
+            try:
+               segments = sorted((e.name for e in os.scandir(archive_dir)
+                                  if e.is_file() and e.name.endswith('.log') and
+                                  now - e.stat().st_mtime >= settle),
+                                 key=lambda n: [int(x) for x in re.findall(r'\d+', n)])
+            except OSError as e:
+               self.logger.error('Could not scan %s: %s' % (archive_dir, e))
+               segments = []
+
+            for name in segments:
+               if self.stopping.is_set() or not self.archive_commitlog(os.path.join(archive_dir, name)):
+                  break
+               os.remove(os.path.join(archive_dir, name))
+            if watcher.wait(poll_interval) and not self.stopping.is_set():
+               self.stopping.wait(settle)
+      finally:
+         watcher.close()
+
+   def restore_commitlog(self, node, restore_dir, restore_point=None):
+      """
+      Download the commitlog segments of a node needed to replay mutations
+      up to a point in time: every segment last written before it, and the
+      segment being written at that time.
 
-      # Get snapshot name from nodetool result
-      for line in result.stdout:
-         if re.match('Snapshot directory:', line):
-            snap_name = re.match(r"Snapshot directory: (\d+)", line).group(1)
-            self.logger.debug("Snapshot name: %s" % snap_name)
-      try:
-         snap_name
-      except NameError:
-         self.logger.critical("Could not find snapshot name")
-         sys.exit(1)
+      :param node: Cassandra node, if None then current host
+      :param restore_dir: local destination directory
+      :param restore_point: point in time, as Cassandra restore_point_in_time
+                            ('YYYY:MM:DD HH:MM:SS', GMT), None for all segments
+      :rtype: bool
+      """
+      self.metrics.action = 'restore'
+      node = self.hostname if node is None else node
+      folder = '/'.join([self.cluster_name, self.commitlog_dir, node])
+      point = None
+      if restore_point is not None:
+         point = calendar.timegm(time.strptime(restore_point, '%Y:%m:%d %H:%M:%S')) * 1000
+
+      with self.metrics.phase('inventory'):
+         try:
+            content = self.storage.get('/'.join([folder, 'segments.idx']))
+         except StorageError as e:
+            self.logger.error('Could not get commitlog index of {0} : {1}'.format(node, e))
+            return False
+         if content is None:
+            self.logger.error('No commitlog archived for {0}'.format(node))
+            return False
+
+         segments = {}
+         for line in content.decode('utf-8').split('\n'):
+            fields = line.split('\t')
+            if len(fields) >= 3:
+               segments[fields[0]] = (int(fields[1]), int(fields[2]))
+      ordered = sorted(segments, key=lambda n: segments[n])
+
+      selected = []
+      for name in ordered:
+         selected.append(name)
+         if point is not None and segments[name][1] > point:
+            break
+
+      self.logger.info('Restoring {0} commitlog segment(s) of {1} in {2}'.format(len(selected), node, restore_dir))
+      if not os.path.isdir(restore_dir):
+         os.makedirs(restore_dir)
+
+      def download(name):
+         dest = os.path.join(restore_dir, name)
+         if not self._download_file_from_hadoop('/'.join([folder, name + '.gz']), dest + '.gz'):
+            self.metrics.add('failed')
+            return 1
+         with gzip.open(dest + '.gz', 'rb') as src, open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+         os.remove(dest + '.gz')
+         self.metrics.add('downloaded', size=os.path.getsize(dest))
+         return 0
+
+      with self.metrics.phase('download'):
+         with self._worker_pool() as pool:
+            failed = sum(pool.map(download, selected))
+      if failed:
+         self.logger.error('{0} commitlog segments could not be restored'.format(failed))
+         return False
 
-      # Generate a diff between last and current snap
-      last_snapshot = self._get_last_snapshot_file()
-      current_snap, snap_file = self._create_snapshot_file(snap_name, tables_list)
+      self.logger.info('Set in commitlog_archiving.properties: restore_directories={0}{1}'.format(
+         restore_dir, '' if restore_point is None else ' restore_point_in_time={0}'.format(restore_point)))
+      return True
 
-      if last_snapshot is None:
-         tables_to_upload = current_snap
-      else:
-         tables_to_upload = set(current_snap) - set(last_snapshot)
-      self.logger.debug("Tables changes before last snapshot: %d" % len( tables_to_upload))
+   def _download_file_from_hadoop(self, path, dest):
+      """
+      Download a file from Hadoop
+      :param path: file path in Hadoop
+      :param dest: local destination file
+      :rtype: bool
+      """
+      self.logger.debug('Downloading {0} to {1}'.format(path, dest))
 
-      # Send diff tables to hadoop
-      self._push_tables_to_hadoop(tables_to_upload)
+      tmp = dest + '.part'
+      try:
+         with open(tmp, 'wb') as f:
+            for chunk in self.storage.read(path):
+               f.write(chunk)
+         os.rename(tmp, dest)
+      except (StorageError, IOError, OSError) as e:
+         self.logger.error('Could not download {0} : {1}'.format(path, e))
+         return False
 
-      # Push metadata to hadoop
-      self.logger.info('Pushing metadata to hadoop')
-      self._hadoop_create_folders(['/'.join([self.meta_dir, self.cluster_name, self.hostname])])
-      self._push_file_to_hadoop(snap_file, '/'.join([self.meta_dir, self.cluster_name, self.hostname]))
+      return True
 
-   def restore_snapshot(self):
+   def _download_bundle_from_hadoop(self, location, members, restore_dir):
       """
-      Restore snapshot
-      :return:
+      Extract files from a bundle in Hadoop. The bundle index gives members
+      offset, then the span holding all requested members is read with a
+      single ranged OPEN.
+      :param location: bundle path relative to the cluster folder
+      :param members: list of file paths (keyspace/table/file) to extract
+      :param restore_dir: local destination directory
+      :return: list of files which could not be extracted
+      :rtype: list
+      """
+      path = '/'.join([self.cluster_name, location])
+      try:
+         index = self._get_bundle_index(location)
+      except (StorageError, ValueError) as e:
+         self.logger.error('Could not get bundle index {0} : {1}'.format(location, e))
+         return members
+
+      failed = [m for m in members if os.path.basename(m) not in index]
+      wanted = sorted((index[os.path.basename(m)][0], index[os.path.basename(m)][1], m)
+                      for m in members if os.path.basename(m) in index)
+      # Empty members are not part of the read span
+      for offset, size, member in wanted:
+         if size == 0:
+            open(os.path.join(restore_dir, member), 'wb').close()
+            self.metrics.add('downloaded')
+      wanted = [w for w in wanted if w[1] > 0]
+      if not wanted:
+         return failed
+
+      start = wanted[0][0]
+      end = max(offset + size for offset, size, member in wanted)
+      self.logger.debug('Extracting {0} files from {1} ({2} bytes)'.format(len(wanted), location, end - start))
+
+      pending = iter(wanted)
+      target = next(pending)
+      current = None
+      position = start
+      try:
+         for chunk in self.storage.read(path, start, end - start):
+            while chunk and target is not None:
+               if current is None:
+                  if position < target[0]:
+                     skip = min(len(chunk), target[0] - position)
+                     chunk = chunk[skip:]
+                     position += skip
+                     continue
+                  current = open(os.path.join(restore_dir, target[2]) + '.part', 'wb')
+               take = min(len(chunk), target[0] + target[1] - position)
+               current.write(chunk[:take])
+               chunk = chunk[take:]
+               position += take
+               if position == target[0] + target[1]:
+                  current.close()
+                  current = None
+                  dest = os.path.join(restore_dir, target[2])
+                  os.rename(dest + '.part', dest)
+                  self.metrics.add('downloaded', size=target[1])
+                  target = next(pending, None)
+      except (StorageError, IOError, OSError) as e:
+         self.logger.error('Could not download bundle {0} : {1}'.format(location, e))
+      finally:
+         if current is not None:
+            current.close()
+
+      if target is not None:
+         failed += [target[2]] + [w[2] for w in pending]
+      return failed
+
+   def restore_snapshot(self, node, date, restore_dir, incremental=False):
+      """
+      Download a snapshot from Hadoop into a local directory, with one
+      keyspace/table folder per table, ready to be moved to the data
+      directory or loaded with sstableloader
+      :param node: Cassandra node, if None then current host
+      :param date: snapshot date
+      :param restore_dir: local destination directory
+      :param incremental: also restore incremental backups shipped since the snapshot day
+      :rtype: bool
       """
+      self.metrics.action = 'restore'
+      snapshot = {
+         'node': self.hostname if node is None else node,
+         'date': date
+      }
+
+      with self.metrics.phase('inventory'):
+         files = self._get_snapshot_metadata(snapshot)
+         if files is not None and incremental:
+            backups = [i for i in self._get_incremental_manifests()
+                       if i['node'] == snapshot['node'] and i['date'] >= snapshot['date']]
+            manifests = [files]
+            for backup, backup_files in zip(backups, self._fetch_snapshots_metadata(backups)):
+               if backup_files is None:
+                  self.logger.error('Incremental backups {0} - {1} are unreadable'.format(backup['node'],
+                                                                                         backup['date']))
+                  return False
+               manifests.append(backup_files)
+            files = Manifest.union(manifests)
+      if files is None:
+         self.logger.error('Snapshot {0} - {1} does not exist'.format(snapshot['node'], snapshot['date']))
+         return False
+      bundles = {}
+      for path, (size, location) in files.items():
+         if location:
+            bundles.setdefault(location, []).append(path)
+      single_files = sorted(path for path, (size, location) in files.items() if not location)
+
+      self.logger.info('Restoring snapshot {0} - {1} ({2} files) in {3}'.format(snapshot['node'], snapshot['date'],
+                                                                                len(files), restore_dir))
+      for folder in files.dirs():
+         if not os.path.isdir(os.path.join(restore_dir, folder)):
+            os.makedirs(os.path.join(restore_dir, folder))
+
+      def download(path):
+         dest = os.path.join(restore_dir, path)
+         if self._download_file_from_hadoop('/'.join([self.cluster_name, path]), dest):
+            self.metrics.add('downloaded', size=os.path.getsize(dest))
+            return 0
+         self.metrics.add('failed')
+         return 1
+
+      def extract(location):
+         failed_members = self._download_bundle_from_hadoop(location, bundles[location], restore_dir)
+         self.metrics.add('failed', files=len(failed_members))
+         return len(failed_members)
+
+      with self.metrics.phase('download'):
+         with self._worker_pool() as pool:
+            failed = sum(pool.map(extract, sorted(bundles)))
+            failed += sum(pool.map(download, single_files))
+
+      if failed:
+         self.logger.error('{0} files could not be restored'.format(failed))
+         return False
+
+      self.logger.info('Snapshot {0} - {1} successfully restored'.format(snapshot['node'], snapshot['date']))
+      return True
 
-   def _delete_file_in_hadoop(self, path):
+   def _delete_file_in_hadoop(self, path, recursive=False):
       """
       Delete a file in Hadoop
       :param path: file path
+      :param recursive: delete a directory and all its content
       :rtype: bool
       """
 
-      self.logger.debug('Deleting file {0} in Hadoop'.format(path))
+      self.logger.debug('Deleting {0} {1} in Hadoop'.format('directory' if recursive else 'file', path))
 
-      url = ''.join([self.hadoop_url, self.hadoop_dest_dir, '/', path, '?op=DELETE'])
-      self.logger.debug('used url: {0}'.format(url))
+      try:
+         self.storage.delete(path, recursive)
+      except StorageError as e:
+         self.logger.error('Could not delete {0} : {1}'.format(path, e))
+         return False
+      return True
 
-      try_con = 0
-      while try_con < 3:
-         r = self.session.delete(url, auth=self.auth)
-         if r.status_code == 500:
-            action = self.session.delete(r.url, auth=self.auth)
-            if action.status_code == 200:
-               return True
-         else:
-            self.logger.error('Could not delete file {0} : {1}'.format(url, action.status_code))
-         try_con += 1
+   def _list_hadoop_dir(self, path):
+      """
+      List a directory in Hadoop
+      :param path: directory path
+      :return: names of the directory entries, None if it can't be listed
+      :rtype: set
+      """
+      listing = self._stat_hadoop_dir(path)
+      return set(listing) if listing is not None else None
 
-      if try_con >= 3:
-         self.logger.error('Could not delete file {0}'.format(url))
+   def _stat_hadoop_dir(self, path, missing=None):
+      """
+      List a directory in Hadoop with the size of its entries
+      :param path: directory path
+      :param missing: value returned if the directory does not exist
+      :return: dict of entry name -> size, None if it can't be listed
+      :rtype: dict
+      """
+      try:
+         listing = self.storage.list(path)
+      except StorageError as e:
+         self.logger.warning('Could not list {0} : {1}'.format(path, e))
+         return None
 
-      return False
+      if listing is None:
+         return missing
+      return dict((name, status['size']) for name, status in listing.items())
 
    def _get_all_snapshots(self):
       """
@@ -615,23 +4235,38 @@ class ManageSnapshot:
 
       result = []
 
-      def node_snapshots(url, node_name):
+      def node_snapshots(path, node_name):
          """
          List available snapshots for a specific node
-         :param url: Hadoop url to metadata dir node
+         :param path: metadata dir of the cluster
          :param node_name: the node name to look on
          """
-         snapshots_json = self._ask_hadoop(''.join([url, '/', node_name, '?op=liststatus']))
-         for s in snapshots_json['FileStatuses']['FileStatus']:
-            snap_date = re.sub('cass_snap_', r'', s['pathSuffix'])
+         for name in sorted(self._ask_hadoop('/'.join([path, node_name]))):
+            snap_date = re.sub('cass_snap_', r'', name)
             result.append({'node': node_name, 'date': snap_date})
 
       # Get list of available Cassandra nodes
-      url = '/'.join([self.hadoop_url, self.hadoop_dest_dir, self.meta_dir, self.cluster_name])
-      nodes_json = self._ask_hadoop(url + '?op=liststatus')
-      for s in nodes_json['FileStatuses']['FileStatus']:
-         node_snapshots(url, s['pathSuffix'])
+      path = '/'.join([self.meta_dir, self.cluster_name])
+      for name in sorted(self._ask_hadoop(path)):
+         if not name.startswith('_'):
+            node_snapshots(path, name)
+
+      return result
 
+   def _get_incremental_manifests(self):
+      """
+      Returns all incremental backups metadata files from Hadoop, one per node and day
+      :rtype: list
+      """
+      base = '/'.join([self.meta_dir, self.cluster_name, self.incremental_dir])
+      nodes = self._list_hadoop_dir(base) or set()
+      with self._worker_pool() as pool:
+         listings = list(pool.map(self._list_hadoop_dir, ['/'.join([base, n]) for n in sorted(nodes)]))
+
+      result = []
+      for node, names in zip(sorted(nodes), listings):
+         for name in sorted(names or ()):
+            result.append({'node': node, 'date': re.sub('cass_incr_', r'', name), 'incremental': True})
       return result
 
    def _is_snapshot_equal(self, snapshot1, snapshot2):
@@ -643,38 +4278,199 @@ class ManageSnapshot:
       """
       return snapshot1['node'] == snapshot2['node'] and snapshot1['date'] == snapshot2['date']
 
-   def _snapshot_exists(self, snapshot):
+   def _snapshot_exists(self, snapshot, all_snapshots=None):
         """
         Checks if a snaphost exists in Hadoop
         :param snapshot: snapshot to check existence
+        :param all_snapshots: already fetched snapshots list, fetched from Hadoop if None
         :rtype: bool
         """
-        all_snapshots = self._get_all_snapshots()
-        match = filter(lambda x: self._is_snapshot_equal(snapshot, x), all_snapshots)
+        if all_snapshots is None:
+           all_snapshots = self._get_all_snapshots()
+
+        return any(self._is_snapshot_equal(snapshot, x) for x in all_snapshots)
 
-        return match != []
+   def _get_metadata_path(self, snapshot):
+      """
+      Get the path of the metadata file of a snapshot or of an incremental backups day
+      :param snapshot: snapshot, with 'incremental' set for incremental backups
+      :rtype: str
+      """
+      if snapshot.get('incremental'):
+         return ''.join([self.meta_dir, '/', self.cluster_name, '/', self.incremental_dir, '/', snapshot['node'],
+                         '/', 'cass_incr_', snapshot['date']])
+      return ''.join([self.meta_dir, '/', self.cluster_name, '/', snapshot['node'], '/', 'cass_snap_',
+                      snapshot['date']])
 
    def _get_snapshot_metadata(self, snapshot):
       """
-      Get metadata for a snapshot
+      Get metadata for a snapshot. Metadata files of past days do not change
+      anymore and are cached for the next runs of a long-running process.
       :param snapshot: snapshot to get metadata
-      :rtype: set
+      :return: file path -> (size, bundle location)
+      :rtype: Manifest
       """
       self.logger.debug('Getting metadata for snapshot {0} - {1}'.format(snapshot['node'], snapshot['date']))
 
-      url = ''.join([self.hadoop_url, self.hadoop_dest_dir, '/', self.meta_dir, '/', self.cluster_name, '/',
-                     snapshot['node'], '/', 'cass_snap_', snapshot['date'], '?op=OPEN'])
+      path = self._get_metadata_path(snapshot)
+      cached = self._metadata_cache.get(path)
+      if cached is not None:
+         return cached
 
-      self.logger.debug('used url: {0}'.format(url))
-
-      r = self.session.get(url, auth=self.auth)
+      try:
+         content = self.storage.get(path)
+      except StorageError as e:
+         self.logger.warning('Could not get metadata file : {0}'.format(e))
+         return None
 
-      if r.status_code == 200:
-         return set(r._content.split('\n'))
+      if content is not None:
+         files = self._parse_snapshot_file(content.decode('utf-8'))
+         if snapshot['date'] < datetime.datetime.now().strftime('%Y_%m_%d'):
+            self._metadata_cache.put(path, files)
+         return files
       else:
-         self.logger.warn('Could not get metadata file : {0}'.format(r.status_code))
+         self.logger.warn('Could not get metadata file : {0} does not exist'.format(path))
          return None
 
+   def _fetch_snapshots_metadata(self, snapshots):
+      """
+      Get metadata of several snapshots concurrently
+      :param snapshots: list of snapshots
+      :rtype: list
+      """
+      with self._worker_pool() as pool:
+         return list(pool.map(self._get_snapshot_metadata, snapshots))
+
+   def _bulk_delete_in_hadoop(self, paths, referenced_dirs=()):
+      """
+      Delete a large set of files in Hadoop, concurrently by batches. Table
+      directories are shared by the nodes of the cluster and may get new
+      files at any time, so they are never deleted recursively: directories
+      left empty are removed with a plain DELETE, which fails on a directory
+      which is not.
+      :param paths: list of files path
+      :param referenced_dirs: directories known to hold files to keep
+      :return: list of files which could not be deleted
+      :rtype: list
+      """
+      def delete_batch(batch):
+         return [path for path in batch if not self._delete_file_in_hadoop(path)]
+
+      paths = sorted(paths)
+      batches = [paths[i:i + self.delete_batch_size] for i in range(0, len(paths), self.delete_batch_size)]
+      failed = []
+      with self.metrics.phase('delete_files'), self._worker_pool() as pool:
+         for result in pool.map(delete_batch, batches):
+            failed += result
+
+      def delete_dir(directory):
+         try:
+            self.storage.delete(directory)
+         except StorageError as e:
+            self.logger.debug('Keeping directory {0}: {1}'.format(directory, e))
+            return False
+         return True
+
+      # Directories holding files to keep, and their parents, are not empty
+      kept = set()
+      for directory in set(referenced_dirs) | set(os.path.dirname(path) for path in failed):
+         while directory:
+            kept.add(directory)
+            directory = os.path.dirname(directory)
+      directories = set(os.path.dirname(path) for path in paths) - kept
+      removed = 0
+      with self.metrics.phase('delete_dirs'):
+         while directories:
+            # Deepest first, a parent is tried once the subdirectories emptied by the deletion are removed
+            depth = max(d.count('/') for d in directories)
+            level = sorted(d for d in directories if d.count('/') == depth)
+            with self._worker_pool() as pool:
+               deleted = [d for d, ok in zip(level, pool.map(delete_dir, level)) if ok]
+            removed += len(deleted)
+            # Top level folders (cluster, metadata) are never removed
+            directories = (directories - set(level)) | set(os.path.dirname(d) for d in deleted
+                                                           if '/' in os.path.dirname(d)) - kept
+      self.logger.debug('Deleted {0} files and {1} empty directories'.format(len(paths) - len(failed), removed))
+
+      return failed
+
+   def _expire_snapshots(self, expired, all_snapshots):
+      """
+      Delete several snapshots in Hadoop in one pass. Files still referenced
+      by a kept snapshot are left in place. Incremental backups older than
+      the oldest kept snapshot of their node can't be restored anymore and
+      are deleted as well, the other ones keep their files.
+      :param expired: snapshots to delete
+      :param all_snapshots: all snapshots available in Hadoop
+      :rtype: bool
+      """
+      expired_keys = set((s['node'], s['date']) for s in expired)
+
+      oldest_kept = {}
+      for snapshot in all_snapshots:
+         if (snapshot['node'], snapshot['date']) not in expired_keys:
+            oldest_kept[snapshot['node']] = min(snapshot['date'], oldest_kept.get(snapshot['node'], snapshot['date']))
+
+      expired_objects = []
+      referenced_objects = []
+      deletable = []
+      with self.metrics.phase('inventory'):
+         incrementals = self._get_incremental_manifests()
+         expired_incrementals = [i for i in incrementals if i['date'] < oldest_kept.get(i['node'], i['date'])]
+         expired_keys.update((i['node'], i['date'], True) for i in expired_incrementals)
+         manifests = all_snapshots + incrementals
+         all_metadata = self._fetch_snapshots_metadata(manifests)
+      for snapshot, files in zip(manifests, all_metadata):
+         key = (snapshot['node'], snapshot['date'], True) if snapshot.get('incremental') else \
+            (snapshot['node'], snapshot['date'])
+         if files is None:
+            # Files of the snapshot are unknown, any of them could be deleted
+            self.logger.critical('Metadata of {0} snapshot {1} - {2} are unreadable, aborting deletion'.format(
+               'expired' if key in expired_keys else 'kept', snapshot['node'], snapshot['date']))
+            return False
+         if key in expired_keys:
+            expired_objects.append(files.objects())
+            deletable.append(snapshot)
+         else:
+            referenced_objects.append(files.objects())
+
+      referenced_files = Manifest.union(referenced_objects)
+      to_delete_files = list(Manifest.union(expired_objects).difference(referenced_files))
+      self.logger.info('{0} files to delete for {1} snapshot(s)'.format(len(to_delete_files), len(deletable)))
+
+      if self.dry_run:
+         # Bundles are accounted with the size of their members
+         sizes = {}
+         bundles = {}
+         for snapshot, files in zip(manifests, all_metadata):
+            if snapshot in deletable:
+               for path, (size, location) in files.items():
+                  if location:
+                     bundles.setdefault(location, {})[path] = size or 0
+                  else:
+                     sizes[path] = size or 0
+         for location, members in bundles.items():
+            sizes[location] = sum(members.values())
+         self._report_plan('delete', dict((f, sizes.get(f, 0)) for f in to_delete_files))
+         return True
+
+      referenced_dirs = set('/'.join([self.cluster_name, d]) for d in referenced_files.dirs())
+      with self.metrics.phase('delete'):
+         failed = self._bulk_delete_in_hadoop(['/'.join([self.cluster_name, f]) for f in to_delete_files],
+                                              referenced_dirs)
+      self.metrics.add('deleted', files=len(to_delete_files) - len(failed))
+      self.metrics.add('failed', files=len(failed))
+      if failed:
+         # Keep metadata files so a next run will try again
+         self.logger.error('{0} files could not be deleted, keeping snapshots metadata'.format(len(failed)))
+         return False
+
+      self._forget_checksums(to_delete_files)
+      self._bulk_delete_in_hadoop([self._get_metadata_path(s) for s in deletable])
+      for s in deletable:
+         self._metadata_cache.pop(self._get_metadata_path(s))
+      return len([s for s in deletable if not s.get('incremental')]) == len(expired)
+
    def flush_snapshot(self, node, date):
       """
       Delete a snaphot in Hadoop
@@ -688,47 +4484,421 @@ class ManageSnapshot:
          'date': date
       }
 
-      if not self._snapshot_exists(snapshot):
+      all_snapshots = self._get_all_snapshots()
+      if not self._snapshot_exists(snapshot, all_snapshots):
           self.logger.error('Snapshot {0} - {1} does not exist'.format(snapshot['node'], snapshot['date']))
           return False
 
       self.logger.info('Deleting snapshot {0} - {1}'.format(snapshot['node'], snapshot['date']))
 
-      snap_files = set()
-      all_other_files = set()
-      for item in self._get_all_snapshots():
-         if self._is_snapshot_equal(snapshot, item):
-            snap_files = self._get_snapshot_metadata(item)
-         else:
-            all_other_files = all_other_files.union(self._get_snapshot_metadata(item))
+      if not self._expire_snapshots([snapshot], all_snapshots):
+         self.logger.error('Snapshot {0} - {1} could not be deleted'.format(snapshot['node'], snapshot['date']))
+         return False
+      if self.dry_run:
+         return True
 
-      to_delete_files = snap_files - all_other_files
+      self.logger.info('Snapshot {0} - {1} successfully deleted'.format(snapshot['node'], snapshot['date']))
+      return True
+
+   def apply_retention(self, policy):
+      """
+      Expire in one pass all the snapshots in Hadoop not kept by a retention policy
+      :param policy: retention policy to apply
+      :type policy: RetentionPolicy
+      :rtype: bool
+      """
+      if policy.is_empty():
+         self.logger.error('No retention rule defined, nothing to expire')
+         return False
 
-      for file in to_delete_files:
-         self._delete_file_in_hadoop('/'.join([self.cluster_name, file]))
+      self.logger.info('Applying retention policy ({0} scope)'.format(policy.scope))
+      all_snapshots = self._get_all_snapshots()
+      expired = policy.select_expired(all_snapshots)
 
-      self._delete_file_in_hadoop(''.join([self.meta_dir, '/', self.cluster_name, '/', snapshot['node'], '/',
-                                  'cass_snap_', snapshot['date']]))
+      if not expired:
+         self.logger.info('No snapshot to expire')
+         return True
 
-      self.logger.info('Snapshot {0} - {1} successfully deleted'.format(snapshot['node'], snapshot['date']))
+      for snapshot in expired:
+         self.logger.info('Expiring snapshot {0} - {1}'.format(snapshot['node'], snapshot['date']))
+
+      if not self._expire_snapshots(expired, all_snapshots):
+         self.logger.error('Retention policy could not be fully applied')
+         return False
+      if self.dry_run:
+         return True
+
+      self.logger.info('{0} snapshot(s) successfully expired'.format(len(expired)))
       return True
 
+   def _get_checksums_path(self, directory):
+      """
+      Get the path of the checksums recorded by the verifications for the
+      files of a directory. Files are shared by the snapshots of the cluster,
+      so are their checksums.
+      :param directory: directory relative to the cluster folder
+      :rtype: str
+      """
+      return '/'.join([self.meta_dir, self.cluster_name, self.verify_dir, directory, 'checksums.tsv'])
+
+   def _get_recorded_checksums(self, directory):
+      """
+      Get the checksums recorded by the verifications for the files of a
+      directory. Lines are only appended: a later line of a file replaces the
+      previous ones, a line without checksum forgets it.
+      :param directory: directory relative to the cluster folder
+      :return: dict of file path -> checksum
+      :rtype: dict
+      """
+      content = self.storage.get(self._get_checksums_path(directory)) or b''
+      checksums = {}
+      for line in content.decode('utf-8').split('\n'):
+         path, tab, value = line.partition('\t')
+         if not tab:
+            continue
+         if value:
+            checksums[path] = value
+         else:
+            checksums.pop(path, None)
+      return checksums
+
+   def _forget_checksums(self, paths):
+      """
+      Forget the recorded checksums of deleted files, a file uploaded again
+      later under the same path gets a new one. Checksums files are shared
+      by the nodes of the cluster, so lines forgetting them are appended
+      rather than the file rewritten. A checksums file is only deleted with
+      its directory, no file is left to verify in it.
+      :param paths: deleted file paths relative to the cluster folder
+      :type paths: list
+      """
+      directories = {}
+      for path in paths:
+         directories.setdefault(os.path.dirname(path), set()).add(path)
+
+      def forget(directory):
+         checksums_path = self._get_checksums_path(directory)
+         try:
+            checksums = self._get_recorded_checksums(directory)
+            forgotten = sorted(directories[directory].intersection(checksums))
+            if not forgotten:
+               return
+            if self.storage.list('/'.join([self.cluster_name, directory])) is None:
+               self.storage.delete(checksums_path)
+            else:
+               self.storage.append(checksums_path, ''.join(path + '\t\n' for path in forgotten).encode('utf-8'))
+         except StorageError as e:
+            self.logger.warning('Could not remove checksums of deleted files in {0}: {1}'.format(directory, e))
+
+      with self._worker_pool() as pool:
+         list(pool.map(forget, sorted(directories)))
+
+   def _get_file_checksum(self, path):
+      """
+      Get the checksum of a file computed by the storage, like the HDFS one
+      computed by the datanodes from the block checksums: reading it fails
+      if a block can't be read
+      :param path: file path relative to the cluster folder
+      :rtype: str
+      """
+      return self.storage.checksum('/'.join([self.cluster_name, path]))
+
+   def _get_bundle_index(self, location):
+      """
+      Get the index of a bundle
+      :param location: bundle path relative to the cluster folder
+      :return: dict of member name -> [offset, size]
+      :rtype: dict
+      """
+      content = self.storage.get('/'.join([self.cluster_name, location + '.idx']))
+      if content is None:
+         raise StorageError('index of {0} does not exist'.format(location))
+      return json.loads(content.decode('utf-8'))
+
+   def verify_snapshot(self, snapshot, sample=0, limiter=None, listings=None):
+      """
+      Check that the files of a snapshot are in Hadoop and restorable. Files
+      existence and size are checked with one LISTSTATUS per directory, and
+      bundle indexes must describe all their members within the bundle. A
+      sample of the files also get their HDFS checksum compared to the one
+      recorded by the first verification which checked them.
+
+      :param snapshot: snapshot to verify
+      :param sample: percentage of the files whose checksum is checked
+      :type sample: float
+      :param limiter: rate limiter of the Hadoop requests
+      :type limiter: RateLimiter
+      :param listings: directory listings cache shared by the verifications of a run
+      :type listings: dict
+      :return: verification report
+      :rtype: dict
+      """
+      limiter = limiter if limiter is not None else RateLimiter()
+      listings = listings if listings is not None else {}
+      start = time.time()
+      report = {'node': snapshot['node'], 'date': snapshot['date'], 'files': 0, 'objects': 0, 'checksummed': 0,
+                'missing': [], 'size_mismatch': [], 'checksum_mismatch': [], 'bundle_errors': [], 'errors': []}
+
+      files = self._get_snapshot_metadata(snapshot)
+      if files is None:
+         report['errors'].append({'path': self._get_metadata_path(snapshot), 'error': 'unreadable metadata'})
+         report['ok'] = False
+         return report
+      objects = files.objects()
+      report['files'] = len(files)
+      report['objects'] = len(objects)
+      self.metrics.add('discovered', files=len(objects))
+
+      def limited(function):
+         def call(*args):
+            limiter.wait()
+            return function(*args)
+         return call
+
+      # Existence and size, with a listing per directory
+      directories = sorted(d for d in objects.dirs() if d not in listings)
+      with self._worker_pool() as pool:
+         for directory, listing in zip(directories, pool.map(
+               limited(lambda d: self._stat_hadoop_dir('/'.join([self.cluster_name, d]), missing={})), directories)):
+            listings[directory] = listing
+      present = []
+      for path, (size, location) in objects.items():
+         directory, _, name = path.rpartition('/')
+         listing = listings[directory]
+         if listing is None:
+            report['errors'].append({'path': path, 'error': 'directory could not be listed'})
+         elif name not in listing:
+            report['missing'].append(path)
+         elif size is not None and listing[name] != size:
+            report['size_mismatch'].append({'path': path, 'expected': size, 'actual': listing[name]})
+         else:
+            present.append(path)
+
+      # Bundle indexes
+      bundles = {}
+      for path, (size, location) in files.items():
+         if location:
+            bundles.setdefault(location, []).append((path, size))
+      present_set = set(present)
+      checked_bundles = sorted(b for b in bundles if b in present_set and b + '.idx' in present_set)
+
+      def check_bundle(location):
+         try:
+            index = self._get_bundle_index(location)
+         except (StorageError, ValueError) as e:
+            return [{'path': location, 'error': 'unreadable index: {0}'.format(e)}]
+         directory, _, name = location.rpartition('/')
+         length = listings[directory][name]
+         errors = []
+         for member, size in bundles[location]:
+            entry = index.get(os.path.basename(member))
+            if entry is None:
+               errors.append({'path': location, 'member': member, 'error': 'not in index'})
+            elif entry[0] + entry[1] > length or (size is not None and entry[1] != size):
+               errors.append({'path': location, 'member': member, 'error': 'index entry out of bundle'})
+         return errors
+
+      with self._worker_pool() as pool:
+         for errors in pool.map(limited(check_bundle), checked_bundles):
+            report['bundle_errors'] += errors
+
+      # Checksums of a sample, against the ones recorded by previous verifications of any snapshot
+      count = int(math.ceil(len(present) * min(sample, 100) / 100.0)) if sample > 0 else 0
+      if count:
+         sampled = random.sample(present, count)
+         baseline = {}
+         unreadable = set()
+
+         def recorded_checksums(directory):
+            try:
+               return directory, self._get_recorded_checksums(directory)
+            except (StorageError, ValueError) as e:
+               self.logger.warning('Could not read checksums of previous verifications in {0}: {1}'.format(
+                  directory, e))
+               return directory, None
+
+         with self._worker_pool() as pool:
+            for directory, checksums in pool.map(limited(recorded_checksums),
+                                                 sorted(set(os.path.dirname(p) for p in sampled))):
+               if checksums is None:
+                  unreadable.add(directory)
+               else:
+                  baseline.update(checksums)
+
+         def checksum(path):
+            try:
+               return path, self._get_file_checksum(path), None
+            except (StorageError, ValueError, KeyError) as e:
+               return path, None, str(e)
+
+         recorded = {}
+         with self._worker_pool() as pool:
+            for path, value, error in pool.map(limited(checksum), sampled):
+               report['checksummed'] += 1
+               if error is not None:
+                  report['errors'].append({'path': path, 'error': error})
+               elif path not in baseline:
+                  if os.path.dirname(path) not in unreadable:
+                     recorded.setdefault(os.path.dirname(path), []).append('\t'.join([path, value]) + '\n')
+               elif baseline[path] != value:
+                  report['checksum_mismatch'].append({'path': path, 'expected': baseline[path], 'actual': value})
+         for directory, lines in sorted(recorded.items()):
+            checksums_path = self._get_checksums_path(directory)
+            self._hadoop_create_folders([os.path.dirname(checksums_path)])
+            self._append_to_hadoop(checksums_path, ''.join(lines).encode('utf-8'))
+
+      failed = set(report['missing'])
+      failed.update(e['path'] for k in ('size_mismatch', 'checksum_mismatch', 'bundle_errors', 'errors')
+                    for e in report[k])
+      self.metrics.add('verified', files=len(objects) - len(failed))
+      self.metrics.add('failed', files=len(failed))
+      report['ok'] = not failed
+      report['duration'] = round(time.time() - start, 3)
+      level = logging.INFO if report['ok'] else logging.ERROR
+      self.logger.log(level, 'Snapshot {0} - {1}: {2} files, {3} missing, {4} size mismatches, {5} checksums '
+                             '({6} mismatches), {7} bundle errors, {8} errors'.format(
+         snapshot['node'], snapshot['date'], report['objects'], len(report['missing']), len(report['size_mismatch']),
+         report['checksummed'], len(report['checksum_mismatch']), len(report['bundle_errors']), len(report['errors'])))
+      return report
+
+   def verify_snapshots(self, node, date, scope='node', sample=0, rate=None, report_file=None):
+      """
+      Verify snapshots in Hadoop and write a JSON report
+      :param node: Cassandra node, if None then current host
+      :param date: snapshot date, 'latest' for the last snapshot of each node
+      :param scope: 'node' to verify the snapshot of a node, 'cluster' for
+                    the snapshots of all the nodes at this date
+      :param sample: percentage of the files whose checksum is checked
+      :type sample: float
+      :param rate: maximum Hadoop requests per second, None for no limit
+      :type rate: float
+      :param report_file: file to write the JSON report to, stdout if None
+      :rtype: bool
+      """
+      self.metrics.action = 'verify'
+      node = self.hostname if node is None else node
+      with self.metrics.phase('inventory'):
+         candidates = [s for s in self._get_all_snapshots() if scope == 'cluster' or s['node'] == node]
+      if date == 'latest':
+         latest = {}
+         for s in candidates:
+            latest[s['node']] = max(s['date'], latest.get(s['node'], s['date']))
+         snapshots = [s for s in candidates if s['date'] == latest[s['node']]]
+      else:
+         snapshots = [s for s in candidates if s['date'] == date]
+      if not snapshots:
+         self.logger.error('No snapshot {0} to verify'.format(date))
+
+      limiter = RateLimiter(rate)
+      listings = {}
+      with self.metrics.phase('verify'):
+         reports = [self.verify_snapshot(s, sample, limiter, listings)
+                    for s in sorted(snapshots, key=lambda s: (s['node'], s['date']))]
+      result = {'ok': bool(reports) and all(r['ok'] for r in reports), 'sample': sample, 'snapshots': reports}
+
+      content = json.dumps(result, indent=2, sort_keys=True)
+      if report_file is None:
+         print(content)
+      else:
+         try:
+            with open(report_file, 'w') as f:
+               f.write(content + '\n')
+         except IOError as e:
+            self.logger.error('Could not write verification report {0}: {1}'.format(report_file, e))
+      return result['ok']
+
 
 class BlankLinesHelpFormatter (argparse.HelpFormatter):
    def _split_lines(self, text, width):
       return super()._split_lines(text, width) + ['']
 
+def restore_point_type(value):
+   """
+   Check a point in time given as Cassandra restore_point_in_time
+   :type value: str
+   :rtype: str
+   """
+   try:
+      time.strptime(value, '%Y:%m:%d %H:%M:%S')
+   except ValueError:
+      raise argparse.ArgumentTypeError('%s is not a "YYYY:MM:DD HH:MM:SS" time' % value)
+   return value
+
+def run_daemon(operation, arg):
+   """
+   Run the daemon jobs. Each job run gets its own metrics, written to the
+   metrics files suffixed with the job name.
+
+   :type operation: ManageSnapshot
+   :param arg: parsed command line arguments
+   """
+   policy = RetentionPolicy(arg.keep_daily, arg.keep_weekly, arg.keep_monthly, arg.max_age, arg.retention_scope)
+   actions = {
+      'snapshot': operation.make_snapshot,
+      'retention': lambda: operation.apply_retention(policy),
+      'verify': lambda: operation.verify_snapshots(arg.node, arg.verify or 'latest', arg.verify_scope,
+                                                   arg.verify_sample, arg.verify_rate, arg.verify_report),
+   }
+
+   def job_file(path, name):
+      if path is None:
+         return None
+      base, ext = os.path.splitext(path)
+      return ''.join([base, '_', name, ext])
+
+   def job(name):
+      def run():
+         operation.metrics = RunMetrics(action=name, progress_interval=arg.progress_interval,
+                                        profiler=operation.metrics.profiler, logger=operation.logger.name)
+         operation.retry_policy.reset()
+         try:
+            return actions[name]()
+         finally:
+            operation.metrics.finish(job_file(arg.metrics_file, name), job_file(arg.prometheus_textfile, name))
+      return run
+
+   schedules = {}
+   for item in arg.schedule or []:
+      name, _, expression = item.partition('=')
+      name = name.strip()
+      if name not in actions:
+         operation.logger.critical('Unknown daemon job %s, available jobs: %s' % (name, ', '.join(sorted(actions))))
+         sys.exit(1)
+      try:
+         schedules[name] = CronSchedule(expression.strip().strip('"\''))
+      except ValueError as e:
+         operation.logger.critical(str(e))
+         sys.exit(1)
+
+   jobs = dict((name, (schedules.get(name), job(name))) for name in actions)
+   daemon = Daemon(operation, jobs, arg.control_socket, logger=operation.logger.name)
+   signal.signal(signal.SIGTERM, lambda signum, frame: operation.stopping.set())
+   try:
+      daemon.run()
+   except KeyboardInterrupt:
+      operation.logger.info('Interrupted, stopping')
+
+
 def main():
    """
    Main - manage args
    """
 
+   # Answer without building the whole parser, monitoring probes call it often
+   if sys.argv[1:] in (['-V'], ['--version']):
+      print(' '.join([__version__, 'Licence GPLv2+']))
+      sys.exit(0)
+
    def args_validation(arg, arg_type='str'):
       try:
          if arg_type == 'str':
             return config.get('defaults', arg)
          elif arg_type == 'bool':
             return config.getboolean('defaults', arg)
+         elif arg_type == 'int':
+            return config.getint('defaults', arg)
+         elif arg_type == 'float':
+            return config.getfloat('defaults', arg)
       except:
          return None
 
@@ -749,8 +4919,10 @@ def main():
                        help='Keytab file path')
 
    # Cassandra
-   parser.add_argument('-p', '--cassandra_data_path', action='store', default='/var/lib/cassandra/data',
-                       metavar='CASSANDRA_DATA_PATH', help='Path to Cassandra data directory')
+   parser.add_argument('-p', '--cassandra_data_path', action='store', default=None, nargs='+',
+                       metavar='CASSANDRA_DATA_PATH', help='Paths to Cassandra data directories, data_file_directories'
+                                                           ' of the Cassandra configuration file or '
+                                                           '/var/lib/cassandra/data if not set')
    parser.add_argument('-n', '--cassandra_config', action='store', default='/etc/cassandra/conf/cassandra.yaml',
                        metavar='CASSANDRA_CONFIG', help='Path to Cassandra configuration file')
    # Todo: ignorer certaines tables (opscenter)
@@ -760,6 +4932,13 @@ def main():
                        help='HADOOP_URL')
    parser.add_argument('-e', '--hadoop_dest_dir', action='store', type=str, default=None, metavar='HADOOP_DEST_DIR',
                        help='HADOOP_DEST_DIR')
+   parser.add_argument('--storage', action='store', type=str, default='webhdfs', choices=STORAGES,
+                       help='Storage holding the snapshots: webhdfs (default), local (a local or NFS folder given by '
+                            '--hadoop_dest_dir) or s3 (--hadoop_dest_dir is /bucket/prefix, --hadoop_url the '
+                            'endpoint if not AWS)')
+
+   parser.add_argument('--cluster_name', action='store', type=str, default=None, metavar='CLUSTER_NAME',
+                       help='Cassandra cluster name, read from the Cassandra configuration file if not set')
 
    # Config
    parser.add_argument('-c', '--configuration_file', action='store', type=str,
@@ -770,17 +4949,128 @@ def main():
    parser.add_argument('-L', '--list_snaps', action='store_true', default=False, help='List available snapshots')
    parser.add_argument('-S', '--make_snapshot', action='store_true', default=False,
                        help='Make a snapshot and store it on Hadoop')
-   parser.add_argument('-R', '--restore_snapshot', action='store_true', default=False,
+   parser.add_argument('-R', '--restore_snapshot', action='store', type=str, default=None, metavar='SNAPSHOT',
                        help='Restore a snapshot from Hadoop from a date')
-   parser.add_argument('-C', '--clear_snapshot', action='store_false', default=False,
-                       help='Clear snapshot. If launched with -S option, it will be done after the snapshot transfer'
-                            'to Hadoop')
+   parser.add_argument('--restore_incremental', action='store_true', default=False,
+                       help='Also restore incremental backups shipped since the snapshot day')
+   parser.add_argument('-I', '--follow_backups', action='store_true', default=False,
+                       help='Ship Cassandra incremental backups continuously, until interrupted')
+   parser.add_argument('--backup_poll_interval', action='store', type=int, default=10, metavar='SECONDS',
+                       help='Maximum seconds between two scans of the backups folders')
+   parser.add_argument('--archive_commitlog', action='store', type=str, default=None, metavar='SEGMENT',
+                       help='Ship a commitlog segment, for archive_command in commitlog_archiving.properties')
+   parser.add_argument('--follow_commitlog', action='store', type=str, default=None, metavar='ARCHIVE_DIR',
+                       help='Ship commitlog segments archived in a directory continuously, until interrupted')
+   parser.add_argument('--restore_commitlog', action='store_true', default=False,
+                       help='Restore archived commitlog segments of a node (see --node) in --restore_dir')
+   parser.add_argument('--restore_point', action='store', type=restore_point_type, default=None, metavar='"YYYY:MM:DD HH:MM:SS"',
+                       help='Restore commitlog segments needed to replay up to this time (GMT)')
+   parser.add_argument('--restore_dir', action='store', type=str, default='/var/lib/cassandra/restore',
+                       metavar='RESTORE_DIR', help='Local directory where snapshots are restored')
+   parser.add_argument('-C', '--clear_snapshot', action='store_true', default=False,
+                       help='With -S, remove the local snapshot of each table as soon as it is uploaded to Hadoop, '
+                            'then clear the whole snapshot with nodetool')
    parser.add_argument('-F', '--flush_snapshot', action='store', type=str, default=None, metavar='SNAPSHOT',
                        help='Remove a snapshot on hadoop')
+   parser.add_argument('--verify', action='store', type=str, default=None, metavar='SNAPSHOT',
+                       help='Verify a snapshot in Hadoop ("latest" for the last one of each node)')
+   parser.add_argument('--verify_scope', action='store', type=str, default='node', choices=['node', 'cluster'],
+                       help='Verify the snapshot of the node (see -N) or of all the cluster nodes')
+   parser.add_argument('--verify_sample', action='store', type=float, default=0, metavar='PERCENT',
+                       help='Percentage of the files whose HDFS checksum is checked, 100 for a full verification')
+   parser.add_argument('--verify_rate', action='store', type=float, default=50, metavar='REQUESTS',
+                       help='Maximum Hadoop requests per second during verifications, 0 for no limit')
+   parser.add_argument('--verify_report', action='store', type=str, default=None, metavar='FILE',
+                       help='Write the JSON verification report to a file instead of stdout')
    parser.add_argument('-N', '--node', action='store', type=str, default=None, metavar='CASSANDRA_NODE',
-                       help='Cassandra node, works with --flush_snapshot')
-   parser.add_argument('-D', '--dry_run', action='store_false', default=True,
-                       help='Define if it should make snapshot or just dry run')
+                       help='Cassandra node, works with --flush_snapshot and --restore_snapshot')
+   parser.add_argument('-P', '--retention', action='store_true', default=False,
+                       help='Expire snapshots on Hadoop not kept by the retention policy')
+   parser.add_argument('-D', '--dry_run', action='store_true', default=False,
+                       help='Only print what a snapshot, flush or retention would upload or delete')
+   parser.add_argument('--plan_file', action='store', type=str, default=None, metavar='FILE',
+                       help='With --dry_run, also write the plan as JSON to a file')
+   parser.add_argument('--state_dir', action='store', type=str, default=os.path.expanduser('~/.cassnap'),
+                       metavar='DIR', help='Folder keeping state between runs, like the recent upload throughput, '
+                                           'empty to keep nothing')
+
+   # Retention policy
+   parser.add_argument('--keep_daily', action='store', type=int, default=None, metavar='DAYS',
+                       help='Number of daily snapshots to keep')
+   parser.add_argument('--keep_weekly', action='store', type=int, default=None, metavar='WEEKS',
+                       help='Number of weekly snapshots to keep')
+   parser.add_argument('--keep_monthly', action='store', type=int, default=None, metavar='MONTHS',
+                       help='Number of monthly snapshots to keep')
+   parser.add_argument('--max_age', action='store', type=int, default=None, metavar='DAYS',
+                       help='Expire snapshots older than this number of days')
+   parser.add_argument('--retention_scope', action='store', type=str, default='node', choices=['node', 'cluster'],
+                       help='Apply retention rules per node or on the whole cluster dates')
+
+   # Performance
+   parser.add_argument('--workers', action='store', type=int, default=8, metavar='WORKERS',
+                       help='Number of concurrent Hadoop requests for bulk operations')
+   parser.add_argument('--retries', action='store', type=int, default=5, metavar='ATTEMPTS',
+                       help='Maximum attempts for a single Hadoop request')
+   parser.add_argument('--retry_budget', action='store', type=int, default=500, metavar='RETRIES',
+                       help='Maximum number of retries for the whole run')
+   parser.add_argument('--connect_timeout', action='store', type=int, default=WebHdfsBackend.TIMEOUT[0],
+                       metavar='SECONDS', help='Seconds to wait for the connection of a storage request')
+   parser.add_argument('--read_timeout', action='store', type=int, default=WebHdfsBackend.TIMEOUT[1],
+                       metavar='SECONDS', help='Seconds without data sent or received before a storage request '
+                                               'is abandoned')
+   parser.add_argument('--slow_transfer_ratio', action='store', type=float, default=0.1, metavar='RATIO',
+                       help='Abandon and send again to another datanode writes running under this ratio of the median '
+                            'throughput, 0 to disable')
+   parser.add_argument('--slow_transfer_grace', action='store', type=int, default=5, metavar='SECONDS',
+                       help='Seconds before a write can be found slow')
+   parser.add_argument('--disk_readers', action='store', type=int, default=2, metavar='READERS',
+                       help='Number of concurrent uploads reading from a same physical disk')
+   parser.add_argument('--pack_small_files', action='store_true', default=False,
+                       help='Pack small SSTable components of a table in one bundle per snapshot')
+   parser.add_argument('--pack_threshold', action='store', type=int, default=4096, metavar='KB',
+                       help='Size under which SSTable components are packed, Data.db and Index.db never are')
+
+   # Cluster coordination
+   parser.add_argument('--coordinate', action='store_true', default=False,
+                       help='Coordinate the snapshot uploads of the cluster nodes with leases in Hadoop')
+   parser.add_argument('--max_concurrent_uploads', action='store', type=int, default=4, metavar='NODES',
+                       help='Maximum number of nodes uploading a snapshot at once')
+   parser.add_argument('--lease_ttl', action='store', type=int, default=600, metavar='SECONDS',
+                       help='Seconds before the upload lease of a crashed node expires')
+   parser.add_argument('--stagger_window', action='store', type=int, default=0, metavar='SECONDS',
+                       help='Spread the snapshot start times of the nodes over this window')
+   parser.add_argument('--coordination_timeout', action='store', type=int, default=3600, metavar='SECONDS',
+                       help='Maximum seconds waiting for an upload lease')
+   parser.add_argument('--replica_dedup', action='store_true', default=False,
+                       help='Only back up the keyspaces this node is elected for, one replica per token range')
+
+   # Metrics
+   parser.add_argument('--progress_interval', action='store', type=int, default=60, metavar='SECONDS',
+                       help='Seconds between two progress logs during uploads, 0 to disable')
+   parser.add_argument('--metrics_file', action='store', type=str, default=None, metavar='FILE',
+                       help='Write the JSON summary of the run to a file')
+   parser.add_argument('--prometheus_textfile', action='store', type=str, default=None, metavar='FILE',
+                       help='Write the metrics of the run to a Prometheus node exporter textfile')
+
+   # Profiling
+   parser.add_argument('--profile', action='store', type=str, default=None, metavar='FILE',
+                       help='Write a Chrome trace of the run phases and Hadoop requests to a file')
+   parser.add_argument('--profile_cpu', action='store', type=str, default=None, metavar='FILE',
+                       help='Run cProfile on all threads and write its statistics to a file')
+   parser.add_argument('--profile_memory', action='store_true', default=False,
+                       help='Trace Python memory allocations with tracemalloc')
+
+   # Daemon
+   parser.add_argument('--daemon', action='store_true', default=False,
+                       help='Run scheduled jobs (see --schedule) in a long-running process')
+   parser.add_argument('--schedule', action='append', type=str, default=None, metavar='JOB=CRON',
+                       help='Schedule a daemon job (snapshot, retention) with a cron expression, '
+                            'like snapshot="0 2 * * *"')
+   parser.add_argument('--control_socket', action='store', type=str,
+                       default=''.join([os.path.expanduser("~"), '/.cassnap.sock']), metavar='SOCKET',
+                       help='Daemon control socket path')
+   parser.add_argument('--ctl', action='store', type=str, nargs='+', default=None, metavar='COMMAND',
+                       help='Send a command to the daemon: status, run JOB or stop')
 
    # Logs and debug
    parser.add_argument('-f', '--file_output', metavar='FILE', default=None, action='store', type=str,
@@ -812,11 +5102,10 @@ def main():
          if arg.keytab is None:
             arg.keytab = args_validation('keytab')
 
-         if arg.cassandra_data_path == parser.get_default(
-                 'cassandra_data_path'):
+         if arg.cassandra_data_path is None:
             cass_dpath = args_validation('cassandra_data_path')
             if cass_dpath is not None:
-               arg.cassandra_data_path = cass_dpath
+               arg.cassandra_data_path = [d.strip() for d in cass_dpath.split(',') if d.strip()]
          if arg.cassandra_config == parser.get_default('cassandra_config'):
             # Todo: l'override marche pas
             cass_config = args_validation('cassandra_config')
@@ -827,34 +5116,165 @@ def main():
             arg.hadoop_url = args_validation('hadoop_url')
          if arg.hadoop_dest_dir is None:
             arg.hadoop_dest_dir = args_validation('hadoop_dest_dir')
+         if arg.storage == parser.get_default('storage'):
+            storage = args_validation('storage')
+            if storage is not None:
+               arg.storage = storage
+            if arg.storage not in STORAGES:
+               print('Unknown storage %s, available storages: %s' % (arg.storage, ', '.join(STORAGES)))
+               sys.exit(1)
 
          if arg.username is None:
             arg.username = args_validation('username')
          if arg.realm is None:
             arg.realm = args_validation('realm')
+
+         for rule in ['keep_daily', 'keep_weekly', 'keep_monthly', 'max_age']:
+            if getattr(arg, rule) is None:
+               setattr(arg, rule, args_validation(rule, 'int'))
+         for option in ['metrics_file', 'prometheus_textfile', 'cluster_name', 'verify_report', 'plan_file']:
+            if getattr(arg, option) is None:
+               setattr(arg, option, args_validation(option))
+         if arg.schedule is None and config.has_section('schedule'):
+            arg.schedule = ['='.join(item) for item in config.items('schedule')]
+         # Options with a default are overridden by any configured value, even an empty one or 0
+         for option, option_type in [('restore_dir', 'str'), ('control_socket', 'str'), ('state_dir', 'str'),
+                                     ('retention_scope', 'str'), ('verify_scope', 'str'),
+                                     ('slow_transfer_ratio', 'float'), ('verify_sample', 'float'),
+                                     ('verify_rate', 'float'), ('workers', 'int'), ('retries', 'int'),
+                                     ('retry_budget', 'int'), ('progress_interval', 'int'),
+                                     ('pack_threshold', 'int'), ('disk_readers', 'int'),
+                                     ('slow_transfer_grace', 'int'), ('backup_poll_interval', 'int'),
+                                     ('max_concurrent_uploads', 'int'), ('lease_ttl', 'int'),
+                                     ('stagger_window', 'int'), ('coordination_timeout', 'int'),
+                                     ('connect_timeout', 'int'), ('read_timeout', 'int')]:
+            if getattr(arg, option) == parser.get_default(option):
+               value = args_validation(option, option_type)
+               if value is not None:
+                  setattr(arg, option, value)
+         for option in ['pack_small_files', 'coordinate', 'replica_dedup', 'clear_snapshot']:
+            if not getattr(arg, option):
+               setattr(arg, option, args_validation(option, 'bool') or False)
       else:
          print("You don't have permission to read configuration file")
          sys.exit(1)
 
+   # Talk to a running daemon
+   if arg.ctl:
+      try:
+         answer = control(arg.control_socket, ' '.join(arg.ctl))
+      except (socket.error, ValueError) as e:
+         print('Could not talk to the daemon on %s: %s' % (arg.control_socket, e))
+         sys.exit(1)
+      print(json.dumps(answer, indent=2, sort_keys=True))
+      sys.exit(0 if answer.get('ok') else 1)
+
+   # Leases are taken over with a rename, which S3 can't do atomically
+   if arg.coordinate and arg.storage == S3Backend.name:
+      print('--coordinate is not available with the s3 storage')
+      sys.exit(1)
+
    # Exit if hadoop information is empty
-   if arg.hadoop_dest_dir is None or arg.hadoop_url is None:
+   if arg.hadoop_dest_dir is None or (arg.hadoop_url is None and arg.storage == WebHdfsBackend.name):
       print('Please enter hadoop information')
       sys.exit(1)
 
    urllib3.util.connection.create_connection = create_connection_replacement
 
    # Create action
+   profiler = Profiler(arg.profile, arg.profile_cpu, arg.profile_memory)
+   profiler.start()
+   metrics = RunMetrics(progress_interval=arg.progress_interval, profiler=profiler)
+   storage = None
+   try:
+      if arg.storage == LocalBackend.name:
+         storage = LocalBackend(arg.hadoop_dest_dir, metrics)
+      elif arg.storage == S3Backend.name:
+         storage = S3Backend(arg.hadoop_url, arg.hadoop_dest_dir, arg.retries, metrics,
+                             (arg.connect_timeout, arg.read_timeout))
+   except StorageError as e:
+      print(e)
+      sys.exit(1)
+   coordinator = None
+   if arg.coordinate or arg.replica_dedup or arg.stagger_window:
+      coordinator = Coordinator(max_uploads=arg.max_concurrent_uploads if arg.coordinate else 0,
+                                lease_ttl=arg.lease_ttl, stagger_window=arg.stagger_window,
+                                timeout=arg.coordination_timeout, replica_dedup=arg.replica_dedup)
    operation = ManageSnapshot(arg.username, arg.realm,
                               arg.kerberos, arg.keytab,
                               arg.cassandra_data_path, arg.cassandra_config,
                               arg.hadoop_url, arg.hadoop_dest_dir,
-                              arg.dry_run)
-   if arg.list_snaps:
-      operation.list_snapshots()
-   elif arg.make_snapshot:
-      operation.make_snapshot()
-   elif arg.flush_snapshot:
-      operation.flush_snapshot(arg.node, arg.flush_snapshot)
+                              arg.dry_run, workers=arg.workers,
+                              retry_policy=RetryPolicy(max_attempts=arg.retries, budget=arg.retry_budget),
+                              metrics=metrics,
+                              pack_threshold=arg.pack_threshold * 1024 if arg.pack_small_files else None,
+                              disk_readers=arg.disk_readers,
+                              transfer_monitor=TransferMonitor(slow_ratio=arg.slow_transfer_ratio,
+                                                               grace=arg.slow_transfer_grace),
+                              cluster_name=arg.cluster_name,
+                              bootstrap=arg.archive_commitlog is None,
+                              coordinator=coordinator,
+                              clear_snapshot=arg.clear_snapshot,
+                              state_dir=arg.state_dir,
+                              storage=storage,
+                              timeout=(arg.connect_timeout, arg.read_timeout))
+   failed = False
+   try:
+      if arg.archive_commitlog:
+         # Run by Cassandra for each segment: a failure must be reported by the exit code
+         metrics.action = 'commitlog'
+         archived = operation.archive_commitlog(arg.archive_commitlog)
+      elif arg.list_snaps:
+         metrics.action = 'list'
+         operation.list_snapshots()
+      elif arg.make_snapshot:
+         operation.make_snapshot()
+      elif arg.flush_snapshot:
+         metrics.action = 'flush'
+         operation.flush_snapshot(arg.node, arg.flush_snapshot)
+      elif arg.restore_snapshot:
+         operation.restore_snapshot(arg.node, arg.restore_snapshot, arg.restore_dir, arg.restore_incremental)
+      elif arg.verify:
+         verified = operation.verify_snapshots(arg.node, arg.verify, arg.verify_scope, arg.verify_sample, arg.verify_rate,
+                                               arg.verify_report)
+      elif arg.restore_commitlog:
+         operation.restore_commitlog(arg.node, os.path.join(arg.restore_dir, 'commitlog'), arg.restore_point)
+      elif arg.follow_commitlog:
+         signal.signal(signal.SIGTERM, lambda signum, frame: operation.stopping.set())
+         try:
+            operation.follow_commitlog(arg.follow_commitlog, arg.backup_poll_interval)
+         except KeyboardInterrupt:
+            operation.logger.info('Interrupted, stopping')
+      elif arg.follow_backups:
+         signal.signal(signal.SIGTERM, lambda signum, frame: operation.stopping.set())
+         try:
+            operation.follow_backups(arg.backup_poll_interval)
+         except KeyboardInterrupt:
+            operation.logger.info('Interrupted, stopping')
+      elif arg.retention:
+         metrics.action = 'retention'
+         operation.apply_retention(RetentionPolicy(arg.keep_daily, arg.keep_weekly, arg.keep_monthly, arg.max_age,
+                                                   arg.retention_scope))
+      elif arg.daemon:
+         run_daemon(operation, arg)
+         return
+   except OperationError:
+      # Logged where it happened
+      failed = True
+   finally:
+      # Written whatever happened, failed runs are the ones worth a look. Daemon jobs write their own metrics.
+      if not arg.daemon:
+         metrics.finish(arg.metrics_file, arg.prometheus_textfile)
+      operation.close()
+      profiler.finish()
+   if arg.plan_file and operation.plan is not None:
+      try:
+         with open(arg.plan_file, 'w') as f:
+            json.dump(operation.plan, f, indent=2, sort_keys=True)
+      except IOError as e:
+         operation.logger.error('Could not write plan file %s: %s' % (arg.plan_file, e))
+   if failed or (arg.archive_commitlog and not archived) or (arg.verify and not verified):
+      sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,19 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from setuptools import setup, find_packages
-from cassnap_manage.py import __version__
+from setuptools import setup
+from cassnap_manage import __version__
 
 setup(
     name='cassnap_manage',
     version=__version__,
-    packages=find_packages(),
+    py_modules=['cassnap_manage'],
     author="Pierre Mavro",
     author_email="pierre@mavro.fr",
     description="S Export and manage Cassandra snapshots to hadoop",
     long_description=open('README.md').read(),
     install_requires=open('requirements.txt').read().splitlines(),
+    # S3 storage, conditional writes (IfNoneMatch/IfMatch) of put_object are needed for appends
+    extras_require={'s3': ['boto3>=1.35.69']},
     include_package_data=True,
+    python_requires='>=3.7',
     url='https://github.com/deimosfr/cassandra_snap_to_hadoop',
     classifiers=[
         "Programming Language :: Python",
@@ -22,7 +25,8 @@ setup(
         "Environment :: Console",
         "Natural Language :: English",
         "Operating System :: OS Independent",
-        "Programming Language :: Python :: 2.7",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
         "Topic :: Communications",
     ],
 )
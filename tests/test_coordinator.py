@@ -0,0 +1,175 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import cassnap_manage
+from cassnap_manage import Coordinator, LocalBackend
+
+
+class CoordinatorTest(unittest.TestCase):
+   def setUp(self):
+      self.root = tempfile.mkdtemp()
+      os.mkdir(os.path.join(self.root, 'data'))
+
+   def tearDown(self):
+      shutil.rmtree(self.root)
+
+   def node(self, hostname):
+      operation = cassnap_manage.ManageSnapshot(None, None, False, None, os.path.join(self.root, 'data'), None, None,
+                                                '/backup', False, cluster_name='C', bootstrap=False,
+                                                storage=LocalBackend(self.root))
+      operation.hostname = hostname
+      return operation
+
+   def coordinator(self, **kwargs):
+      kwargs.setdefault('max_uploads', 2)
+      kwargs.setdefault('timeout', 0)
+      kwargs.setdefault('poll_interval', 0)
+      return Coordinator(**kwargs)
+
+   def lease_file(self, operation, slot):
+      return os.path.join(self.root, self.coordinator()._lease_path(operation, slot).lstrip('/'))
+
+   def lease_node(self, operation, slot):
+      with open(self.lease_file(operation, slot)) as f:
+         return json.load(f)['node']
+
+   def write_lease(self, operation, slot, node, expires):
+      with open(self.lease_file(operation, slot), 'w') as f:
+         json.dump({'node': node, 'acquired': time.time(), 'expires': expires}, f)
+
+   def test_acquire_up_to_max_uploads(self):
+      nodes = [self.node('node%d' % i) for i in range(3)]
+      coordinators = [self.coordinator() for _ in nodes]
+      self.assertTrue(coordinators[0].acquire(nodes[0]))
+      self.assertTrue(coordinators[1].acquire(nodes[1]))
+      self.assertEqual({coordinators[0].lease, coordinators[1].lease}, {0, 1})
+      self.assertFalse(coordinators[2].acquire(nodes[2]))
+      self.assertIsNone(coordinators[2].lease)
+
+   def test_release_frees_the_lease(self):
+      first, second = self.node('node0'), self.node('node1')
+      coordinator = self.coordinator(max_uploads=1)
+      self.assertTrue(coordinator.acquire(first))
+      self.assertFalse(self.coordinator(max_uploads=1).acquire(second))
+      coordinator.release(first)
+      self.assertIsNone(coordinator.lease)
+      self.assertFalse(os.path.exists(self.lease_file(first, 0)))
+      self.assertTrue(self.coordinator(max_uploads=1).acquire(second))
+
+   def test_release_keeps_a_lease_taken_over(self):
+      operation = self.node('node0')
+      coordinator = self.coordinator(max_uploads=1)
+      coordinator.acquire(operation)
+      self.write_lease(operation, 0, 'node1', time.time() + 600)
+      coordinator.release(operation)
+      self.assertEqual(self.lease_node(operation, 0), 'node1')
+
+   def test_try_slot_does_not_take_a_live_lease(self):
+      operation = self.node('node0')
+      coordinator = self.coordinator(max_uploads=1)
+      coordinator.acquire(self.node('node1'))
+      self.assertFalse(coordinator._try_slot(operation, 0))
+      self.assertEqual(self.lease_node(operation, 0), 'node1')
+
+   def test_try_slot_takes_an_expired_lease_over(self):
+      operation = self.node('node0')
+      self.coordinator(max_uploads=1).acquire(self.node('node1'))
+      self.write_lease(operation, 0, 'node1', time.time() - 1)
+      self.assertTrue(self.coordinator()._try_slot(operation, 0))
+      self.assertEqual(self.lease_node(operation, 0), 'node0')
+      # the renamed expired lease is deleted
+      self.assertEqual(os.listdir(os.path.dirname(self.lease_file(operation, 0))), ['upload_0'])
+
+   def test_try_slot_takes_a_corrupted_lease_over(self):
+      operation = self.node('node0')
+      self.coordinator(max_uploads=1).acquire(self.node('node1'))
+      with open(self.lease_file(operation, 0), 'w') as f:
+         f.write('{')
+      self.assertTrue(self.coordinator()._try_slot(operation, 0))
+      self.assertEqual(self.lease_node(operation, 0), 'node0')
+
+   def test_renew_extends_the_held_lease(self):
+      operation = self.node('node0')
+      coordinator = self.coordinator(max_uploads=1, lease_ttl=600)
+      coordinator.acquire(operation)
+      self.write_lease(operation, 0, 'node0', time.time() + 1)
+      coordinator.renew(operation)
+      with open(self.lease_file(operation, 0)) as f:
+         self.assertGreater(json.load(f)['expires'], time.time() + 500)
+      self.assertFalse(coordinator.lost)
+
+   def test_renew_does_not_overwrite_a_lease_taken_over(self):
+      operation = self.node('node0')
+      coordinator = self.coordinator(max_uploads=2)
+      coordinator.acquire(operation)
+      held = coordinator.lease
+      self.write_lease(operation, held, 'node1', time.time() + 600)
+      coordinator.renew(operation)
+      self.assertEqual(self.lease_node(operation, held), 'node1')
+      self.assertEqual(coordinator.lease, 1 - held)
+      self.assertEqual(self.lease_node(operation, 1 - held), 'node0')
+      self.assertFalse(coordinator.lost)
+
+   def test_renew_sets_lost_when_no_lease_is_left(self):
+      operation = self.node('node0')
+      coordinator = self.coordinator(max_uploads=1)
+      coordinator.acquire(operation)
+      self.write_lease(operation, 0, 'node1', time.time() + 600)
+      coordinator.renew(operation)
+      self.assertTrue(coordinator.lost)
+      self.assertEqual(self.lease_node(operation, 0), 'node1')
+
+   def test_renew_recreates_a_missing_lease_without_overwrite(self):
+      operation = self.node('node0')
+      coordinator = self.coordinator(max_uploads=1)
+      coordinator.acquire(operation)
+      os.remove(self.lease_file(operation, 0))
+      coordinator.renew(operation)
+      self.assertFalse(coordinator.lost)
+      self.assertEqual(self.lease_node(operation, 0), 'node0')
+
+   def test_renew_does_not_overwrite_a_lease_recreated_by_another_node(self):
+      operation = self.node('node0')
+      coordinator = self.coordinator(max_uploads=1)
+      coordinator.acquire(operation)
+      os.remove(self.lease_file(operation, 0))
+      # the lease reads as missing, then another node creates it
+      read_lease = coordinator._read_lease
+
+      def missing_then_taken(op, slot, path=None):
+         self.write_lease(op, 0, 'node1', time.time() + 600)
+         coordinator._read_lease = read_lease
+         return None
+      coordinator._read_lease = missing_then_taken
+      coordinator.renew(operation)
+      self.assertTrue(coordinator.lost)
+      self.assertEqual(self.lease_node(operation, 0), 'node1')
+
+
+class ElectReplicasTest(unittest.TestCase):
+   def test_every_range_has_an_elected_replica(self):
+      ranges = [['a', 'b', 'c'], ['b', 'c', 'd'], ['c', 'd', 'e'], ['d', 'e', 'a'], ['e', 'a', 'b']]
+      elected = Coordinator.elect_replicas(ranges)
+      self.assertEqual(elected, {'a', 'c'})
+      for endpoints in ranges:
+         self.assertTrue(elected & set(endpoints))
+
+   def test_election_does_not_depend_on_the_order(self):
+      ranges = [['a', 'b'], ['b', 'c'], ['c', 'a']]
+      self.assertEqual(Coordinator.elect_replicas(ranges),
+                       Coordinator.elect_replicas([list(reversed(r)) for r in reversed(ranges)]))
+
+   def test_ranges_without_replicas_are_ignored(self):
+      self.assertEqual(Coordinator.elect_replicas([[], ['a']]), {'a'})
+      self.assertEqual(Coordinator.elect_replicas([]), set())
+
+
+if __name__ == '__main__':
+   unittest.main()
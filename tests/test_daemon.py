@@ -0,0 +1,158 @@
+import datetime
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from cassnap_manage import CronSchedule, Daemon, OperationError, control
+
+
+def timestamp(*args):
+   return time.mktime(datetime.datetime(*args).timetuple())
+
+
+def next_runs(expression, after, count):
+   schedule = CronSchedule(expression)
+   runs = []
+   t = timestamp(*after)
+   for _ in range(count):
+      t = schedule.next_run(t)
+      runs.append(datetime.datetime.fromtimestamp(t))
+   return runs
+
+
+class Operation:
+   def __init__(self):
+      self.stopping = threading.Event()
+
+
+class CronScheduleTest(unittest.TestCase):
+   def test_fields(self):
+      schedule = CronSchedule('*/15 1-3,22 * 1,6 *')
+      self.assertEqual(schedule.minutes, {0, 15, 30, 45})
+      self.assertEqual(schedule.hours, {1, 2, 3, 22})
+      self.assertEqual(schedule.days, set(range(1, 32)))
+      self.assertEqual(schedule.months, {1, 6})
+      self.assertEqual(schedule.weekdays, set(range(7)))
+
+   def test_step_from_a_value(self):
+      self.assertEqual(CronSchedule('10/20 * * * *').minutes, {10, 30, 50})
+
+   def test_aliases(self):
+      self.assertEqual(CronSchedule('@daily').next_run(timestamp(2026, 3, 31, 12, 0)), timestamp(2026, 4, 1, 0, 0))
+
+   def test_invalid_expressions(self):
+      for expression in ('* * * *', '60 * * * *', '* 24 * * *', '* * 0 * *', '* * * 13 *', '* * * * 8',
+                         '5-1 * * * *', '*/0 * * * *', 'a * * * *'):
+         self.assertRaises(ValueError, CronSchedule, expression)
+
+   def test_seven_is_sunday(self):
+      self.assertEqual(CronSchedule('0 0 * * 7').weekdays, {0})
+      self.assertEqual(CronSchedule('0 0 * * 5-7').weekdays, {5, 6, 0})
+      # 2026-03-31 is a Tuesday
+      self.assertEqual(next_runs('0 3 * * 7', (2026, 3, 31), 2),
+                       [datetime.datetime(2026, 4, 5, 3, 0), datetime.datetime(2026, 4, 12, 3, 0)])
+
+   def test_day_of_month_or_day_of_week(self):
+      # Like cron, the 13th of the month or a Friday
+      self.assertEqual(next_runs('0 0 13 * 5', (2026, 3, 31), 4),
+                       [datetime.datetime(2026, 4, 3), datetime.datetime(2026, 4, 10),
+                        datetime.datetime(2026, 4, 13), datetime.datetime(2026, 4, 17)])
+
+   def test_day_of_month_and_any_day_of_week(self):
+      self.assertEqual(next_runs('30 2 1 * *', (2026, 3, 31), 2),
+                       [datetime.datetime(2026, 4, 1, 2, 30), datetime.datetime(2026, 5, 1, 2, 30)])
+
+   def test_next_run_is_strictly_after(self):
+      self.assertEqual(CronSchedule('0 * * * *').next_run(timestamp(2026, 3, 31, 10, 0)),
+                       timestamp(2026, 3, 31, 11, 0))
+
+   def test_never_matching_expression(self):
+      self.assertRaises(ValueError, CronSchedule('0 0 31 2 *').next_run, timestamp(2026, 3, 31))
+
+
+class DaemonTest(unittest.TestCase):
+   def setUp(self):
+      self.runs = []
+      self.daemon = Daemon(Operation(), {'backup': (CronSchedule('@daily'), lambda: self.runs.append('backup')),
+                                         'retention': (None, lambda: False)})
+
+   def test_status(self):
+      answer = self.daemon.command('status\n')
+      self.assertTrue(answer['ok'])
+      self.assertEqual(answer['jobs']['backup']['schedule'], '@daily')
+      self.assertIsNone(answer['jobs']['retention']['schedule'])
+
+   def test_run_queues_a_job_once(self):
+      self.assertEqual(self.daemon.command('run backup'), {'ok': True, 'queued': 'backup'})
+      self.assertEqual(self.daemon.command('run backup'), {'ok': True, 'queued': 'backup'})
+      self.assertTrue(self.daemon.state['backup']['queued'])
+      self.assertEqual(self.daemon.queue.qsize(), 1)
+
+   def test_run_unknown_job(self):
+      self.assertEqual(self.daemon.command('run nothing'), {'ok': False, 'error': 'Unknown job nothing'})
+      self.assertTrue(self.daemon.queue.empty())
+
+   def test_unknown_command(self):
+      self.assertEqual(self.daemon.command('restart now\n'), {'ok': False, 'error': 'Unknown command: restart now'})
+
+   def test_stop(self):
+      self.assertEqual(self.daemon.command('stop'), {'ok': True})
+      self.assertTrue(self.daemon.operation.stopping.is_set())
+      self.assertIsNone(self.daemon.queue.get_nowait())
+
+   def test_run_job_records_the_result(self):
+      self.daemon.trigger('backup')
+      self.daemon._run_job(self.daemon.queue.get_nowait())
+      self.daemon._run_job('retention')
+      self.assertEqual(self.runs, ['backup'])
+      self.assertEqual(self.daemon.state['backup']['last_result'], 'ok')
+      self.assertFalse(self.daemon.state['backup']['queued'])
+      self.assertEqual(self.daemon.state['retention']['last_result'], 'failed')
+      self.assertEqual(self.daemon.state['retention']['runs'], 1)
+
+
+class ControlSocketTest(unittest.TestCase):
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.socket_path = os.path.join(self.directory, 'control.sock')
+      self.daemons = []
+
+   def tearDown(self):
+      for daemon in self.daemons:
+         if daemon._server is not None:
+            daemon._server.shutdown()
+            daemon._server.server_close()
+      shutil.rmtree(self.directory)
+
+   def start(self):
+      daemon = Daemon(Operation(), {'backup': (None, lambda: None)}, self.socket_path)
+      self.daemons.append(daemon)
+      daemon._start_server()
+      return daemon
+
+   def test_commands_through_the_socket(self):
+      self.start()
+      self.assertEqual(control(self.socket_path, 'run backup'), {'ok': True, 'queued': 'backup'})
+
+   def test_live_socket_is_kept(self):
+      self.start()
+      self.assertRaises(OperationError, self.start)
+      self.assertEqual(control(self.socket_path, 'run backup'), {'ok': True, 'queued': 'backup'})
+
+   def test_stale_socket_is_replaced(self):
+      stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      stale.bind(self.socket_path)
+      stale.close()
+      self.start()
+      self.assertEqual(control(self.socket_path, 'status')['ok'], True)
+
+
+if __name__ == '__main__':
+   unittest.main()
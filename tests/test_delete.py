@@ -0,0 +1,106 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import cassnap_manage
+from cassnap_manage import LocalBackend, StorageError
+
+
+class FailingBackend(LocalBackend):
+   """
+   Local storage refusing to delete some files, and recording deletions
+   """
+   def __init__(self, root, refused):
+      super().__init__(root)
+      self.refused = set(refused)
+      self.deleted = []
+
+   def delete(self, path, recursive=False):
+      self.deleted.append(path)
+      if path in self.refused:
+         raise StorageError('DELETE %s answered 403' % path)
+      super().delete(path, recursive)
+
+
+class BulkDeleteTest(unittest.TestCase):
+   def setUp(self):
+      self.root = tempfile.mkdtemp()
+      os.mkdir(os.path.join(self.root, 'data'))
+
+   def tearDown(self):
+      shutil.rmtree(self.root)
+
+   def node(self, refused=()):
+      return cassnap_manage.ManageSnapshot(None, None, False, None, os.path.join(self.root, 'data'), None, None,
+                                           '/backup', False, cluster_name='C', bootstrap=False, delete_batch_size=2,
+                                           storage=FailingBackend(os.path.join(self.root, 'backup'), refused))
+
+   def local(self, path):
+      return os.path.join(self.root, 'backup', path)
+
+   def write(self, *paths):
+      for path in paths:
+         if not os.path.isdir(os.path.dirname(self.local(path))):
+            os.makedirs(os.path.dirname(self.local(path)))
+         with open(self.local(path), 'w') as f:
+            f.write(path)
+
+   def test_emptied_directories_are_removed(self):
+      paths = ['C/ks1/t1/a-Data.db', 'C/ks1/t1/a-Index.db', 'C/ks1/t2/b-Data.db', 'C/ks2/t3/c-Data.db']
+      self.write(*paths)
+      self.write('C/ks2/t4/d-Data.db')
+      self.assertEqual(self.node()._bulk_delete_in_hadoop(paths), [])
+      for path in paths:
+         self.assertFalse(os.path.exists(self.local(path)))
+      self.assertFalse(os.path.exists(self.local('C/ks1')))
+      self.assertFalse(os.path.exists(self.local('C/ks2/t3')))
+      # not empty, or top level
+      self.assertTrue(os.path.exists(self.local('C/ks2/t4/d-Data.db')))
+      self.assertTrue(os.path.isdir(self.local('C')))
+
+   def test_failed_deletions_are_returned_and_their_directories_kept(self):
+      paths = ['C/ks1/t1/a-Data.db', 'C/ks1/t1/a-Index.db', 'C/ks1/t2/b-Data.db', 'C/ks2/t3/c-Data.db']
+      self.write(*paths)
+      operation = self.node(refused=['C/ks1/t1/a-Index.db'])
+      self.assertEqual(operation._bulk_delete_in_hadoop(paths), ['C/ks1/t1/a-Index.db'])
+      self.assertTrue(os.path.exists(self.local('C/ks1/t1/a-Index.db')))
+      self.assertFalse(os.path.exists(self.local('C/ks1/t1/a-Data.db')))
+      self.assertFalse(os.path.exists(self.local('C/ks1/t2')))
+      self.assertFalse(os.path.exists(self.local('C/ks2')))
+
+   def test_referenced_directories_are_not_tried(self):
+      paths = ['C/ks1/t1/a-Data.db', 'C/ks1/t2/b-Data.db']
+      self.write(*paths)
+      operation = self.node()
+      self.assertEqual(operation._bulk_delete_in_hadoop(paths, ['C/ks1/t1']), [])
+      self.assertEqual(sorted(operation.storage.deleted), sorted(paths + ['C/ks1/t2']))
+      self.assertTrue(os.path.isdir(self.local('C/ks1/t1')))
+      self.assertFalse(os.path.exists(self.local('C/ks1/t2')))
+
+   def test_failed_deletions_keep_the_expired_snapshot_metadata(self):
+      operation = self.node(refused=['C/ks1/t1/old-Data.db'])
+      self.write('C/ks1/t1/old-Data.db', 'C/ks1/t1/new-Data.db', 'C/ks1/t2/gone-Data.db')
+      old = {'node': 'node1', 'date': '2026_03_30'}
+      new = {'node': 'node1', 'date': '2026_03_31'}
+      for snapshot, files in ((old, ['ks1/t1/old-Data.db', 'ks1/t1/new-Data.db', 'ks1/t2/gone-Data.db']),
+                              (new, ['ks1/t1/new-Data.db'])):
+         path = self.local(operation._get_metadata_path(snapshot))
+         if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+         with open(path, 'w') as f:
+            f.write(''.join(name + '\n' for name in files))
+
+      self.assertFalse(operation._expire_snapshots([old], [old, new]))
+      self.assertTrue(os.path.exists(self.local(operation._get_metadata_path(old))))
+      self.assertTrue(os.path.exists(self.local('C/ks1/t1/old-Data.db')))
+      self.assertTrue(os.path.exists(self.local('C/ks1/t1/new-Data.db')))
+      self.assertFalse(os.path.exists(self.local('C/ks1/t2')))
+      self.assertEqual(operation.metrics.files['failed'], 1)
+
+
+if __name__ == '__main__':
+   unittest.main()
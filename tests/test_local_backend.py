@@ -0,0 +1,206 @@
+import errno
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from cassnap_manage import LocalBackend, StorageError
+
+
+class LocalBackendTest(unittest.TestCase):
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.storage = LocalBackend(os.path.join(self.directory, 'backup'))
+      self.storage.check()
+
+   def tearDown(self):
+      shutil.rmtree(self.directory)
+
+   def local(self, path):
+      return os.path.join(self.directory, 'backup', path)
+
+   def content(self, path):
+      with open(self.local(path), 'rb') as f:
+         return f.read()
+
+   def test_put(self):
+      self.assertTrue(self.storage.put('/ks/t/a-Data.db', lambda: io.BytesIO(b'data')))
+      self.assertEqual(self.content('ks/t/a-Data.db'), b'data')
+      self.assertTrue(self.storage.put('ks/t/a-Data.db', lambda: io.BytesIO(b'new')))
+      self.assertEqual(self.content('ks/t/a-Data.db'), b'new')
+      self.assertEqual(os.listdir(self.local('ks/t')), ['a-Data.db'])
+
+   def test_put_without_overwrite(self):
+      self.assertTrue(self.storage.put('lease', lambda: io.BytesIO(b'first'), False))
+      self.assertFalse(self.storage.put('lease', lambda: io.BytesIO(b'second'), False))
+      self.assertEqual(self.content('lease'), b'first')
+      self.assertEqual(os.listdir(self.local('')), ['lease'])
+
+   def test_put_closes_the_body(self):
+      body = io.BytesIO(b'data')
+      self.storage.put('a', lambda: body)
+      self.assertTrue(body.closed)
+
+   def test_append(self):
+      self.storage.append('meta/index', b'a\n')
+      self.storage.append('meta/index', b'b\n')
+      self.assertEqual(self.content('meta/index'), b'a\nb\n')
+
+   def test_get_and_read(self):
+      self.storage.put('a', lambda: io.BytesIO(b'0123456789'))
+      self.assertEqual(self.storage.get('a'), b'0123456789')
+      self.assertEqual(self.storage.get('a', 2, 3), b'234')
+      self.assertIsNone(self.storage.get('missing'))
+      self.assertEqual(list(self.storage.read('a', 1, 7, chunk_size=3)), [b'123', b'456', b'7'])
+      self.assertEqual(b''.join(self.storage.read('a', 8)), b'89')
+      self.assertRaises(StorageError, list, self.storage.read('missing'))
+
+   def test_list(self):
+      self.storage.put('d/a', lambda: io.BytesIO(b'123'))
+      self.storage.mkdirs('d/sub')
+      # written by a put in progress
+      open(self.local('d/b.12.345.tmp'), 'w').close()
+      listing = self.storage.list('d')
+      self.assertEqual(sorted(listing), ['a', 'sub'])
+      self.assertEqual((listing['a']['type'], listing['a']['size']), ('FILE', 3))
+      self.assertEqual((listing['sub']['type'], listing['sub']['size']), ('DIRECTORY', 0))
+      self.assertIsNone(self.storage.list('missing'))
+
+   def test_delete(self):
+      self.storage.put('d/sub/a', lambda: io.BytesIO(b'a'))
+      self.storage.delete('d/missing')
+      self.assertRaises(StorageError, self.storage.delete, 'd')
+      self.storage.delete('d/sub/a')
+      self.storage.delete('d/sub')
+      self.assertEqual(os.listdir(self.local('d')), [])
+      self.storage.put('d/sub/b', lambda: io.BytesIO(b'b'))
+      self.storage.delete('d', recursive=True)
+      self.assertFalse(os.path.exists(self.local('d')))
+
+   def test_rename(self):
+      self.storage.put('a', lambda: io.BytesIO(b'a'))
+      self.storage.put('b', lambda: io.BytesIO(b'b'))
+      self.assertFalse(self.storage.rename('a', 'b'))
+      self.assertEqual((self.content('a'), self.content('b')), (b'a', b'b'))
+      self.assertTrue(self.storage.rename('a', 'moved/a'))
+      self.assertFalse(os.path.exists(self.local('a')))
+      self.assertEqual(self.content('moved/a'), b'a')
+      self.assertFalse(self.storage.rename('a', 'c'))
+
+   def test_rename_directory(self):
+      self.storage.put('d/a', lambda: io.BytesIO(b'a'))
+      self.storage.mkdirs('e')
+      self.assertFalse(self.storage.rename('d', 'e'))
+      self.assertTrue(self.storage.rename('d', 'f'))
+      self.assertEqual(self.content('f/a'), b'a')
+
+   def test_checksum(self):
+      self.storage.put('a', lambda: io.BytesIO(b'data'))
+      self.assertEqual(self.storage.checksum('a'), 'sha256:' + hashlib.sha256(b'data').hexdigest())
+      self.assertRaises(StorageError, self.storage.checksum, 'missing')
+
+
+class LocalCopyTest(unittest.TestCase):
+   """
+   Files are cloned, else copied with copy_file_range, else read
+   """
+   CONTENT = os.urandom(3 * 1024 * 1024 + 17)
+
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.storage = LocalBackend(os.path.join(self.directory, 'backup'))
+      self.source = os.path.join(self.directory, 'source')
+      with open(self.source, 'wb') as f:
+         f.write(self.CONTENT)
+      self.copyfileobj = mock.patch('shutil.copyfileobj', wraps=shutil.copyfileobj).start()
+      self.addCleanup(mock.patch.stopall)
+
+   def tearDown(self):
+      shutil.rmtree(self.directory)
+
+   def put(self):
+      self.storage.put('a', lambda: open(self.source, 'rb'))
+      with open(os.path.join(self.directory, 'backup', 'a'), 'rb') as f:
+         return f.read()
+
+   def no_clone(self):
+      mock.patch('fcntl.ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'Operation not supported')).start()
+
+   def test_file_is_copied(self):
+      # with whatever this filesystem and kernel support
+      self.assertEqual(self.put(), self.CONTENT)
+
+   def test_clone(self):
+      def clone(target, request, source):
+         self.assertEqual(request, LocalBackend.FICLONE)
+         os.pwrite(target, os.pread(source, len(self.CONTENT), 0), 0)
+      mock.patch('fcntl.ioctl', side_effect=clone).start()
+      copy_file_range = mock.patch('os.copy_file_range', create=True).start()
+      self.assertEqual(self.put(), self.CONTENT)
+      self.assertFalse(copy_file_range.called)
+      self.assertFalse(self.copyfileobj.called)
+
+   def test_copy_file_range_without_clone(self):
+      self.no_clone()
+
+      def copy_file_range(src, dst, count, offset_src, offset_dst):
+         # the kernel may copy less than asked
+         data = os.pread(src, min(count, 1024 * 1024), offset_src)
+         return os.pwrite(dst, data, offset_dst)
+      copy_file_range = mock.patch('os.copy_file_range', side_effect=copy_file_range, create=True).start()
+      self.assertEqual(self.put(), self.CONTENT)
+      self.assertEqual(copy_file_range.call_count, 4)
+      self.assertFalse(self.copyfileobj.called)
+
+   def test_read_without_clone_nor_copy_file_range(self):
+      self.no_clone()
+      mock.patch('os.copy_file_range', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link'),
+                 create=True).start()
+      self.assertEqual(self.put(), self.CONTENT)
+      self.assertTrue(self.copyfileobj.called)
+
+   def test_read_without_copy_file_range(self):
+      self.no_clone()
+      mock.patch('os.copy_file_range', side_effect=AttributeError, create=True).start()
+      self.assertEqual(self.put(), self.CONTENT)
+      self.assertTrue(self.copyfileobj.called)
+
+   def test_partial_copy_file_range_fails(self):
+      self.no_clone()
+      calls = []
+
+      def copy_file_range(src, dst, count, offset_src, offset_dst):
+         calls.append(count)
+         if len(calls) > 1:
+            raise OSError(errno.EIO, 'Input/output error')
+         os.pwrite(dst, os.pread(src, 1024, offset_src), offset_dst)
+         return 1024
+      mock.patch('os.copy_file_range', side_effect=copy_file_range, create=True).start()
+      # a copy which stopped midway is not completed by reading the file again
+      self.assertRaises(StorageError, self.put)
+      self.assertFalse(self.copyfileobj.called)
+      self.assertEqual(os.listdir(os.path.join(self.directory, 'backup')), [])
+
+   def test_streams_are_read(self):
+      self.storage.put('a', lambda: io.BytesIO(self.CONTENT))
+      self.assertTrue(self.copyfileobj.called)
+
+   def test_file_read_partly_is_read(self):
+      def opened():
+         f = open(self.source, 'rb')
+         f.seek(10)
+         return f
+      self.storage.put('a', opened)
+      self.assertTrue(self.copyfileobj.called)
+      with open(os.path.join(self.directory, 'backup', 'a'), 'rb') as f:
+         self.assertEqual(f.read(), self.CONTENT[10:])
+
+
+if __name__ == '__main__':
+   unittest.main()
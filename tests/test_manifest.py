@@ -0,0 +1,26 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from cassnap_manage import Manifest
+
+
+class ManifestUnionTest(unittest.TestCase):
+   def test_union_mixed_sizes(self):
+      # legacy manifests have no size: the first manifest holding a path wins
+      legacy = Manifest([('ks/t/a-Data.db', None, ''), ('ks/t/b-Data.db', None, '')])
+      recent = Manifest([('ks/t/a-Data.db', 12, 'bundle-1'), ('ks/t/c-Data.db', 3, '')])
+      union = Manifest.union([legacy, recent])
+      self.assertEqual(list(union.items()), [
+         ('ks/t/a-Data.db', (None, '')),
+         ('ks/t/b-Data.db', (None, '')),
+         ('ks/t/c-Data.db', (3, '')),
+      ])
+      union = Manifest.union([recent, legacy])
+      self.assertEqual(list(union.items())[0], ('ks/t/a-Data.db', (12, 'bundle-1')))
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,92 @@
+import datetime
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from cassnap_manage import RetentionPolicy
+
+
+TODAY = datetime.date(2026, 3, 31)
+
+
+def days(*offsets):
+   return [TODAY - datetime.timedelta(days=offset) for offset in offsets]
+
+
+def snapshots(node, dates):
+   return [{'node': node, 'date': d.strftime('%Y_%m_%d') if isinstance(d, datetime.date) else d} for d in dates]
+
+
+def expired_dates(policy, snaps):
+   return sorted(s['date'] for s in policy.select_expired(snaps, TODAY))
+
+
+class KeepDatesTest(unittest.TestCase):
+   def test_no_rules_keeps_everything(self):
+      dates = days(0, 10, 400)
+      self.assertEqual(RetentionPolicy()._keep_dates(dates, TODAY), set(dates))
+
+   def test_daily_keeps_the_last_days(self):
+      dates = days(0, 1, 2, 3, 4)
+      self.assertEqual(RetentionPolicy(keep_daily=3)._keep_dates(dates, TODAY), set(days(0, 1, 2)))
+
+   def test_weekly_keeps_the_most_recent_snapshot_of_each_week(self):
+      # 2026-03-31 is a Tuesday: days 0-1 are in its week, 2-8 in the previous one
+      dates = days(0, 1, 2, 5, 8, 9, 16)
+      self.assertEqual(RetentionPolicy(keep_weekly=2)._keep_dates(dates, TODAY), set(days(0, 2)))
+
+   def test_monthly_keeps_the_most_recent_snapshot_of_each_month(self):
+      dates = [datetime.date(2026, 3, 1), datetime.date(2026, 2, 28), datetime.date(2026, 2, 1),
+               datetime.date(2026, 1, 15), datetime.date(2025, 12, 31)]
+      self.assertEqual(RetentionPolicy(keep_monthly=3)._keep_dates(dates, TODAY),
+                       set([datetime.date(2026, 3, 1), datetime.date(2026, 2, 28), datetime.date(2026, 1, 15)]))
+
+   def test_rules_add_up(self):
+      dates = days(0, 1, 2, 9, 40)
+      policy = RetentionPolicy(keep_daily=2, keep_monthly=2)
+      self.assertEqual(policy._keep_dates(dates, TODAY), set(days(0, 1, 40)))
+
+   def test_max_age_expires_older_dates(self):
+      dates = days(0, 5, 10, 11)
+      self.assertEqual(RetentionPolicy(max_age=10)._keep_dates(dates, TODAY), set(days(0, 5, 10)))
+      self.assertEqual(RetentionPolicy(keep_daily=4, max_age=7)._keep_dates(dates, TODAY), set(days(0, 5)))
+
+   def test_duplicated_dates(self):
+      dates = days(0, 0, 1)
+      self.assertEqual(RetentionPolicy(keep_daily=1)._keep_dates(dates, TODAY), set(days(0)))
+
+
+class SelectExpiredTest(unittest.TestCase):
+   def test_node_scope(self):
+      snaps = snapshots('n1', days(0, 1, 2)) + snapshots('n2', days(3, 4, 5))
+      self.assertEqual(expired_dates(RetentionPolicy(keep_daily=2), snaps),
+                       ['2026_03_26', '2026_03_29'])
+
+   def test_cluster_scope(self):
+      # The last 2 dates of the cluster are kept on every node
+      snaps = snapshots('n1', days(0, 1, 2)) + snapshots('n2', days(1, 2, 3))
+      policy = RetentionPolicy(keep_daily=2, scope='cluster')
+      self.assertEqual(sorted((s['node'], s['date']) for s in policy.select_expired(snaps, TODAY)),
+                       [('n1', '2026_03_29'), ('n2', '2026_03_28'), ('n2', '2026_03_29')])
+
+   def test_latest_is_never_expired(self):
+      snaps = snapshots('n1', days(100, 200)) + snapshots('n2', days(0))
+      self.assertEqual(expired_dates(RetentionPolicy(max_age=30), snaps), ['2025_09_12'])
+      policy = RetentionPolicy(keep_daily=1, scope='cluster')
+      self.assertEqual(expired_dates(policy, snaps), ['2025_09_12'])
+
+   def test_unparseable_dates_are_kept(self):
+      snaps = snapshots('n1', days(0, 50) + ['latest', '2026-01-01'])
+      self.assertEqual(expired_dates(RetentionPolicy(max_age=30), snaps), ['2026_02_09'])
+
+   def test_empty_policy(self):
+      self.assertTrue(RetentionPolicy().is_empty())
+      self.assertFalse(RetentionPolicy(max_age=0).is_empty())
+      snaps = snapshots('n1', days(0, 500))
+      self.assertEqual(expired_dates(RetentionPolicy(), snaps), [])
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,28 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from cassnap_manage import RetryPolicy, SlowTransferError
+
+
+class RetryPolicyTest(unittest.TestCase):
+   def test_slow_transfers_are_retried(self):
+      self.assertEqual(RetryPolicy().classify(error=SlowTransferError('slow')), 'retry')
+      self.assertEqual(RetryPolicy().classify(error=ValueError('bug')), 'fail')
+
+   def test_slow_transfer_is_raised_once_attempts_are_spent(self):
+      calls = []
+
+      def request():
+         calls.append(1)
+         raise SlowTransferError('slow')
+      policy = RetryPolicy(max_attempts=3, base_delay=0)
+      self.assertRaises(SlowTransferError, policy.run, request)
+      self.assertEqual(len(calls), 3)
+      self.assertEqual(policy.retries, 2)
+
+
+if __name__ == '__main__':
+   unittest.main()
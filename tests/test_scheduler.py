@@ -0,0 +1,70 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from cassnap_manage import UploadScheduler
+
+
+class UploadSchedulerTest(unittest.TestCase):
+   def test_largest_tasks_first(self):
+      started = []
+
+      def task(name):
+         def run():
+            started.append(name)
+            return name.upper()
+         return run
+
+      tasks = [('disk1', 10, task('a')), ('disk2', 50, task('b')), ('disk1', 30, task('c')),
+               ('disk2', 5, task('d')), ('disk1', 40, task('e'))]
+      done = []
+      results = UploadScheduler(workers=1).run(tasks, on_done=lambda idx, result: done.append((idx, result)))
+      self.assertEqual(started, ['b', 'e', 'c', 'a', 'd'])
+      self.assertEqual(results, ['A', 'B', 'C', 'D', 'E'])
+      self.assertEqual(sorted(done), [(0, 'A'), (1, 'B'), (2, 'C'), (3, 'D'), (4, 'E')])
+
+   def test_concurrent_reads_per_disk(self):
+      lock = threading.Lock()
+      active = {'disk1': 0, 'disk2': 0}
+      peak = {'disk1': 0, 'disk2': 0}
+      # Tasks of disk1 only end once two of them run together
+      pairs = threading.Barrier(2, timeout=10)
+      other_disk_done = threading.Event()
+
+      def task(disk):
+         def run():
+            with lock:
+               active[disk] += 1
+               peak[disk] = max(peak[disk], active[disk])
+            if disk == 'disk1':
+               pairs.wait()
+               # Workers left idle by the disk1 limit take the disk2 task meanwhile
+               self.assertTrue(other_disk_done.wait(10))
+            else:
+               other_disk_done.set()
+            with lock:
+               active[disk] -= 1
+         return run
+
+      tasks = [('disk1', size, task('disk1')) for size in (100, 90, 80, 70)] + [('disk2', 1, task('disk2'))]
+      UploadScheduler(workers=4, disk_readers=2).run(tasks)
+      self.assertEqual(peak, {'disk1': 2, 'disk2': 1})
+
+   def test_workers_limited_by_disks(self):
+      threads = set()
+
+      def run():
+         threads.add(threading.current_thread().name)
+
+      UploadScheduler(workers=8, disk_readers=2).run([('disk1', size, run) for size in range(20)])
+      self.assertLessEqual(len(threads), 2)
+
+   def test_no_task(self):
+      self.assertEqual(UploadScheduler().run([]), [])
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,135 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import cassnap_manage
+from cassnap_manage import LocalBackend
+
+
+SNAPSHOT = {'node': 'node1', 'date': '2026_03_31'}
+FILES = {
+   'ks/t1/a-Data.db': b'a' * 10,
+   'ks/t1/a-Index.db': b'b' * 5,
+   'ks/t2/b-Data.db': b'c' * 20,
+   'ks/t2/b-Index.db': b'd' * 7,
+}
+
+
+class VerifyTest(unittest.TestCase):
+   def setUp(self):
+      self.root = tempfile.mkdtemp()
+      os.mkdir(os.path.join(self.root, 'data'))
+      self.operation = cassnap_manage.ManageSnapshot(None, None, False, None, os.path.join(self.root, 'data'), None,
+                                                     None, '/backup', False, cluster_name='C', bootstrap=False,
+                                                     storage=LocalBackend(os.path.join(self.root, 'backup')))
+      for path, content in FILES.items():
+         self.write(path, content)
+      self.write_snapshot(dict((path, len(content)) for path, content in FILES.items()))
+
+   def tearDown(self):
+      shutil.rmtree(self.root)
+
+   def local(self, path):
+      return os.path.join(self.root, 'backup', path)
+
+   def write(self, path, content):
+      path = self.local('C/' + path)
+      if not os.path.isdir(os.path.dirname(path)):
+         os.makedirs(os.path.dirname(path))
+      with open(path, 'wb') as f:
+         f.write(content)
+
+   def write_snapshot(self, sizes):
+      path = self.local(self.operation._get_metadata_path(SNAPSHOT))
+      if not os.path.isdir(os.path.dirname(path)):
+         os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as f:
+         f.write(''.join('%s\t%d\t\n' % (p, size) for p, size in sorted(sizes.items())))
+
+   def checksums_file(self, directory):
+      with open(self.local(self.operation._get_checksums_path(directory))) as f:
+         return f.read()
+
+   def verify(self, sample=0):
+      return self.operation.verify_snapshot(SNAPSHOT, sample)
+
+   def test_complete_snapshot(self):
+      report = self.verify()
+      self.assertTrue(report['ok'])
+      self.assertEqual(report['objects'], 4)
+      self.assertEqual(report['checksummed'], 0)
+
+   def test_missing_file(self):
+      os.remove(self.local('C/ks/t1/a-Index.db'))
+      report = self.verify()
+      self.assertFalse(report['ok'])
+      self.assertEqual(report['missing'], ['ks/t1/a-Index.db'])
+
+   def test_size_mismatch(self):
+      self.write('ks/t2/b-Data.db', b'c' * 19)
+      report = self.verify()
+      self.assertFalse(report['ok'])
+      self.assertEqual(report['size_mismatch'], [{'path': 'ks/t2/b-Data.db', 'expected': 20, 'actual': 19}])
+
+   def test_legacy_metadata_without_sizes(self):
+      with open(self.local(self.operation._get_metadata_path(SNAPSHOT)), 'w') as f:
+         f.write(''.join(p + '\n' for p in sorted(FILES)))
+      self.write('ks/t2/b-Data.db', b'c' * 19)
+      self.assertTrue(self.verify()['ok'])
+
+   def test_sample_of_the_files(self):
+      report = self.verify(sample=50)
+      self.assertTrue(report['ok'])
+      self.assertEqual(report['checksummed'], 2)
+      recorded = {}
+      for directory in ('ks/t1', 'ks/t2'):
+         recorded.update(self.operation._get_recorded_checksums(directory))
+      self.assertEqual(len(recorded), 2)
+
+   def test_checksums_are_recorded_by_the_first_verification(self):
+      self.assertTrue(self.verify(sample=100)['ok'])
+      self.assertEqual(sorted(self.operation._get_recorded_checksums('ks/t1')), ['ks/t1/a-Data.db', 'ks/t1/a-Index.db'])
+      content = self.checksums_file('ks/t1')
+      # checked again against the recorded ones, not recorded twice
+      self.assertTrue(self.verify(sample=100)['ok'])
+      self.assertEqual(self.checksums_file('ks/t1'), content)
+
+   def test_checksum_mismatch(self):
+      self.verify(sample=100)
+      expected = self.operation._get_recorded_checksums('ks/t1')['ks/t1/a-Data.db']
+      self.write('ks/t1/a-Data.db', b'x' * 10)
+      report = self.verify(sample=100)
+      self.assertFalse(report['ok'])
+      self.assertEqual(len(report['checksum_mismatch']), 1)
+      mismatch = report['checksum_mismatch'][0]
+      self.assertEqual((mismatch['path'], mismatch['expected']), ('ks/t1/a-Data.db', expected))
+      self.assertNotEqual(mismatch['actual'], expected)
+
+   def test_forgotten_checksums_are_appended(self):
+      self.verify(sample=100)
+      content = self.checksums_file('ks/t1')
+      self.operation._forget_checksums(['ks/t1/a-Data.db'])
+      # the file is not rewritten, lines appended meanwhile by other nodes are kept
+      self.assertEqual(self.checksums_file('ks/t1'), content + 'ks/t1/a-Data.db\t\n')
+      self.assertEqual(sorted(self.operation._get_recorded_checksums('ks/t1')), ['ks/t1/a-Index.db'])
+
+      # a file uploaded again under the same path gets a new checksum
+      self.write('ks/t1/a-Data.db', b'x' * 10)
+      self.assertTrue(self.verify(sample=100)['ok'])
+      self.assertEqual(self.operation._get_recorded_checksums('ks/t1')['ks/t1/a-Data.db'],
+                       self.operation.storage.checksum('C/ks/t1/a-Data.db'))
+
+   def test_checksums_are_deleted_with_their_directory(self):
+      self.verify(sample=100)
+      shutil.rmtree(self.local('C/ks/t2'))
+      self.operation._forget_checksums(['ks/t2/b-Data.db', 'ks/t2/b-Index.db'])
+      self.assertFalse(os.path.exists(self.local(self.operation._get_checksums_path('ks/t2'))))
+      self.assertEqual(len(self.operation._get_recorded_checksums('ks/t1')), 2)
+
+
+if __name__ == '__main__':
+   unittest.main()
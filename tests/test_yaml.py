@@ -0,0 +1,97 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from cassnap_manage import read_yaml_keys
+
+
+CASSANDRA_YAML = """\
+# Cassandra storage config YAML
+cluster_name: 'Test Cluster'  # quoted
+num_tokens: 256
+# listen_address: commented.example.com
+listen_address: node1.example.com
+broadcast_address: "10.0.0.1"
+rpc_address: ~
+hints_directory:
+seed_provider:
+    - class_name: org.apache.cassandra.locator.SimpleSeedProvider
+      parameters:
+          # seeds is actually a comma-delimited list of addresses.
+          - seeds: "10.0.0.1,10.0.0.2"
+
+data_file_directories:
+# first disk
+- /data1/cassandra   # trailing comment
+    # second disk
+- '/data2/cassandra'
+commitlog_directory: /var/lib/cassandra/commitlog
+server_encryption_options:
+    internode_encryption: none
+    keystore: conf/.keystore
+"""
+
+
+class ReadYamlKeysTest(unittest.TestCase):
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.path = os.path.join(self.directory, 'cassandra.yaml')
+      self.write(CASSANDRA_YAML)
+
+   def tearDown(self):
+      shutil.rmtree(self.directory)
+
+   def write(self, content):
+      with open(self.path, 'w') as f:
+         f.write(content)
+
+   def read(self, *keys):
+      return read_yaml_keys(self.path, keys)
+
+   def test_plain_values(self):
+      self.assertEqual(self.read('listen_address', 'commitlog_directory', 'num_tokens'),
+                       {'listen_address': 'node1.example.com', 'num_tokens': '256',
+                        'commitlog_directory': '/var/lib/cassandra/commitlog'})
+
+   def test_quoted_values(self):
+      self.assertEqual(self.read('cluster_name', 'broadcast_address'),
+                       {'cluster_name': 'Test Cluster', 'broadcast_address': '10.0.0.1'})
+
+   def test_comment_characters_in_quoted_values(self):
+      self.write("cluster_name: 'Test #1' # the test one\nlisten_address: \"a: b\"\n")
+      self.assertEqual(self.read('cluster_name', 'listen_address'),
+                       {'cluster_name': 'Test #1', 'listen_address': 'a: b'})
+
+   def test_null_and_missing_values_are_left_out(self):
+      self.assertEqual(self.read('rpc_address', 'hints_directory', 'not_set'), {})
+
+   def test_lists_with_comments(self):
+      self.assertEqual(self.read('data_file_directories'),
+                       {'data_file_directories': ['/data1/cassandra', '/data2/cassandra']})
+
+   def test_nested_keys(self):
+      settings = self.read('seed_provider', 'server_encryption_options')
+      self.assertEqual(settings['seed_provider'],
+                       [{'class_name': 'org.apache.cassandra.locator.SimpleSeedProvider',
+                         'parameters': [{'seeds': '10.0.0.1,10.0.0.2'}]}])
+      self.assertEqual(settings['server_encryption_options'],
+                       {'internode_encryption': 'none', 'keystore': 'conf/.keystore'})
+
+   def test_only_requested_keys_are_read(self):
+      # The broken block of an other key is not parsed
+      self.write('listen_address: node1\nseed_provider:\n  - [unclosed\n')
+      self.assertEqual(self.read('listen_address'), {'listen_address': 'node1'})
+      self.assertRaises(ValueError, self.read, 'seed_provider')
+
+   def test_changed_file_is_read_again(self):
+      self.assertEqual(self.read('num_tokens'), {'num_tokens': '256'})
+      self.write('num_tokens: 16  \n')
+      self.assertEqual(self.read('num_tokens'), {'num_tokens': '16'})
+
+
+if __name__ == '__main__':
+   unittest.main()